@@ -0,0 +1,176 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+from metrics import Counter
+
+# Журнал в формате JSON Lines, который использовался до перехода на SQLite
+LOG_FILE = 'action_log.json'
+BACKUP_COUNT = 12
+PAGE_SIZE = 30
+# Буферизованная запись: размер очереди, размер пачки и интервал сброса (секунды)
+QUEUE_SIZE = 10000
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 1.0
+# Сколько дней хранить записи журнала (0 - без ограничения) и как часто удалять
+# старые (секунды). Итоги полива по дням и неделям хранятся отдельно и не удаляются.
+RETENTION_DAYS = 365
+PRUNE_INTERVAL = 86400
+
+DROPPED = Counter('watering_action_log_dropped_total', 'Записи журнала, отброшенные из-за переполнения очереди')
+
+
+def read_legacy_log(path=LOG_FILE, backup_count=BACKUP_COUNT):
+    # Записи старого журнала action_log.json и его ротированных копий
+    # (action_log.json.N) от самых старых к самым новым - для разового импорта
+    paths = [f"{path}.{i}" for i in range(backup_count, 0, -1)] + [path]
+    for log_path in paths:
+        if not os.path.exists(log_path):
+            continue
+        with open(log_path, 'r', encoding='utf-8') as log_file:
+            for line in log_file:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def matches(entry, valve=None, action=None, since=None, until=None):
+    if action is not None and entry['action'] != action:
+        return False
+    if valve is not None and valve not in entry['valves']:
+        return False
+    if since is not None or until is not None:
+        timestamp = datetime.fromisoformat(entry['timestamp'])
+        if since is not None and timestamp < since:
+            return False
+        if until is not None and timestamp > until:
+            return False
+    return True
+
+
+class ActionLogWriter:
+    # Буферизованная запись журнала действий вне цикла событий.
+    # log - хранилище с методами append_many(entries, fsync) и query(...).
+    # Записи копятся в ограниченной очереди и пишутся на диск пачками в отдельном
+    # потоке - по заполнению пачки или по интервалу. Если очередь переполнена
+    # (диск не успевает), новые записи отбрасываются и учитываются в dropped.
+    # Раз в PRUNE_INTERVAL записи старше retention_days удаляются (log.prune_actions).
+
+    def __init__(self, log, max_queue=QUEUE_SIZE, flush_size=FLUSH_SIZE, flush_interval=FLUSH_INTERVAL,
+                 retention_days=RETENTION_DAYS):
+        self.log = log
+        self.max_queue = max_queue
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.dropped = 0
+        self._pruned = None
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def append(self, entry):
+        if len(self._pending) >= self.max_queue:
+            self.dropped += 1
+            DROPPED.inc()
+            logging.error(f"Очередь журнала действий переполнена, запись отброшена ({self.dropped} всего)")
+            return
+        self._pending.append(entry)
+        if len(self._pending) >= self.flush_size:
+            self._wakeup.set()
+
+    async def query(self, valve=None, action=None, since=None, until=None, offset=0, limit=PAGE_SIZE, descending=True):
+        # Еще не записанные записи новее всех в хранилище: от новых к старым они
+        # идут первыми, от старых к новым - последними. Чтение из базы идет в
+        # отдельном потоке; пока оно идет, очередь не сбрасывается в базу.
+        filters = {'valve': valve, 'action': action, 'since': since, 'until': until}
+        async with self._flush_lock:
+            pending = [entry for entry in self._pending if matches(entry, **filters)]
+            if descending:
+                pending.reverse()
+                entries = pending[offset:offset + limit]
+                stored, has_more = await asyncio.to_thread(
+                    self.log.query, offset=max(offset - len(pending), 0), limit=limit - len(entries), **filters
+                )
+                return entries + stored, has_more or offset + len(entries) < len(pending)
+            stored, has_more = await asyncio.to_thread(
+                self.log.query, offset=offset, limit=limit, descending=False, **filters
+            )
+            if has_more:
+                return stored, True
+            start = max(offset - await asyncio.to_thread(self.log.count, **filters), 0)
+            entries = pending[start:start + limit - len(stored)]
+            return stored + entries, start + len(entries) < len(pending)
+
+    async def count(self, valve=None, action=None, since=None, until=None):
+        filters = {'valve': valve, 'action': action, 'since': since, 'until': until}
+        async with self._flush_lock:
+            pending = sum(1 for entry in self._pending if matches(entry, **filters))
+            return pending + await asyncio.to_thread(self.log.count, **filters)
+
+    async def flush(self, fsync=False):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = list(self._pending)
+            self._pending.clear()
+            try:
+                await asyncio.to_thread(self.log.append_many, batch, fsync)
+            except (OSError, sqlite3.Error) as e:
+                logging.error(f"Ошибка записи журнала действий: {e}")
+                # Возвращаем пачку в начало очереди, чтобы повторить при следующем сбросе
+                kept = batch[:self.max_queue - len(self._pending)]
+                self._pending.extendleft(reversed(kept))
+                if len(kept) < len(batch):
+                    self.dropped += len(batch) - len(kept)
+                    DROPPED.inc(len(batch) - len(kept))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Останавливает фоновую запись и сбрасывает остаток на диск с fsync
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush(fsync=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if self.retention_days and (self._pruned is None or time.monotonic() - self._pruned >= PRUNE_INTERVAL):
+                    self._pruned = time.monotonic()
+                    await self.prune()
+            except Exception as e:
+                # Запись журнала не должна останавливаться из-за одной ошибки
+                logging.error(f"Ошибка фоновой записи журнала действий: {e}")
+
+    async def prune(self):
+        before = datetime.now() - timedelta(days=self.retention_days)
+        try:
+            removed = await asyncio.to_thread(self.log.prune_actions, before)
+        except Exception as e:
+            logging.error(f"Ошибка удаления старых записей журнала: {e}")
+            return
+        if removed:
+            logging.info(f"Из журнала удалены записи старше {before:%d.%m.%Y}: {removed}")
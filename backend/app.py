@@ -1,21 +1,58 @@
+import time
+# Начало запуска: от него считаются фазы старта (см. mark_startup)
+STARTED = time.perf_counter()
 from nicegui import ui, app
-import socket
+import asyncio
+import bisect
 import json
 from datetime import datetime, timedelta
 import os
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.triggers.cron import CronTrigger
-
-# Настройка логирования
+from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED
+from fastapi.responses import PlainTextResponse
+from fleet import Fleet, load_devices, load_valve_mapping
+from coalescer import CommandCoalescer, COMMAND_WINDOW
+from outbox import Outbox
+from reconciler import Reconciler
+from mqtt_bridge import MqttBridge
+from offload import ScheduleSync, device_schedules, MAX_ON
+from valve_state import ValveStateCache, POLL_INTERVAL, STATE_TTL
+from timeline import Dispatcher, compile_timeline, days_mapping, entry_sort_key
+from sequencer import FlowSequencer
+from action_log import ActionLogWriter, read_legacy_log, PAGE_SIZE, RETENTION_DAYS
+from storage import Store, DB_FILE
+from grid import PagedTable
+import metrics
+
+# Настройка логирования. Запись в файл идет через очередь в отдельном потоке,
+# чтобы не блокировать цикл событий
+log_queue = queue.Queue()
+log_listener = QueueListener(log_queue, logging.FileHandler("watering_log_2024.log", encoding="utf-8"))
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(levelname)s - %(message)s',
     handlers=[
         logging.StreamHandler(),
-        logging.FileHandler("watering_log_2024.log", encoding="utf-8")
+        QueueHandler(log_queue)
     ]
 )
+log_listener.start()
+
+# Фазы запуска и их длительность. Холодный старт без устройств должен укладываться
+# в STARTUP_BUDGET секунд независимо от числа клапанов и записей расписания.
+STARTUP_BUDGET = 5.0
+STARTUP = metrics.Gauge('watering_startup_seconds', 'Длительность фаз запуска приложения', ['phase'])
+startup_phases = {}
+
+def mark_startup(phase):
+    now = time.perf_counter()
+    startup_phases[phase] = now - STARTED - sum(startup_phases.values())
+    STARTUP.set(startup_phases[phase], phase=phase)
+
+mark_startup('import')
 
 # Путь к файлу конфигурации
 CONFIG_FILE = 'config.json'
@@ -28,148 +65,346 @@ if os.path.exists(CONFIG_FILE):
 else:
     # Если файла нет, создаем конфигурацию по умолчанию
     config = {
-        "device_ip": "192.168.1.48",
-        "device_port": 8080,
-        "valve_mapping": {1: 16, 2: 14, 3: 12, 4: 13},
+        "devices": {"main": {"ip": "192.168.1.48", "port": 8080}},
+        "valve_mapping": {
+            1: {"device": "main", "pin": 16}, 2: {"device": "main", "pin": 14},
+            3: {"device": "main", "pin": 12}, 4: {"device": "main", "pin": 13},
+        },
         "valve_names": {1: "Клапан 1", 2: "Клапан 2", 3: "Клапан 3", 4: "Клапан 4"},
         "schedule": []
     }
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(config, f, ensure_ascii=False, indent=4)
 
-DEVICE_IP = config.get('device_ip')
-DEVICE_PORT = config.get('device_port')
-VALVE_MAPPING = {int(k): v for k, v in config.get('valve_mapping', {}).items()}
-VALVE_NAMES = {int(k): v for k, v in config.get('valve_names', {}).items()}
-schedule = config.get('schedule', [])
-
-# Соответствие дня недели числу (Понедельник=0)
-days_mapping = {
-    'Понедельник': 0, 'Вторник': 1, 'Среда': 2, 'Четверг': 3,
-    'Пятница': 4, 'Суббота': 5, 'Воскресенье': 6,
-}
-
-# Загрузка состояния из файла
-if os.path.exists(STATE_FILE):
-    with open(STATE_FILE, 'r', encoding='utf-8') as f:
-        state = json.load(f)
+# Устройства, клапаны, расписание, отмены и журнал хранятся в SQLite.
+# При первом запуске туда один раз импортируются config.json, state.json и action_log.json.
+store = Store(config.get('database', DB_FILE))
+if not store.is_imported():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    else:
+        state = {}
+    store.import_legacy(config, state, read_legacy_log())
 else:
-    state = {}
-
-today_watering_canceled = state.get('today_watering_canceled', False)
-canceled_date = state.get('canceled_date', None)
+    merged = store.merge_config(config)
+    if merged:
+        logging.info(f"Из {CONFIG_FILE} в базу перенесены: {', '.join(merged)}")
+# Журнал, записанный до появления итогов полива, сворачивается в них один раз
+store.backfill_usage()
+
+DEVICES = store.load_devices()
+VALVE_MAPPING, VALVE_NAMES = store.load_valves()
+
+def ignored_config_sections():
+    # Разделы config.json, правки в которых не применяются: новые устройства и клапаны
+    # и адреса устройств переносятся в базу при запуске, а пропускная способность,
+    # привязка и имена клапанов и расписание меняются в интерфейсе
+    ignored = []
+    capacities = {name: d['capacity'] for name, d in config.get('devices', {}).items() if 'capacity' in d}
+    if any(float(capacity) != DEVICES[name]['capacity'] for name, capacity in capacities.items()):
+        ignored.append('devices')
+    mapping = load_valve_mapping(config, next(iter(load_devices(config))))
+    if any(VALVE_MAPPING[valve] != target for valve, target in mapping.items()):
+        ignored.append('valve_mapping')
+    if any(VALVE_NAMES[int(valve)] != name for valve, name in config.get('valve_names', {}).items()):
+        ignored.append('valve_names')
+    stored_schedule = [(e['day'], e['time'], float(e['duration']), e['valves']) for e in store.load_schedule()]
+    config_schedule = [(e['day'], e['time'], float(e['duration']), e['valves']) for e in config.get('schedule', [])]
+    if config_schedule and sorted(config_schedule) != sorted(stored_schedule):
+        ignored.append('schedule')
+    return ignored
+
+ignored_sections = ignored_config_sections()
+if ignored_sections:
+    logging.warning(
+        f"Разделы {', '.join(ignored_sections)} в {CONFIG_FILE} отличаются от базы {store.path} и не применяются: "
+        f"после первого запуска эти настройки и расписание меняются только в интерфейсе"
+    )
+# Расход клапанов и пропускная способность линий устройств (0 - не задано)
+VALVE_FLOWS = store.load_flows()
+DEVICE_CAPACITY = {name: device['capacity'] for name, device in DEVICES.items()}
+# Расписание хранится отсортированным для таблицы: день недели, время, порядок добавления
+schedule = sorted(store.load_schedule(), key=entry_sort_key)
+# Даты (ISO), на которые полив отменен
+canceled_dates = store.load_cancellations()
+mark_startup('config')
+
+fleet = Fleet(DEVICES, VALVE_MAPPING)
+# Команды из расписания и интерфейса, пришедшие почти одновременно, уходят
+# на каждое устройство одним кадром
+commands = CommandCoalescer(fleet.set, window=config.get('command_window', COMMAND_WINDOW))
+# Поливы, которые вместе превысили бы пропускную способность линии устройства,
+# разносятся по времени при компиляции расписания
+sequencer = FlowSequencer(VALVE_FLOWS, DEVICE_CAPACITY, lambda valve: fleet.resolve(valve)[0])
 
 scheduler = AsyncIOScheduler()
 
+action_writer = ActionLogWriter(store, retention_days=config.get('action_retention_days', RETENTION_DAYS))
+
+SCHEDULER_LAG = metrics.Histogram(
+    'watering_scheduler_lag_seconds', 'Задержка запуска задания планировщика относительно запланированного времени'
+)
+SCHEDULER_EVENTS = metrics.Counter('watering_scheduler_events_total', 'Ошибки и пропуски заданий планировщика', ['event'])
+EVENT_LAG = metrics.Histogram('watering_schedule_event_lag_seconds', 'Задержка выполнения события расписания', ['action'])
+UI_REFRESH = metrics.Histogram('watering_ui_refresh_seconds', 'Время перестроения элементов страницы', ['view'])
+
+def on_scheduler_event(event):
+    if event.code == EVENT_JOB_SUBMITTED:
+        now = datetime.now().astimezone()
+        for run_time in event.scheduled_run_times:
+            SCHEDULER_LAG.observe(max((now - run_time).total_seconds(), 0.0))
+    elif event.code == EVENT_JOB_ERROR:
+        SCHEDULER_EVENTS.inc(event='error')
+    elif event.code == EVENT_JOB_MISSED:
+        SCHEDULER_EVENTS.inc(event='missed')
+
+scheduler.add_listener(on_scheduler_event, EVENT_JOB_SUBMITTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED)
+
+@app.get('/metrics')
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+@app.get('/health')
+def health_endpoint():
+    # Проверка живости без обращения к устройствам
+    return PlainTextResponse('ok')
+
 @app.on_startup
 async def init_scheduler():
     scheduler.start()
-    reschedule_jobs()
-
-def log_action(action_type, valves):
+    dispatcher.attach(scheduler)
+    valve_cache.start()
+    outbox.start()
+    reconciler.start()
+    if mqtt_bridge is not None:
+        mqtt_bridge.start()
+    if schedule_sync is not None:
+        schedule_sync.start()
+    action_writer.start()
+    mark_startup('server')
+    total = sum(startup_phases.values())
+    phases = ', '.join(f'{phase} {duration:.2f} с' for phase, duration in startup_phases.items())
+    logging.info(f"Запуск занял {total:.2f} с: {phases}")
+    if total > config.get('startup_budget', STARTUP_BUDGET):
+        logging.warning(f"Запуск дольше бюджета {config.get('startup_budget', STARTUP_BUDGET)} с")
+
+@app.on_shutdown
+async def close_devices():
+    await reconciler.stop()
+    if schedule_sync is not None:
+        await schedule_sync.stop()
+    if mqtt_bridge is not None:
+        await mqtt_bridge.stop()
+    await valve_cache.stop()
+    await outbox.stop()
+    await commands.stop()
+    await fleet.close()
+    await action_writer.stop()
+    store.close()
+    log_listener.stop()
+
+def log_action(action_type, valves, when=None):
     log_entry = {
-        'timestamp': datetime.now().isoformat(),
+        'timestamp': (when or datetime.now()).isoformat(),
         'action': action_type,
         'valves': valves
     }
     logging.info(f"{action_type} - Клапаны: {valves}")
-    with open("action_log.json", "a", encoding="utf-8") as log_file:
-        log_file.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
-
-def send_command(action, valves):
-    remapped_valves = [str(VALVE_MAPPING.get(valve, valve)) for valve in valves]
-    data = f"{action} {','.join(remapped_valves)}"
-    try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((DEVICE_IP, DEVICE_PORT))
-            s.sendall(data.encode())
-            logging.info(f"Команда отправлена: {data}")
-            if action != 'status':
-                log_action(action, valves)
-            else:
-                response = s.recv(1024).decode()
-                return response
-    except Exception as e:
-        logging.error(f"Ошибка при отправке команды: {e}")
-        return None
-
-def get_valve_status():
-    response = send_command('status', [])
-    valve_status = {}
-    if response:
-        # Пример ответа: "12=0;13=0;14=0;16=0;"
-        status_entries = response.strip().split(';')
-        for entry in status_entries:
-            if '=' in entry:
-                device_valve_number, state = entry.split('=')
-                try:
-                    device_valve_number = int(device_valve_number)
-                    state = int(state)
-                    # Найдем логический номер клапана по номеру устройства
-                    for valve_number, device_number in VALVE_MAPPING.items():
-                        if device_number == device_valve_number:
-                            valve_status[valve_number] = bool(state)
-                            break
-                except ValueError:
-                    continue
-    return valve_status
-
-def save_config():
-    config['schedule'] = schedule
-    config['valve_mapping'] = VALVE_MAPPING
-    config['valve_names'] = VALVE_NAMES
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=4)
-
-def save_state():
-    with open(STATE_FILE, 'w', encoding='utf-8') as f:
-        json.dump(state, f, ensure_ascii=False)
+    action_writer.append(log_entry)
+
+def on_delivered(action, valves):
+    log_action(action, valves)
+    valve_cache.update({valve: action == 'on' for valve in valves})
+    reconciler.kick()
+
+# Каждая команда сначала записывается в очередь в базе. Недоставленные команды
+# повторяются в фоне, в том числе после перезапуска.
+outbox = Outbox(store, commands.submit, on_delivered=on_delivered)
+
+async def deliver(action, valves):
+    # Возвращает True, если команда сразу доставлена на все затронутые устройства.
+    # Иначе она осталась в очереди и будет повторена.
+    return not await outbox.send(action, valves)
+
+async def send_command(action, valves):
+    # Ручная команда важнее расписания до его следующего события для этих клапанов
+    await reconciler.override(action, valves)
+    return await deliver(action, valves)
+
+async def get_valve_status():
+    return await fleet.status()
+
+# Общий кэш состояния клапанов, который опрашивает устройства в фоне
+valve_cache = ValveStateCache(
+    get_valve_status,
+    interval=config.get('status_poll_interval', POLL_INTERVAL),
+    ttl=config.get('status_ttl', STATE_TTL),
+)
 
-def reschedule_jobs():
-    scheduler.remove_all_jobs()
+# Поливы, открытые по журналу на момент запуска. Если первый же опрос показывает
+# клапан закрытым, выключение потерялось при сбое и полив закрывается оценочно.
+interrupted_runs = set(store.load_open_runs())
+
+def close_interrupted_runs(changes):
+    closed = [valve for valve, state in changes.items() if valve in interrupted_runs and not state]
+    interrupted_runs.difference_update(changes)
+    if closed:
+        logging.warning(f"Выключение клапанов {closed} не попало в журнал, полив закрыт по времени опроса")
+        asyncio.create_task(asyncio.to_thread(store.close_interrupted_runs, closed, datetime.now()))
+    if not interrupted_runs:
+        unsubscribe_interrupted()
+
+unsubscribe_interrupted = valve_cache.subscribe(close_interrupted_runs) if interrupted_runs else None
+
+# Мост в MQTT (Home Assistant) включается секцией "mqtt" в config.json
+mqtt_config = config.get('mqtt') or {}
+mqtt_bridge = MqttBridge(mqtt_config, valve_cache, VALVE_NAMES, send_command) if mqtt_config.get('host') else None
+
+def is_watering_canceled(date):
+    return date.isoformat() in canceled_dates
+
+async def execute_event(when, on, off):
+    # Выключение и включение попадают в одно окно и уходят одной командой на устройство.
+    # Клапаны плат, которые выполняют текущее расписание сами, пропускаем.
+    if schedule_sync is not None:
+        on = [valve for valve in on if not schedule_sync.handles(valve)]
+        off = [valve for valve in off if not schedule_sync.handles(valve)]
+    lag = (datetime.now() - when).total_seconds()
+    sends = []
+    if off:
+        EVENT_LAG.observe(lag, action='off')
+        sends.append(deliver('off', off))
+    if on:
+        EVENT_LAG.observe(lag, action='on')
+        sends.append(deliver('on', on))
+    await asyncio.gather(*sends)
+
+# Расписание компилируется в недельную ленту событий, которую исполняет один
+# диспетчер. В планировщике всегда одно задание - ближайшее событие.
+dispatcher = Dispatcher(compile_timeline(schedule, sequencer), execute_event, is_canceled=is_watering_canceled)
+
+# Сверка фактического состояния клапанов с расписанием и ручными командами
+reconciler = Reconciler(store, valve_cache, outbox, VALVE_MAPPING, dispatcher, is_canceled=is_watering_canceled)
+
+def update_timeline():
+    dispatcher.set_timeline(compile_timeline(schedule, sequencer))
+    dispatcher.arm()
+    reconciler.kick()
+    if schedule_sync is not None:
+        schedule_sync.kick()
+
+def on_board_report(device, reports):
+    # Действия, которые плата выполнила сама, попадают в журнал с ее временем.
+    # Отчеты читаются с опозданием, поэтому в кэш состояния уходит только итог
+    # по каждому клапану и только если с тех пор состояние не обновлялось.
+    pins = {pin: valve for valve, (device_name, pin) in fleet.mapping.items() if device_name == device}
+    states = {}
+    forced = {}
+    for when, on_mask, off_mask, source in reports:
+        on = sorted(valve for pin, valve in pins.items() if on_mask >> pin & 1)
+        off = sorted(valve for pin, valve in pins.items() if off_mask >> pin & 1)
+        for action, valves in (('on', on), ('off', off)):
+            if valves:
+                log_action(action, valves, when=when)
+                states.update({valve: (action == 'on', when) for valve in valves})
+        if source == 'f':
+            forced.update({valve: when for valve in off})
+    by_time = {}
+    for valve, (state, when) in states.items():
+        by_time.setdefault(when, {})[valve] = state
+    for when, changes in by_time.items():
+        valve_cache.update(changes, since=time.monotonic() - (time.time() - when.timestamp()))
+    # Сработал предел времени включения: сверка не должна открыть клапаны снова,
+    # если после этого не было новой ручной команды
+    forced = sorted(
+        valve for valve, when in forced.items()
+        if reconciler.overrides.get(valve, (None, 0))[1] < when.timestamp()
+    )
+    if forced:
+        logging.warning(f"Устройство {device} выключило клапаны {forced} по пределу времени включения")
+        asyncio.create_task(reconciler.override('off', forced))
+
+# Расписание выполняют сами платы с протоколом 3 и выше: сервер досылает изменения
+# и читает отчеты. Отключается параметром "offload_schedule": false в config.json.
+schedule_sync = ScheduleSync(
+    fleet,
+    desired=lambda: device_schedules(
+        dispatcher.timeline, fleet.mapping, canceled_dates, max_on=config.get('max_on_minutes', MAX_ON // 60) * 60,
+    ),
+    on_report=on_board_report,
+) if config.get('offload_schedule', True) else None
+
+# Сколько последних дней и недель показывать в статистике полива
+USAGE_DAYS = 14
+USAGE_WEEKS = 12
+
+async def usage_rows(period):
+    # Строки статистики: период -> минуты полива по клапанам, от новых к старым.
+    # Читаются только готовые итоги, без разбора журнала.
     today = datetime.now().date()
+    if period == 'week':
+        since = today - timedelta(days=today.weekday(), weeks=USAGE_WEEKS - 1)
+    else:
+        since = today - timedelta(days=USAGE_DAYS - 1)
+    rows = {}
+    for valve, start, seconds, runs in await asyncio.to_thread(store.usage, period, since=since):
+        row = rows.setdefault(start, {'period': start})
+        row[f'valve_{valve}'] = f'{seconds / 60:.0f} ({runs})'
+    return [rows[start] for start in sorted(rows, reverse=True)]
+
+async def month_usage():
+    # Минуты полива по клапанам с начала месяца
+    totals = {}
+    for valve, _, seconds, _ in await asyncio.to_thread(store.usage, 'day', since=datetime.now().date().replace(day=1)):
+        totals[valve] = totals.get(valve, 0) + seconds
+    return totals
+
+# Сколько пересечений и сдвигов поливов перечислять под расписанием
+OVERLAPS_SHOWN = 10
+
+DAY_NAMES = {number: name for name, number in days_mapping.items()}
+
+def format_week_second(second, day=True):
+    second %= 7 * 86400
+    clock = f'{second % 86400 // 3600:02d}:{second % 3600 // 60:02d}'
+    if second % 60:
+        clock += f':{second % 60:02d}'
+    return f'{DAY_NAMES[second // 86400]} {clock}' if day else clock
+
+def schedule_page(offset, limit, sort_by, descending):
+    # Страница таблицы расписания. Порядок по дню и времени уже есть в списке,
+    # по длительности сортируем только по запросу.
+    if sort_by == 'duration':
+        entries = sorted(schedule, key=lambda entry: (float(entry['duration']), entry_sort_key(entry)), reverse=descending)
+    else:
+        entries = schedule[::-1] if descending else schedule
+    rows = [
+        {
+            'id': entry['id'],
+            'day': entry['day'],
+            'time': entry['time'],
+            'duration': entry['duration'],
+            'valves': ', '.join(VALVE_NAMES.get(v, f'Клапан {v}') for v in entry['valves']),
+        }
+        for entry in entries[offset:offset + limit]
+    ]
+    return rows, len(schedule)
 
-    for entry in schedule:
-        day = entry['day']
-        time_str = entry['time']
-        duration = entry['duration']
-        valves = entry['valves']
-        hour, minute = map(int, time_str.split(':'))
-
-        day_of_week = days_mapping.get(day, None)
-        if day_of_week is None:
-            logging.warning(f"Некорректный день недели: {day}")
-            continue
-
-        skip_today = False
-        if today_watering_canceled and canceled_date == today.isoformat():
-            if today.weekday() == day_of_week:
-                skip_today = True
-
-        if skip_today:
-            continue
-
-        trigger_on = CronTrigger(day_of_week=day_of_week, hour=hour, minute=minute)
-        scheduler.add_job(send_command, trigger=trigger_on, args=['on', valves])
-
-        start_time = datetime.strptime(time_str, '%H:%M')
-        off_time = (start_time + timedelta(minutes=int(duration))).time()
-        hour_off = off_time.hour
-        minute_off = off_time.minute
-
-        trigger_off = CronTrigger(day_of_week=day_of_week, hour=hour_off, minute=minute_off)
-        scheduler.add_job(send_command, trigger=trigger_off, args=['off', valves])
+# Открытые страницы: функции перестроения расписания и списка клапанов. Изменение,
+# сделанное на одной странице, показывается на всех.
+schedule_views = set()
+valve_views = set()
 
-def get_last_actions():
-    try:
-        with open("action_log.json", "r", encoding="utf-8") as log_file:
-            logs = [json.loads(line) for line in log_file.readlines()]
-            return logs[-30:]
-    except FileNotFoundError:
-        return []
+def refresh_views(views):
+    for refresh in list(views):
+        refresh()
 
-def main_page():
-    global cancel_button, today_watering_canceled, canceled_date, schedule_container, valve_states, valve_switches_container
+@ui.page('/')
+def main_page(client):
+    # Страница строится для каждого клиента отдельно и только из памяти: состояние
+    # клапанов берется из кэша, а устаревший кэш обновляется уже после отдачи страницы
+    page_started = time.perf_counter()
 
     with ui.header().classes('items-center justify-center') as header:
         ui.label('Система управления поливом - 2024').classes('text-h4 text-white')
@@ -177,25 +412,75 @@ def main_page():
         header.style('background-color: #4CAF50;')
 
     def show_last_actions():
-        last_actions = get_last_actions()
         with ui.dialog() as dialog:
-            with ui.card().style('width: 600px;'):
+            with ui.card().style('width: 700px; max-width: 90vw;'):
                 ui.label('Последние действия').classes('text-h6')
-                with ui.element('table').style('width: 100%; border-collapse: collapse;'):
-                    with ui.element('thead'):
-                        with ui.element('tr'):
-                            for header_text in ['Время', 'Действие', 'Клапаны']:
-                                with ui.element('th').style('border: 1px solid black; padding: 5px;'):
-                                    ui.label(header_text)
-                    with ui.element('tbody'):
-                        for log in last_actions:
-                            with ui.element('tr'):
-                                timestamp = datetime.fromisoformat(log['timestamp']).strftime('%d.%m.%Y %H:%M')
-                                action = 'Включение' if log['action'] == 'on' else 'Выключение'
-                                valves = ', '.join(VALVE_NAMES.get(v, f'Клапан {v}') for v in log['valves'])
-                                for value in [timestamp, action, valves]:
-                                    with ui.element('td').style('border: 1px solid black; padding: 5px;'):
-                                        ui.label(value)
+                with ui.row().classes('items-center w-full'):
+                    valve_filter = ui.select({0: 'Все краны', **VALVE_NAMES}, value=0, label='Кран').classes('w-40')
+                    action_filter = ui.select(
+                        {'': 'Все действия', 'on': 'Включение', 'off': 'Выключение'}, value='', label='Действие'
+                    ).classes('w-40')
+                    since_input = ui.input(label='С').props('type=date')
+                    until_input = ui.input(label='По').props('type=date')
+
+                async def fetch_history(offset, limit, sort_by, descending):
+                    filters = {
+                        'valve': valve_filter.value or None,
+                        'action': action_filter.value or None,
+                        'since': datetime.fromisoformat(since_input.value) if since_input.value else None,
+                        'until': datetime.fromisoformat(until_input.value) + timedelta(days=1) if until_input.value else None,
+                    }
+                    entries, _ = await action_writer.query(offset=offset, limit=limit, descending=descending, **filters)
+                    rows = [
+                        {
+                            'key': offset + i,
+                            'timestamp': datetime.fromisoformat(log['timestamp']).strftime('%d.%m.%Y %H:%M'),
+                            'action': 'Включение' if log['action'] == 'on' else 'Выключение',
+                            'valves': ', '.join(VALVE_NAMES.get(v, f'Клапан {v}') for v in log['valves']),
+                        }
+                        for i, log in enumerate(entries)
+                    ]
+                    return rows, await action_writer.count(**filters)
+
+                history_table = PagedTable([
+                    {'name': 'timestamp', 'label': 'Время', 'field': 'timestamp', 'align': 'left', 'sortable': True},
+                    {'name': 'action', 'label': 'Действие', 'field': 'action', 'align': 'left'},
+                    {'name': 'valves', 'label': 'Клапаны', 'field': 'valves', 'align': 'left'},
+                ], fetch_history, row_key='key', rows_per_page=PAGE_SIZE, sort_by='timestamp', descending=True)
+                ui.button('Закрыть', on_click=dialog.close, color='grey', icon='close')
+
+        def apply_filters():
+            history_table.table.pagination['page'] = 1
+            history_table.refresh()
+
+        for control in (valve_filter, action_filter, since_input, until_input):
+            control.on_value_change(apply_filters)
+        dialog.open()
+
+    async def show_usage():
+        totals = await month_usage()
+        rows = await usage_rows('day')
+        with ui.dialog() as dialog:
+            with ui.card().style('width: 700px; max-width: 90vw;'):
+                ui.label('Статистика полива').classes('text-h6')
+                ui.label('С начала месяца: ' + (', '.join(
+                    f"{VALVE_NAMES.get(valve, f'Клапан {valve}')} - {seconds / 60:.0f} мин"
+                    for valve, seconds in sorted(totals.items())
+                ) or 'поливов не было'))
+                period_select = ui.select({'day': 'По дням', 'week': 'По неделям'}, value='day', label='Период')
+                ui.label('Минуты полива (число поливов)').classes('text-grey')
+                usage_table = ui.table(columns=[
+                    {'name': 'period', 'label': 'Период', 'field': 'period', 'align': 'left'},
+                    *[
+                        {'name': f'valve_{valve}', 'label': name, 'field': f'valve_{valve}'}
+                        for valve, name in VALVE_NAMES.items()
+                    ],
+                ], rows=rows, row_key='period').classes('w-full')
+
+                async def change_period():
+                    usage_table.rows = await usage_rows(period_select.value)
+
+                period_select.on_value_change(change_period)
                 ui.button('Закрыть', on_click=dialog.close, color='grey', icon='close')
         dialog.open()
 
@@ -207,33 +492,77 @@ def main_page():
                 with ui.element('table').style('width: 100%; border-collapse: collapse;'):
                     with ui.element('thead'):
                         with ui.element('tr'):
-                            for header_text in ['Номер', 'Номер на устройстве', 'Имя']:
+                            for header_text in ['Номер', 'Устройство', 'Номер на устройстве', 'Имя', 'Расход']:
                                 with ui.element('th').style('border: 1px solid black; padding: 5px;'):
                                     ui.label(header_text)
                     with ui.element('tbody'):
                         for valve_number in sorted(VALVE_NAMES.keys()):
                             valve_name = VALVE_NAMES[valve_number]
-                            device_valve_number = VALVE_MAPPING.get(valve_number, valve_number)
+                            device_name, device_valve_number = fleet.resolve(valve_number)
                             with ui.element('tr'):
                                 with ui.element('td').style('border: 1px solid black; padding: 5px;'):
                                     ui.label(f'{valve_number}')
+                                with ui.element('td').style('border: 1px solid black; padding: 5px;'):
+                                    device_select = ui.select(list(DEVICES.keys()), value=device_name).classes('w-full')
                                 with ui.element('td').style('border: 1px solid black; padding: 5px;'):
                                     device_input = ui.input(value=str(device_valve_number)).props('type=number').classes('w-full')
                                 with ui.element('td').style('border: 1px solid black; padding: 5px;'):
                                     name_input = ui.input(value=valve_name).classes('w-full')
-                                valve_entries.append((valve_number, device_input, name_input))
+                                with ui.element('td').style('border: 1px solid black; padding: 5px;'):
+                                    flow_input = ui.number(value=VALVE_FLOWS.get(valve_number, 0), min=0).classes('w-full')
+                                valve_entries.append((valve_number, device_select, device_input, name_input, flow_input))
+
+                # Поливы одного устройства, суммарный расход которых больше пропускной
+                # способности линии, будут разнесены по времени. 0 - без ограничения.
+                ui.label('Пропускная способность линий').classes('text-subtitle1')
+                capacity_inputs = {}
+                with ui.row():
+                    for device_name in DEVICES:
+                        capacity_inputs[device_name] = ui.number(
+                            device_name, value=DEVICE_CAPACITY.get(device_name, 0), min=0,
+                        )
 
                 def save_settings():
-                    global VALVE_MAPPING, VALVE_NAMES
-                    for valve_number, device_input, name_input in valve_entries:
+                    changed = []
+                    flows = {}
+                    invalid = []
+                    for valve_number, device_select, device_input, name_input, flow_input in valve_entries:
+                        target = fleet.resolve(valve_number)
                         try:
-                            device_valve_number = int(device_input.value)
-                            VALVE_MAPPING[valve_number] = device_valve_number
+                            target = (device_select.value, int(device_input.value))
                         except ValueError:
                             pass  # ignore invalid number
-                        VALVE_NAMES[valve_number] = name_input.value
-                    save_config()
-                    update_valve_switches()
+                        # Пин должен быть среди тех, о которых сообщило устройство
+                        device_pins = fleet.pins.get(target[0])
+                        if device_pins is not None and not device_pins >> target[1] & 1:
+                            invalid.append(valve_number)
+                            target = fleet.resolve(valve_number)
+                        if VALVE_MAPPING.get(valve_number) != target or VALVE_NAMES[valve_number] != name_input.value:
+                            VALVE_MAPPING[valve_number] = target
+                            VALVE_NAMES[valve_number] = name_input.value
+                            changed.append((valve_number, name_input.value, *target))
+                        flow = float(flow_input.value or 0)
+                        if VALVE_FLOWS.get(valve_number, 0) != flow:
+                            VALVE_FLOWS[valve_number] = flow
+                            flows[valve_number] = flow
+                    capacities = {}
+                    for device_name, capacity_input in capacity_inputs.items():
+                        capacity = float(capacity_input.value or 0)
+                        if DEVICE_CAPACITY.get(device_name, 0) != capacity:
+                            DEVICE_CAPACITY[device_name] = capacity
+                            capacities[device_name] = capacity
+                    store.save_valves(changed)
+                    if changed and mqtt_bridge is not None:
+                        mqtt_bridge.publish_discovery()
+                    store.save_flows(flows)
+                    store.save_capacities(capacities)
+                    if changed or flows or capacities:
+                        # Привязка к устройствам и расходы меняют план поливов
+                        update_timeline()
+                        refresh_views(schedule_views)
+                    refresh_views(valve_views)
+                    if invalid:
+                        ui.notify(f'Пины клапанов {invalid} нет на устройстве, привязка не изменена', color='negative')
                     dialog.close()
 
                 with ui.row().classes('justify-end'):
@@ -245,9 +574,6 @@ def main_page():
         build_valve_switches()
         refresh_schedule()
 
-    # Получаем состояние клапанов при загрузке страницы
-    initial_valve_status = get_valve_status()
-
     with ui.element('div').style('display: flex; width: 100%; padding: 20px;'):
         with ui.card().style('flex: 0 0 40%; margin-right: 10px;'):
             with ui.row().classes('items-center justify-between'):
@@ -255,22 +581,47 @@ def main_page():
                 with ui.row().classes('items-center'):
                     ui.button('', on_click=show_settings, icon='settings', color='primary')
                     ui.button('', on_click=show_last_actions, icon='history', color='primary')
+                    ui.button('', on_click=show_usage, icon='bar_chart', color='primary')
             valve_states = {}
             valve_switches_container = ui.column()
+            stale_label = ui.label('Нет свежих данных от устройства').classes('text-grey')
+            stale_label.visible = valve_cache.is_stale()
+
+            def on_valve_state_change(changes):
+                # Обновления приходят из фонового опроса и после любых команд,
+                # в том числе от расписания
+                with UI_REFRESH.time(view='valve_state'):
+                    for valve_number, value in changes.items():
+                        switch = valve_states.get(valve_number)
+                        if switch is not None:
+                            switch.value = value
+                    stale_label.visible = valve_cache.is_stale()
+
+            unsubscribe_state = valve_cache.subscribe(on_valve_state_change)
 
             def create_valve_switch(valve_number):
-                def on_change(e):
+                async def on_change(e):
+                    # Переключатель совпадает с известным состоянием - значит его
+                    # обновили программно, команду отправлять не нужно
+                    if valve_cache.get(valve_number) == e.value:
+                        return
                     action = 'on' if e.value else 'off'
-                    send_command(action, [valve_number])
+                    if not await send_command(action, [valve_number]):
+                        ui.notify('Устройство недоступно, команда будет повторена', color='orange')
+                    # Переключатель показывает подтвержденное состояние: включение могло
+                    # не дойти или быть отменено выключением в том же окне
+                    e.sender.value = valve_cache.get(valve_number)
 
                 valve_name = VALVE_NAMES.get(valve_number, f'Клапан {valve_number}')
-                switch = ui.switch(valve_name, on_change=on_change)
                 # Устанавливаем начальное состояние переключателя
-                if initial_valve_status and valve_number in initial_valve_status:
-                    switch.value = initial_valve_status[valve_number]
+                switch = ui.switch(valve_name, value=valve_cache.get(valve_number), on_change=on_change)
                 valve_states[valve_number] = switch
 
             def build_valve_switches():
+                with UI_REFRESH.time(view='valves'):
+                    build_valve_switch_list()
+
+            def build_valve_switch_list():
                 valve_switches_container.clear()
                 with valve_switches_container:
                     for valve_number in VALVE_NAMES.keys():
@@ -278,54 +629,42 @@ def main_page():
 
             build_valve_switches()
 
-            def close_all_valves():
-                send_command('off', list(VALVE_NAMES.keys()))
-                for switch in valve_states.values():
-                    switch.value = False
+            async def close_all_valves():
+                if not await send_command('off', list(VALVE_NAMES.keys())):
+                    ui.notify('Часть кранов недоступна, команда будет повторена', color='orange')
 
             ui.button('Закрыть все краны', on_click=close_all_valves, color='red', icon='close')
 
         with ui.card().style('flex: 1; margin-left: 10px;'):
             ui.label('Управление расписанием').classes('text-h5')
-            schedule_container = ui.column().classes('w-full')
+            schedule_table = PagedTable([
+                {'name': 'when', 'label': 'День недели', 'field': 'day', 'align': 'left', 'sortable': True},
+                {'name': 'time', 'label': 'Время', 'field': 'time', 'align': 'left'},
+                {'name': 'duration', 'label': 'Длительность (мин)', 'field': 'duration', 'sortable': True},
+                {'name': 'valves', 'label': 'Клапаны', 'field': 'valves', 'align': 'left'},
+                {'name': 'actions', 'label': 'Действия', 'field': 'id'},
+            ], schedule_page, sort_by='when')
+            schedule_table.table.add_slot('body-cell-actions', """
+                <q-td :props="props">
+                    <q-btn label="Удалить" icon="delete" color="red" dense @click="() => $parent.$emit('delete', props.row.id)" />
+                </q-td>
+            """)
+            schedule_table.table.on('delete', lambda e: delete_schedule_entry(e.args))
 
             def refresh_schedule():
-                schedule_container.clear()
-
-                def sort_key(entry):
-                    day_num = days_mapping.get(entry['day'], 7)
-                    time_obj = datetime.strptime(entry['time'], '%H:%M')
-                    return (day_num, time_obj)
-
-                indexed_schedule = [{'idx': idx, 'entry': entry} for idx, entry in enumerate(schedule)]
-                sorted_schedule = sorted(indexed_schedule, key=lambda x: sort_key(x['entry']))
-
-                with schedule_container:
-                    with ui.element('table').classes('schedule-table').style('width: 100%; border-collapse: collapse;'):
-                        with ui.element('thead'):
-                            with ui.element('tr'):
-                                for header_text in ['День недели', 'Время', 'Длительность (мин)', 'Клапаны', 'Действия']:
-                                    with ui.element('th').style('border: 1px solid black; padding: 5px;'):
-                                        ui.label(header_text)
-                        with ui.element('tbody'):
-                            for item in sorted_schedule:
-                                idx = item['idx']
-                                entry = item['entry']
-                                valves_display = ', '.join(VALVE_NAMES.get(v, f'Клапан {v}') for v in entry['valves'])
-                                with ui.element('tr'):
-                                    for value in [entry['day'], entry['time'], entry['duration'], valves_display]:
-                                        with ui.element('td').style('border: 1px solid black; padding: 5px;'):
-                                            ui.label(str(value))
-                                    with ui.element('td').style('border: 1px solid black; padding: 5px;'):
-                                        ui.button('Удалить', on_click=lambda _, idx=idx: delete_schedule_entry(idx), color='red', icon='delete')
-
+                with UI_REFRESH.time(view='schedule'):
+                    schedule_table.refresh()
                 update_cancel_button_state()
+                update_timeline_labels()
 
-            def delete_schedule_entry(idx):
-                schedule.pop(idx)
-                save_config()
-                refresh_schedule()
-                reschedule_jobs()
+            def delete_schedule_entry(entry_id):
+                entry = next((entry for entry in schedule if entry['id'] == entry_id), None)
+                if entry is None:
+                    return
+                schedule.remove(entry)
+                store.delete_schedule_entry(entry_id)
+                update_timeline()
+                refresh_views(schedule_views)
 
             def add_schedule_entry():
                 with ui.dialog() as dialog:
@@ -354,10 +693,10 @@ def main_page():
                                         'duration': duration_input.value,
                                         'valves': selected_valves,
                                     }
-                                    schedule.append(new_entry)
-                                    save_config()
-                                    refresh_schedule()
-                                    reschedule_jobs()
+                                    new_entry['id'] = store.add_schedule_entry(new_entry)
+                                    bisect.insort(schedule, new_entry, key=entry_sort_key)
+                                    update_timeline()
+                                    refresh_views(schedule_views)
                                     dialog.close()
                                 except Exception as e:
                                     logging.error(f"Ошибка при сохранении записи расписания: {e}")
@@ -379,7 +718,7 @@ def main_page():
                 else:
                     cancel_button.enable()
 
-                if today_watering_canceled and canceled_date == today.isoformat():
+                if is_watering_canceled(today):
                     cancel_button.text = 'Включить сегодняшний полив'
                     color = 'green'
                     icon = 'check_circle'
@@ -392,29 +731,86 @@ def main_page():
                 cancel_button.update()
 
             def toggle_today_watering():
-                global today_watering_canceled, canceled_date
-                today = datetime.now().date()
-                if today_watering_canceled and canceled_date == today.isoformat():
-                    today_watering_canceled = False
-                    state['today_watering_canceled'] = False
-                    state['canceled_date'] = None
+                today = datetime.now().date().isoformat()
+                if today in canceled_dates:
+                    canceled_dates.discard(today)
+                    store.set_canceled(today, False)
                 else:
-                    today_watering_canceled = True
-                    state['today_watering_canceled'] = True
-                    state['canceled_date'] = today.isoformat()
-                save_state()
-                reschedule_jobs()
-                update_cancel_button_state()
+                    canceled_dates.add(today)
+                    store.set_canceled(today, True)
+                # Идущий сегодня полив закрывается или возобновляется сверкой состояния
+                reconciler.kick()
+                if schedule_sync is not None:
+                    schedule_sync.kick()
+                refresh_views(schedule_views)
 
             with ui.row().classes('justify-start'):
                 ui.button('Добавить в расписание', on_click=add_schedule_entry, icon='add', color='primary')
                 cancel_button = ui.button('Отменить сегодняшний полив', on_click=toggle_today_watering)
+            next_event_label = ui.label()
+            overlaps_label = ui.label().classes('text-orange')
+            shifts_label = ui.label().classes('text-orange')
+
+            def update_timeline_labels():
+                next_event = dispatcher.timeline.next_event(datetime.now())
+                if next_event is None:
+                    next_event_label.text = 'Расписание пусто'
+                else:
+                    when, event = next_event
+                    parts = []
+                    if event.on:
+                        parts.append('включение: ' + ', '.join(VALVE_NAMES.get(v, f'Клапан {v}') for v in sorted(event.on)))
+                    if event.off:
+                        parts.append('выключение: ' + ', '.join(VALVE_NAMES.get(v, f'Клапан {v}') for v in sorted(event.off)))
+                    next_event_label.text = f"Следующее событие {when.strftime('%d.%m.%Y %H:%M:%S')} - {'; '.join(parts)}"
+
+                # Показываем только первые пересечения, чтобы размер страницы не зависел от расписания
+                all_overlaps = dispatcher.timeline.overlaps
+                overlaps = [
+                    f"{VALVE_NAMES.get(valve, f'Клапан {valve}')} ({format_week_second(second)})"
+                    for valve, second in all_overlaps[:OVERLAPS_SHOWN]
+                ]
+                if len(all_overlaps) > OVERLAPS_SHOWN:
+                    overlaps.append(f'и еще {len(all_overlaps) - OVERLAPS_SHOWN}')
+                overlaps_label.text = f"Пересекающиеся поливы объединены: {', '.join(overlaps)}" if overlaps else ''
+                overlaps_label.visible = bool(overlaps)
+
+                all_shifts = dispatcher.timeline.shifts
+                shifts = [
+                    f"{VALVE_NAMES.get(valve, f'Клапан {valve}')} ({format_week_second(requested)} → "
+                    f"{format_week_second(start, day=start // 86400 != requested // 86400)})"
+                    for valve, requested, start, _ in all_shifts[:OVERLAPS_SHOWN]
+                ]
+                if len(all_shifts) > OVERLAPS_SHOWN:
+                    shifts.append(f'и еще {len(all_shifts) - OVERLAPS_SHOWN}')
+                shifts_label.text = f"Сдвинуты из-за ограничения расхода: {', '.join(shifts)}" if shifts else ''
+                shifts_label.visible = bool(shifts)
+
+            ui.timer(30, update_timeline_labels)
 
             refresh_schedule()
 
     with ui.footer().style('background-color: #4CAF50; color: white;').classes('items-center justify-center'):
         ui.label('© 2024 Система управления поливом')
 
-main_page()
+    schedule_views.add(refresh_schedule)
+    valve_views.add(update_valve_switches)
+
+    def on_disconnect():
+        unsubscribe_state()
+        schedule_views.discard(refresh_schedule)
+        valve_views.discard(update_valve_switches)
+
+    client.on_disconnect(on_disconnect)
+
+    UI_REFRESH.observe(time.perf_counter() - page_started, view='page')
+    if 'first_page' not in startup_phases:
+        startup_phases['first_page'] = time.perf_counter() - page_started
+        STARTUP.set(startup_phases['first_page'], phase='first_page')
+        logging.info(f"Первая страница построена за {startup_phases['first_page'] * 1000:.0f} мс")
+    if valve_cache.is_stale():
+        valve_cache.request_refresh()
 
-ui.run()
+# Автоперезагрузка при изменении файлов нужна только при разработке: она запускает
+# отдельный процесс-наблюдатель и импортирует приложение дважды
+ui.run(reload=config.get('reload', False))
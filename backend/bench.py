@@ -0,0 +1,233 @@
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+from coalescer import CommandCoalescer
+from esp_sim import EspSimulator, PINS
+from fleet import Fleet
+from timeline import Dispatcher, compile_timeline, days_mapping
+
+# Бенчмарк бэкенда на локальных симуляторах ESP (esp_sim.py).
+# Результаты можно сохранить в JSON (--json) и сравнить с прошлым запуском (--compare),
+# чтобы регрессии были видны до выката на реальные платы.
+
+DAY_NAMES = {number: name for name, number in days_mapping.items()}
+
+
+def percentiles(values, prefix):
+    values = sorted(values)
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {f'{prefix}_p50': value, f'{prefix}_p90': value, f'{prefix}_p99': value, f'{prefix}_max': value}
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return {
+        f'{prefix}_p50': cuts[49],
+        f'{prefix}_p90': cuts[89],
+        f'{prefix}_p99': cuts[98],
+        f'{prefix}_max': values[-1],
+    }
+
+
+async def start_fleet(args):
+    simulators = []
+    devices = {}
+    mapping = {}
+    for index in range(args.devices):
+        simulator = await EspSimulator(
+            latency=args.latency, jitter=args.jitter, loss=args.loss, max_connections=args.max_connections,
+            keep_alive=not args.close_after_reply, protocol=args.protocol, seed=index,
+        ).start()
+        simulators.append(simulator)
+        name = f'esp{index}'
+        devices[name] = {'ip': '127.0.0.1', 'port': simulator.port}
+        for pin in PINS:
+            mapping[len(mapping) + 1] = (name, pin)
+    return simulators, Fleet(devices, mapping)
+
+
+async def bench_command_latency(fleet, args):
+    # Последовательные команды на один клапан - задержка одной команды
+    latencies = []
+    failures = 0
+    for i in range(args.requests):
+        started = time.perf_counter()
+        failed = await fleet.send('on' if i % 2 == 0 else 'off', [1])
+        latencies.append((time.perf_counter() - started) * 1000)
+        failures += bool(failed)
+    return {**percentiles(latencies, 'command_latency_ms'), 'command_failures': failures}
+
+
+async def bench_status_throughput(fleet, args):
+    # Сколько полных опросов всех устройств в секунду выдерживает бэкенд
+    polls = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < args.duration:
+        await fleet.status()
+        polls += 1
+    return {'status_polls_per_s': polls / (time.perf_counter() - started)}
+
+
+async def bench_concurrent_commands(fleet, args):
+    # Одновременные команды на одно устройство: по протоколу 2 они идут конвейером
+    # по одному соединению, по протоколу 1 - строго друг за другом
+    device_valves = [valve for valve, (device_name, _) in fleet.mapping.items() if device_name == 'esp0']
+    # С объединением команд в окне (coalescer.py) они превращаются в один кадр
+    coalescer = CommandCoalescer(fleet.set, window=0)
+    results = {}
+    for name, send in (('concurrent_commands_ms', fleet.send), ('coalesced_commands_ms', coalescer.submit)):
+        timings = []
+        for i in range(5):
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                send('on' if i % 2 == 0 else 'off', [device_valves[n % len(device_valves)]])
+                for n in range(args.concurrency)
+            ))
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = statistics.median(timings)
+    return results
+
+
+async def bench_close_all(fleet, args):
+    valves = list(fleet.mapping.keys())
+    timings = []
+    for _ in range(5):
+        started = time.perf_counter()
+        await fleet.send('off', valves)
+        timings.append((time.perf_counter() - started) * 1000)
+    return {'close_all_valves': len(valves), 'close_all_ms': statistics.median(timings)}
+
+
+def build_schedule(fleet, now, args):
+    # Большое расписание: записи, равномерно разбросанные по неделе, и несколько
+    # записей, которые сработают в ближайшие секунды и по которым меряется задержка
+    valves = list(fleet.mapping.keys())
+    schedule = []
+    for i in range(args.schedule_size):
+        second = (i * 7919) % (7 * 24 * 3600)
+        schedule.append({
+            'day': DAY_NAMES[second // 86400],
+            'time': f'{second % 86400 // 3600:02d}:{second % 3600 // 60:02d}',
+            'duration': 1 + i % 30,
+            'valves': [valves[i % len(valves)]],
+        })
+    fire_times = []
+    for i in range(args.fire_events):
+        when = now + timedelta(seconds=2 + i)
+        fire_times.append(when.replace(microsecond=0))
+        schedule.append({
+            'day': DAY_NAMES[when.weekday()],
+            'time': when.strftime('%H:%M:%S'),
+            'duration': 1 / 60,
+            'valves': valves[i % len(valves)::args.fire_events][:8],
+        })
+    return schedule, fire_times
+
+
+async def bench_scheduler(fleet, args):
+    now = datetime.now()
+    schedule, fire_times = build_schedule(fleet, now, args)
+
+    started = time.perf_counter()
+    timeline = compile_timeline(schedule)
+    compile_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    for i in range(1000):
+        timeline.next_event(now + timedelta(seconds=i * 601))
+    # 1000 поисков: миллисекунды на все = микросекунды на один
+    lookup_us = (time.perf_counter() - started) * 1000
+
+    lags = []
+    fired = asyncio.Event()
+    deadline = fire_times[-1] + timedelta(seconds=2)
+
+    async def execute(when, on, off):
+        if when <= deadline:
+            lags.append((datetime.now() - when).total_seconds() * 1000)
+        await fleet.set(on, off)
+        if datetime.now() >= deadline:
+            fired.set()
+
+    scheduler = AsyncIOScheduler()
+    scheduler.start()
+    dispatcher = Dispatcher(timeline, execute, now=now)
+    dispatcher.attach(scheduler)
+    try:
+        await asyncio.wait_for(fired.wait(), (deadline - datetime.now()).total_seconds() + 5)
+    except asyncio.TimeoutError:
+        pass
+    scheduler.shutdown(wait=False)
+    return {
+        'schedule_entries': len(schedule),
+        'timeline_events': len(timeline.events),
+        'timeline_compile_ms': compile_ms,
+        'next_event_lookup_us': lookup_us,
+        **percentiles(lags, 'fire_lag_ms'),
+    }
+
+
+async def run(args):
+    simulators, fleet = await start_fleet(args)
+    results = {}
+    try:
+        results.update(await bench_command_latency(fleet, args))
+        results.update(await bench_status_throughput(fleet, args))
+        results.update(await bench_concurrent_commands(fleet, args))
+        results.update(await bench_close_all(fleet, args))
+        results.update(await bench_scheduler(fleet, args))
+    finally:
+        await fleet.close()
+        for simulator in simulators:
+            await simulator.stop()
+    return results
+
+
+def print_results(results, baseline=None):
+    for name, value in results.items():
+        line = f'{name:28} {value:12.3f}'
+        if baseline and isinstance(baseline.get(name), (int, float)) and baseline[name]:
+            change = (value - baseline[name]) / baseline[name] * 100
+            line += f'   {baseline[name]:12.3f}  {change:+7.1f}%'
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк бэкенда полива на симуляторах ESP')
+    parser.add_argument('--devices', type=int, default=10, help='число симулируемых плат')
+    parser.add_argument('--latency', type=float, default=0.005, help='задержка ответа платы, секунды')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--max-connections', type=int, default=4)
+    parser.add_argument('--close-after-reply', action='store_true', help='симуляторы ведут себя как старая прошивка')
+    parser.add_argument('--protocol', type=int, default=2, help='старшая версия протокола симуляторов')
+    parser.add_argument('--requests', type=int, default=200, help='команд в тесте задержки')
+    parser.add_argument('--concurrency', type=int, default=16, help='одновременных команд на одно устройство')
+    parser.add_argument('--duration', type=float, default=3.0, help='длительность теста опроса, секунды')
+    parser.add_argument('--schedule-size', type=int, default=2000, help='записей в расписании')
+    parser.add_argument('--fire-events', type=int, default=5, help='событий для замера задержки срабатывания')
+    parser.add_argument('--json', help='сохранить результаты в файл')
+    parser.add_argument('--compare', help='сравнить с результатами из файла')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    results = asyncio.run(run(args))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+    print_results(results, baseline)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'params': vars(args), 'results': results}, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
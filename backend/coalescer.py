@@ -0,0 +1,69 @@
+import asyncio
+import logging
+
+from metrics import Counter, Histogram
+
+# Окно, в течение которого команды собираются в одну отправку (секунды)
+COMMAND_WINDOW = 0.05
+
+BATCH_SIZE = Histogram(
+    'watering_command_batch_size', 'Команд, объединенных в одну отправку', buckets=(1, 2, 3, 5, 10, 20, 50)
+)
+OVERRIDDEN = Counter('watering_commands_overridden_total', 'Включения, отмененные выключением в том же окне')
+
+
+class CommandCoalescer:
+    # Собирает команды, пришедшие в течение window секунд, и отправляет их одной
+    # пачкой: send(on, off) превращает ее в один кадр на устройство. Если в одном
+    # окне клапан и включают, и выключают, побеждает выключение - для полива это
+    # безопасно и не зависит от порядка, в котором пришли команды.
+
+    def __init__(self, send, window=COMMAND_WINDOW):
+        self.send = send
+        self.window = window
+        self._on = set()
+        self._off = set()
+        self._waiters = []
+        self._task = None
+
+    async def submit(self, action, valves):
+        # Возвращает (не выполнено, отменено): клапаны из valves, для которых команда
+        # не дошла до устройства, и включения, отмененные выключением в том же окне
+        future = asyncio.get_running_loop().create_future()
+        (self._on if action == 'on' else self._off).update(valves)
+        self._waiters.append((action, list(valves), future))
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def stop(self):
+        # Дожидается отправки команд, собранных в текущем окне
+        if self._task is not None:
+            await self._task
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        # Команды, пришедшие во время отправки, собираются уже в следующее окно
+        on, off, waiters = self._on, self._off, self._waiters
+        self._on, self._off, self._waiters, self._task = set(), set(), [], None
+
+        overridden = on & off
+        if overridden:
+            OVERRIDDEN.inc(len(overridden))
+            logging.warning(f"Включение клапанов {sorted(overridden)} отменено выключением в том же окне")
+        BATCH_SIZE.observe(len(waiters))
+        try:
+            failed = set(await self.send(sorted(on - off), sorted(off)))
+        except Exception as e:
+            for _, _, future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for action, valves, future in waiters:
+            if future.done():
+                continue
+            canceled = overridden if action == 'on' else set()
+            future.set_result((
+                [valve for valve in valves if valve in failed and valve not in canceled],
+                [valve for valve in valves if valve in canceled],
+            ))
@@ -0,0 +1,305 @@
+import asyncio
+import itertools
+import logging
+import time
+
+# Таймауты по умолчанию (в секундах)
+CONNECT_TIMEOUT = 3.0
+READ_TIMEOUT = 3.0
+
+# Версия протокола, которую предлагает клиент.
+# 1 - текстовые команды "on|off pin,pin" и "status" без идентификаторов, по одной за раз.
+# 2 - кадры "<id> <команда> [аргументы]" с ответами "<id> ok|err [данные]". Кадры можно
+#     отправлять, не дожидаясь ответа на предыдущие, а состояние пинов приходит битовой маской.
+# 3 - то же плюс расписание, которое плата выполняет сама (sched, clock, report).
+PROTOCOL_VERSION = 3
+# Как часто переспрашивать версию у устройства со старым протоколом (секунды):
+# прошивку могут обновить, пока бэкенд работает
+RENEGOTIATE_INTERVAL = 60.0
+
+
+class DeviceError(Exception):
+    pass
+
+
+def pins_to_mask(pins):
+    mask = 0
+    for pin in pins:
+        mask |= 1 << pin
+    return mask
+
+
+def parse_status(response):
+    # Ответ протокола 1: "12=0;13=0;14=0;16=0;" -> {12: False, 13: False, ...}
+    pins = {}
+    for entry in response.strip().split(';'):
+        if '=' in entry:
+            pin, value = entry.split('=', 1)
+            try:
+                pins[int(pin)] = bool(int(value))
+            except ValueError:
+                continue
+    return pins
+
+
+class DeviceClient:
+    # Асинхронный клиент контроллера ESP.
+    # Держит одно соединение и переиспользует его между командами. При подключении
+    # предлагает протокол 2 командой "hello 2"; старая прошивка отвечает на нее
+    # "Invalid action", и тогда клиент запоминает версию 1 и говорит с устройством
+    # текстовыми командами по одной за раз, раз в renegotiate_interval снова
+    # предлагая новый протокол. Если устройство закрыло
+    # соединение (самая старая прошивка закрывает его после каждого ответа), клиент
+    # сам переподключается и повторяет команду один раз - все команды идемпотентны.
+
+    def __init__(self, host, port, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 renegotiate_interval=RENEGOTIATE_INTERVAL):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.renegotiate_interval = renegotiate_interval
+        # Согласованная версия протокола, None - еще не известна
+        self.protocol = None
+        self._negotiated_at = None
+        self._reader = None
+        self._writer = None
+        self._pending = {}
+        self._reply_task = None
+        self._ids = itertools.count(1)
+        self._lock = asyncio.Lock()
+
+    def __repr__(self):
+        return f"DeviceClient({self.host}:{self.port})"
+
+    async def set_pins(self, on=(), off=()):
+        # Включает пины on и выключает пины off. Пин из обоих списков выключается.
+        on = [pin for pin in on if pin not in off]
+        if await self._negotiated() >= 2:
+            await self._call(f"set {pins_to_mask(on):x} {pins_to_mask(off):x}")
+            return
+        for action, pins in (('off', off), ('on', on)):
+            if not pins:
+                continue
+            response = await self._request_text(f"{action} {','.join(str(pin) for pin in pins)}")
+            if response != 'Done':
+                raise DeviceError(f"{self.host}:{self.port} ответил на {action}: {response}")
+
+    async def status(self):
+        # Возвращает пару битовых масок: включенные пины и пины, о которых сообщило устройство
+        if await self._negotiated() >= 2:
+            payload = await self._call('status')
+            try:
+                values, pins = (int(part, 16) for part in payload.split())
+            except ValueError:
+                raise DeviceError(f"{self.host}:{self.port} прислал некорректное состояние: {payload}")
+            return values, pins
+        pins = parse_status(await self._request_text('status'))
+        return pins_to_mask(pin for pin, value in pins.items() if value), pins_to_mask(pins)
+
+    async def protocol_version(self):
+        # Согласованная версия протокола; подключается к устройству, если она еще не известна
+        return await self._negotiated()
+
+    # Локальное расписание платы (протокол 3), см. offload.py
+
+    async def schedule_version(self):
+        # (версия расписания на плате, число элементов)
+        version, count = (await self._call('sched')).split()
+        return version, int(count)
+
+    async def update_schedule(self, base, version, add=(), remove=()):
+        # Изменения применяются, только если на плате сейчас версия base
+        changes = [f'+{token}' for token in add] + [f'-{token}' for token in remove]
+        await self._call(' '.join(['sched', base, version, *changes]))
+
+    async def clear_schedule(self, version):
+        await self._call(f'sched clear {version}')
+
+    async def set_clock(self, unix_time):
+        await self._call(f'clock {int(unix_time)}')
+
+    async def reports(self, after=0):
+        # (последний номер отчета, [(номер, время Unix, маска включенных, маска выключенных, источник)])
+        parts = (await self._call(f'report {after}')).split()
+        try:
+            entries = []
+            for entry in parts[1:]:
+                seq, timestamp, on_mask, off_mask, source = entry.split(',')
+                entries.append((int(seq), int(timestamp), int(on_mask, 16), int(off_mask, 16), source))
+            return int(parts[0]), entries
+        except (IndexError, ValueError):
+            raise DeviceError(f"{self.host}:{self.port} прислал некорректный отчет: {' '.join(parts)}")
+
+    async def close(self):
+        async with self._lock:
+            await self._close()
+
+    async def _negotiated(self):
+        if self.protocol is None or self._renegotiation_due():
+            async with self._lock:
+                if self._renegotiation_due():
+                    # Соединение со старой прошивкой могло остаться открытым
+                    await self._close()
+                await self._ensure_connected()
+        return self.protocol
+
+    def _renegotiation_due(self):
+        return self.protocol == 1 and time.monotonic() - self._negotiated_at >= self.renegotiate_interval
+
+    async def _call(self, command):
+        # Кадр протокола 2. Блокировка держится только на время записи, ответа
+        # ждем вне ее, поэтому несколько команд идут по соединению одновременно.
+        for attempt in range(2):
+            async with self._lock:
+                fresh = await self._ensure_connected()
+                if self.protocol < 2:
+                    raise DeviceError(f"{self.host}:{self.port} сменил протокол на версию {self.protocol}")
+                writer = self._writer
+                request_id = str(next(self._ids))
+                future = asyncio.get_running_loop().create_future()
+                self._pending[request_id] = future
+                try:
+                    writer.write(f"{request_id} {command}\n".encode())
+                    await asyncio.wait_for(writer.drain(), self.read_timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    await self._close()
+                    if fresh or attempt:
+                        raise DeviceError(f"{self.host}:{self.port} не отвечает: {e!r}") from e
+                    continue
+            try:
+                reply = await asyncio.wait_for(future, self.read_timeout)
+            except asyncio.TimeoutError as e:
+                # Соединение, скорее всего, оборвано: закрываем его вместе с остальными ожидающими командами
+                async with self._lock:
+                    if self._writer is writer:
+                        await self._close()
+                raise DeviceError(f"{self.host}:{self.port} не ответил на {command}") from e
+            except DeviceError:
+                if fresh or attempt:
+                    raise
+                continue
+            result, _, payload = reply.partition(' ')
+            if result != 'ok':
+                raise DeviceError(f"{self.host}:{self.port} ответил на {command}: {payload or result}")
+            return payload
+
+    async def _request_text(self, data):
+        # Команда протокола 1. По соединению идет только один запрос за раз.
+        async with self._lock:
+            for attempt in range(2):
+                fresh = await self._ensure_connected()
+                if self.protocol >= 2:
+                    raise DeviceError(f"{self.host}:{self.port} сменил протокол на версию {self.protocol}")
+                try:
+                    response = await self._exchange(data)
+                except (OSError, asyncio.TimeoutError) as e:
+                    await self._close()
+                    if fresh or attempt:
+                        raise DeviceError(f"{self.host}:{self.port} не отвечает: {e!r}") from e
+                    continue
+                if not response:
+                    # Устройство закрыло соединение, не ответив
+                    await self._close()
+                    if fresh or attempt:
+                        raise DeviceError(f"{self.host}:{self.port} закрыл соединение без ответа")
+                    continue
+                if self._reader.at_eof():
+                    await self._close()
+                return response
+
+    async def _ensure_connected(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return False
+        await self._close()
+        await self._connect()
+        # Режим кадров включается отдельно на каждом соединении. Старую прошивку,
+        # которая закрывает соединение после каждого ответа, переспрашиваем реже.
+        if self.protocol != 1 or self._renegotiation_due():
+            await self._negotiate()
+            if self._writer is None:
+                await self._connect()
+        if self.protocol >= 2:
+            self._pending = {}
+            self._reply_task = asyncio.create_task(self._read_replies(self._reader, self._writer, self._pending))
+        return True
+
+    async def _connect(self):
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.connect_timeout
+            )
+        except (OSError, asyncio.TimeoutError) as e:
+            raise DeviceError(f"Не удалось подключиться к {self.host}:{self.port}: {e!r}") from e
+        logging.debug(f"Подключено к {self.host}:{self.port}")
+
+    async def _negotiate(self):
+        try:
+            response = await self._exchange(f"hello {PROTOCOL_VERSION}", line=True)
+        except (OSError, asyncio.TimeoutError) as e:
+            await self._close()
+            raise DeviceError(f"{self.host}:{self.port} не отвечает: {e!r}") from e
+        if not response:
+            await self._close()
+            raise DeviceError(f"{self.host}:{self.port} закрыл соединение без ответа")
+        parts = response.split()
+        if len(parts) == 2 and parts[0] == 'hello' and parts[1].isdigit():
+            protocol = min(int(parts[1]), PROTOCOL_VERSION)
+        else:
+            # Старая прошивка не знает команды hello
+            protocol = 1
+        self._negotiated_at = time.monotonic()
+        if protocol != self.protocol:
+            logging.info(f"{self.host}:{self.port} использует протокол версии {protocol}")
+            self.protocol = protocol
+        if self._reader.at_eof():
+            await self._close()
+
+    async def _exchange(self, data, line=False):
+        self._writer.write((data + "\n").encode())
+        await asyncio.wait_for(self._writer.drain(), self.read_timeout)
+        if line:
+            response = await asyncio.wait_for(self._reader.readline(), self.read_timeout)
+        else:
+            response = await asyncio.wait_for(self._reader.read(1024), self.read_timeout)
+        return response.decode().strip()
+
+    async def _read_replies(self, reader, writer, pending):
+        # Разбирает ответы одного соединения и передает их ожидающим командам по id
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request_id, _, reply = line.decode().strip().partition(' ')
+                future = pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(reply)
+        except (OSError, ValueError) as e:
+            logging.debug(f"Ошибка чтения ответов {self.host}:{self.port}: {e!r}")
+        finally:
+            writer.close()
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(DeviceError(f"{self.host}:{self.port} закрыл соединение"))
+            pending.clear()
+
+    async def _close(self):
+        writer = self._writer
+        task = self._reply_task
+        self._reader = None
+        self._writer = None
+        self._reply_task = None
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if writer is None:
+            return
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
@@ -0,0 +1,363 @@
+import argparse
+import asyncio
+import logging
+import random
+import time
+from datetime import datetime, timezone
+
+# Пины реле на плате, как в esp/boot.py
+PINS = (12, 13, 14, 16)
+# Как в esp/boot.py: длина недели, предел включения пина, допуск часов, отчеты
+WEEK = 7 * 86400
+MAX_ON_DEFAULT = 3 * 3600
+CLOCK_TOLERANCE = 2
+REPORTS_KEPT = 50
+REPORTS_PER_REPLY = 8
+
+
+class EspSimulator:
+    # Локальная замена контроллера ESP для тестов и бенчмарков.
+    # Реализует протоколы esp/boot.py: текстовый "on|off pin,pin", "status", "uptime"
+    # и кадры протоколов 2 и 3 после "hello N", включая локальное расписание,
+    # которое выполняется по часам симулятора (clock - функция времени Unix,
+    # по умолчанию time.time). Как и прошивка, держит соединение
+    # открытым и отвечает на каждую строку. С protocol=1 не знает команды hello,
+    # с keep_alive=False ведет себя как самая старая прошивка: одна команда на
+    # соединение. Умеет добавлять задержку, терять запросы и ограничивать число
+    # одновременно обслуживаемых соединений.
+
+    def __init__(self, pins=PINS, latency=0.0, jitter=0.0, loss=0.0, max_connections=4,
+                 backlog=5, keep_alive=True, read_timeout=60.0, protocol=3, seed=None,
+                 clock=time.time, schedule_period=1.0):
+        self.pins = {pin: 0 for pin in pins}
+        self.pins_mask = sum(1 << pin for pin in pins)
+        # Прошивка, закрывающая соединение после ответа, знает только протокол 1
+        self.protocol = protocol if keep_alive else 1
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.backlog = backlog
+        self.keep_alive = keep_alive
+        self.read_timeout = read_timeout
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.dropped = 0
+        self.refused = 0
+        self.started = time.time()
+        self.server = None
+        self._slots = asyncio.Semaphore(max_connections)
+        self._waiting = 0
+        # Локальное расписание (протокол 3)
+        self.clock = clock
+        self.clock_offset = 0.0
+        self.schedule_period = schedule_period
+        self.schedule_version = "0"
+        self.schedule_tokens = set()
+        self.runs = []
+        self.canceled = set()
+        self.max_on = {}
+        self.tz_offset = 0
+        self.scheduled = 0
+        self.on_since = {}
+        self.reports = []
+        self.report_seq = 0
+        self._schedule_task = None
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        if self.protocol >= 3:
+            self._schedule_task = asyncio.create_task(self._run_schedule())
+        return self
+
+    async def stop(self):
+        if self._schedule_task is not None:
+            self._schedule_task.cancel()
+            self._schedule_task = None
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def handle_request(self, request):
+        # Та же логика разбора, что и в handle_request прошивки
+        d = request.split()
+        if len(d) == 2:
+            action = d[0].strip()
+            if action not in ["on", "off"]:
+                return "Invalid action"
+            try:
+                pin_numbers = [int(pin_number) for pin_number in d[1].split(',')]
+            except ValueError:
+                return "Invalid request"
+            for pin_number in pin_numbers:
+                self._set_pin(pin_number, action == "on")
+            return "Done"
+        if len(d) == 1:
+            action = d[0].strip()
+            if action == "uptime":
+                return str(int(time.time() - self.started))
+            if action == "status":
+                return "".join(f"{pin}={value};" for pin, value in sorted(self.pins.items()))
+        return "Invalid request"
+
+    def handle_frame(self, request):
+        # Та же логика разбора, что и в handle_frame прошивки
+        d = request.split()
+        request_id = d[0]
+        command = d[1] if len(d) > 1 else ""
+        if command == "set" and len(d) == 4:
+            try:
+                on_mask, off_mask = int(d[2], 16), int(d[3], 16)
+            except ValueError:
+                return f"{request_id} err mask"
+            if (on_mask | off_mask) & ~self.pins_mask:
+                return f"{request_id} err pin"
+            self.set_pins(on_mask, off_mask)
+            return f"{request_id} ok"
+        if command == "status" and len(d) == 2:
+            values = sum(1 << pin for pin, value in self.pins.items() if value)
+            return f"{request_id} ok {values:x} {self.pins_mask:x}"
+        if command == "uptime" and len(d) == 2:
+            return f"{request_id} ok {int(time.time() - self.started)}"
+        if self.protocol >= 3 and command == "sched":
+            return self.handle_schedule(request_id, d)
+        if self.protocol >= 3 and command == "clock" and len(d) == 3:
+            try:
+                unix_time = int(d[2])
+            except ValueError:
+                return f"{request_id} err clock"
+            if abs(unix_time - self.now()) > CLOCK_TOLERANCE:
+                self.clock_offset = unix_time - self.clock()
+            return f"{request_id} ok"
+        if self.protocol >= 3 and command == "report":
+            try:
+                after = int(d[2]) if len(d) > 2 else 0
+            except ValueError:
+                return f"{request_id} err request"
+            entries = [entry for entry in self.reports if entry[0] > after][:REPORTS_PER_REPLY]
+            return f"{request_id} ok {self.report_seq} " + " ".join(
+                f"{seq},{int(when)},{on:x},{off:x},{source}" for seq, when, on, off, source in entries
+            )
+        return f"{request_id} err request"
+
+    # Локальное расписание - та же логика, что в esp/boot.py
+
+    def now(self):
+        return self.clock() + self.clock_offset
+
+    def set_pins(self, on_mask, off_mask):
+        for pin in self.pins:
+            if on_mask >> pin & 1:
+                self._set_pin(pin, True)
+        for pin in self.pins:
+            if off_mask >> pin & 1:
+                self._set_pin(pin, False)
+
+    def handle_schedule(self, request_id, d):
+        if len(d) == 2:
+            return f"{request_id} ok {self.schedule_version} {len(self.schedule_tokens)}"
+        if d[2] == "clear" and len(d) == 4:
+            tokens = set()
+        elif len(d) >= 4:
+            if d[2] != self.schedule_version:
+                return f"{request_id} err version"
+            tokens = set(self.schedule_tokens)
+            for change in d[4:]:
+                if change[0] == "+":
+                    tokens.add(change[1:])
+                elif change[0] == "-":
+                    tokens.discard(change[1:])
+        else:
+            return f"{request_id} err request"
+        if "." not in d[3]:
+            try:
+                self.apply_schedule(tokens)
+            except (ValueError, IndexError):
+                return f"{request_id} err schedule"
+        self.schedule_tokens = tokens
+        self.schedule_version = d[3]
+        return f"{request_id} ok"
+
+    def apply_schedule(self, tokens):
+        runs, canceled, max_on, tz_offset = [], set(), {}, 0
+        for token in tokens:
+            kind, value = token[0], token[1:]
+            if kind == "r":
+                start, length, mask = (int(part, 16) for part in value.split(","))
+                runs.append((start, length, mask & self.pins_mask))
+            elif kind == "x":
+                canceled.add(int(value))
+            elif kind == "m":
+                pin, seconds = (int(part, 16) for part in value.split(","))
+                max_on[pin] = seconds
+            elif kind == "z":
+                tz_offset = int(value)
+        self.runs, self.canceled, self.max_on, self.tz_offset = runs, canceled, max_on, tz_offset
+
+    def scheduled_mask(self):
+        local = self.now() + self.tz_offset
+        t = datetime.fromtimestamp(local, timezone.utc)
+        position = t.weekday() * 86400 + t.hour * 3600 + t.minute * 60 + t.second
+        mask = 0
+        for start, length, run_mask in self.runs:
+            elapsed = (position - start) % WEEK
+            if elapsed >= length:
+                continue
+            started = datetime.fromtimestamp(local - elapsed, timezone.utc)
+            if started.year * 10000 + started.month * 100 + started.day in self.canceled:
+                continue
+            mask |= run_mask
+        return mask
+
+    def tick(self):
+        # Один шаг цикла расписания и проверки предела включения
+        now = self.now()
+        expired = 0
+        for pin, since in self.on_since.items():
+            if now - since > self.max_on.get(pin, MAX_ON_DEFAULT):
+                expired |= 1 << pin
+        if expired:
+            self.set_pins(0, expired)
+            self._report(0, expired, "f")
+        mask = self.scheduled_mask()
+        on_mask, off_mask = mask & ~self.scheduled, self.scheduled & ~mask
+        if on_mask or off_mask:
+            self.set_pins(on_mask, off_mask)
+            self._report(on_mask, off_mask, "s")
+        self.scheduled = mask
+
+    async def _run_schedule(self):
+        while True:
+            if self.runs or self.on_since:
+                self.tick()
+            await asyncio.sleep(self.schedule_period)
+
+    def _set_pin(self, pin, value):
+        self.pins[pin] = 1 if value else 0
+        if value:
+            self.on_since.setdefault(pin, self.now())
+        else:
+            self.on_since.pop(pin, None)
+
+    def _report(self, on_mask, off_mask, source):
+        self.report_seq += 1
+        self.reports.append((self.report_seq, self.now(), on_mask, off_mask, source))
+        del self.reports[:-REPORTS_KEPT]
+
+    def handle_line(self, request, version):
+        # Возвращает ответ и версию протокола соединения после этой строки
+        if self.protocol >= 2 and request.startswith("hello "):
+            try:
+                version = min(int(request[6:]), self.protocol)
+            except ValueError:
+                version = 1
+            return f"hello {self.protocol}", version
+        if version >= 2:
+            return self.handle_frame(request), version
+        return self.handle_request(request), version
+
+    async def _handle(self, reader, writer):
+        # Очередь на обслуживание переполнена - соединение сбрасывается, как при
+        # переполнении listen(backlog) на плате
+        if self._waiting >= self.backlog:
+            self.refused += 1
+            writer.close()
+            return
+        self._waiting += 1
+        try:
+            async with self._slots:
+                self._waiting -= 1
+                await self._serve(reader, writer)
+        finally:
+            writer.close()
+
+    async def _serve(self, reader, writer):
+        replies = set()
+        try:
+            await self._serve_lines(reader, writer, replies)
+        finally:
+            for task in replies:
+                task.cancel()
+
+    async def _reply_later(self, writer, response, delay):
+        await asyncio.sleep(delay)
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            writer.close()
+            return
+        writer.write(response.encode() + b"\n")
+        try:
+            await writer.drain()
+        except ConnectionError:
+            writer.close()
+
+    async def _serve_lines(self, reader, writer, replies):
+        version = 1
+        while True:
+            try:
+                if self.keep_alive:
+                    data = await asyncio.wait_for(reader.readline(), self.read_timeout)
+                else:
+                    data = await asyncio.wait_for(reader.read(1024), self.read_timeout)
+            except (ConnectionError, ValueError, asyncio.TimeoutError):
+                return
+            if not data:
+                return
+            request = data.decode().strip()
+            if self.keep_alive and not request:
+                continue
+            self.requests += 1
+            delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+            if version >= 2 and delay:
+                # Кадры протокола 2 идут конвейером: задержка сети у них перекрывается,
+                # следующий кадр читается, пока ответ на предыдущий еще в пути
+                response, version = self.handle_line(request, version)
+                replies.add(asyncio.create_task(self._reply_later(writer, response, delay)))
+                replies.difference_update([task for task in replies if task.done()])
+                continue
+            if delay:
+                await asyncio.sleep(delay)
+            if self.loss and self.random.random() < self.loss:
+                # Потеря запроса: соединение закрывается без ответа
+                self.dropped += 1
+                return
+            response, version = self.handle_line(request, version)
+            writer.write(response.encode() + (b"\n" if self.keep_alive else b""))
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+            if not self.keep_alive:
+                return
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Симулятор контроллера полива ESP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа, секунды')
+    parser.add_argument('--jitter', type=float, default=0.0, help='случайная добавка к задержке, секунды')
+    parser.add_argument('--loss', type=float, default=0.0, help='доля запросов, оставленных без ответа')
+    parser.add_argument('--max-connections', type=int, default=4, help='одновременно обслуживаемых соединений')
+    parser.add_argument('--backlog', type=int, default=5)
+    parser.add_argument('--close-after-reply', action='store_true', help='как старая прошивка: одна команда на соединение')
+    parser.add_argument('--protocol', type=int, default=3, help='старшая версия протокола, 1 - как старая прошивка')
+    args = parser.parse_args()
+
+    simulator = EspSimulator(
+        latency=args.latency, jitter=args.jitter, loss=args.loss, max_connections=args.max_connections,
+        backlog=args.backlog, keep_alive=not args.close_after_reply, protocol=args.protocol,
+    )
+    await simulator.start(args.host, args.port)
+    logging.info(f"Симулятор ESP слушает {args.host}:{simulator.port}")
+    async with simulator.server:
+        await simulator.server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import time
+
+from device import DeviceClient, DeviceError
+from metrics import Counter, Histogram
+
+DEFAULT_DEVICE = 'main'
+
+COMMAND_DURATION = Histogram(
+    'watering_command_duration_seconds', 'Время выполнения команды на устройстве', ['device', 'action']
+)
+COMMANDS = Counter('watering_commands_total', 'Команды на устройства по результату', ['device', 'action', 'result'])
+
+
+def load_devices(config):
+    # Реестр контроллеров: имя -> {"ip": ..., "port": ..., "capacity": ...}
+    # Старый формат с одним устройством (device_ip/device_port) превращается в
+    # реестр из одного устройства DEFAULT_DEVICE. capacity - пропускная способность
+    # линии устройства (0 - без ограничения)
+    devices = config.get('devices')
+    if not devices:
+        devices = {DEFAULT_DEVICE: {'ip': config.get('device_ip'), 'port': config.get('device_port')}}
+    return {
+        name: {'ip': d['ip'], 'port': int(d['port']), 'capacity': float(d.get('capacity', 0))}
+        for name, d in devices.items()
+    }
+
+
+def load_valve_mapping(config, default_device):
+    # Клапан -> (устройство, пин). Старый формат {"1": 16} привязывает пин
+    # к устройству по умолчанию
+    mapping = {}
+    for valve, target in config.get('valve_mapping', {}).items():
+        if isinstance(target, dict):
+            mapping[int(valve)] = (target.get('device', default_device), int(target['pin']))
+        else:
+            mapping[int(valve)] = (default_device, int(target))
+    return mapping
+
+
+class Fleet:
+    # Набор контроллеров и привязка клапанов к их пинам.
+    # Команды и опрос состояния рассылаются на все затронутые устройства
+    # одновременно, поэтому время выполнения не зависит от числа плат.
+
+    def __init__(self, devices, mapping):
+        self.devices = {name: DeviceClient(d['ip'], d['port']) for name, d in devices.items()}
+        self.mapping = mapping
+        # Устройство -> маска пинов, о которых оно сообщило при опросе состояния
+        self.pins = {}
+
+    @property
+    def default_device(self):
+        return next(iter(self.devices))
+
+    def resolve(self, valve):
+        return self.mapping.get(valve, (self.default_device, valve))
+
+    async def send(self, action, valves):
+        # Возвращает список клапанов, команду для которых доставить не удалось
+        if action == 'on':
+            return await self.set(on=valves)
+        return await self.set(off=valves)
+
+    async def set(self, on=(), off=()):
+        # Включает клапаны on и выключает клапаны off одной командой на устройство.
+        # Возвращает список клапанов, команду для которых доставить не удалось.
+        groups = {}
+        for index, valves in enumerate((on, off)):
+            for valve in valves:
+                device_name, pin = self.resolve(valve)
+                groups.setdefault(device_name, ([], []))[index].append((valve, pin))
+        results = await asyncio.gather(*(
+            self._set_on_device(device_name, on_targets, off_targets)
+            for device_name, (on_targets, off_targets) in groups.items()
+        ))
+        return [valve for failed in results for valve in failed]
+
+    async def status(self):
+        # Опрашивает все устройства, к которым привязаны клапаны, и собирает
+        # общий словарь клапан -> включен. Клапаны недоступных устройств в
+        # результат не попадают.
+        valves_by_device = {}
+        for valve, (device_name, pin) in self.mapping.items():
+            valves_by_device.setdefault(device_name, []).append((valve, pin))
+        device_names = sorted(valves_by_device)
+        responses = await asyncio.gather(*(
+            self._request(name, 'status', lambda device: device.status()) for name in device_names
+        ))
+        valve_status = {}
+        for device_name, response in zip(device_names, responses):
+            if response is None:
+                continue
+            values, pins = response
+            self.pins[device_name] = pins
+            for valve, pin in valves_by_device[device_name]:
+                if pins >> pin & 1:
+                    valve_status[valve] = bool(values >> pin & 1)
+        return valve_status
+
+    async def close(self):
+        await asyncio.gather(*(device.close() for device in self.devices.values()))
+
+    async def known_pins(self, device_name):
+        # Маска пинов устройства; при первом обращении спрашиваем ее у устройства
+        if device_name not in self.pins:
+            response = await self._request(device_name, 'status', lambda device: device.status())
+            if response is not None:
+                self.pins[device_name] = response[1]
+        return self.pins.get(device_name)
+
+    async def _set_on_device(self, device_name, on_targets, off_targets):
+        # Пины, которых нет на устройстве, не отправляем: плата отклонила бы весь
+        # кадр вместе с остальными клапанами
+        pins = await self.known_pins(device_name)
+        if pins is None:
+            # Устройство не ответило даже на опрос состояния
+            return [valve for valve, _ in on_targets + off_targets]
+        unknown = [valve for valve, pin in on_targets + off_targets if not pins >> pin & 1]
+        on_targets = [(valve, pin) for valve, pin in on_targets if pins >> pin & 1]
+        off_targets = [(valve, pin) for valve, pin in off_targets if pins >> pin & 1]
+        if unknown:
+            logging.error(f"Клапаны {unknown} привязаны к пинам, которых нет на {device_name}")
+            if not on_targets and not off_targets:
+                return unknown
+        on_pins = [pin for _, pin in on_targets]
+        off_pins = [pin for _, pin in off_targets]
+        action = 'set' if on_pins and off_pins else 'on' if on_pins else 'off'
+        response = await self._request(device_name, action, lambda device: device.set_pins(on_pins, off_pins))
+        if response is None:
+            return [valve for valve, _ in on_targets + off_targets] + unknown
+        described = ' '.join(
+            f"{name} {','.join(str(pin) for pin in pins)}" for name, pins in (('on', on_pins), ('off', off_pins)) if pins
+        )
+        logging.info(f"Команда отправлена на {device_name}: {described}")
+        return unknown
+
+    async def _request(self, device_name, action, call):
+        # Возвращает результат call(device) или None, если устройство недоступно
+        device = self.devices.get(device_name)
+        if device is None:
+            logging.error(f"Неизвестное устройство: {device_name}")
+            return None
+        started = time.perf_counter()
+        try:
+            response = await call(device)
+            if response is None:
+                response = True
+        except DeviceError as e:
+            logging.error(f"Ошибка при отправке команды на {device_name}: {e}")
+            response = None
+        COMMAND_DURATION.observe(time.perf_counter() - started, device=device_name, action=action)
+        COMMANDS.inc(device=device_name, action=action, result='ok' if response is not None else 'error')
+        return response
@@ -0,0 +1,67 @@
+import asyncio
+
+from nicegui import background_tasks, ui
+
+ROWS_PER_PAGE = 20
+
+
+class PagedTable:
+    # Таблица с сортировкой и постраничной выдачей на сервере.
+    # На клиент уходит только текущая страница: fetch(offset, limit, sort_by, descending)
+    # возвращает (строки страницы, всего строк). После изменения данных refresh()
+    # перечитывает текущую страницу и отправляет ее клиенту, только если на ней
+    # что-то поменялось, - правка строки на другой странице не пересылает таблицу.
+    # fetch может быть корутиной (например, чтение из базы в отдельном потоке):
+    # тогда страница подгружается в фоне, а устаревшие ответы отбрасываются.
+
+    def __init__(self, columns, fetch, row_key='id', rows_per_page=ROWS_PER_PAGE, sort_by=None, descending=False):
+        self.fetch = fetch
+        self._requests = 0
+        self.table = ui.table(columns=columns, rows=[], row_key=row_key, pagination={
+            'page': 1, 'rowsPerPage': rows_per_page, 'sortBy': sort_by, 'descending': descending, 'rowsNumber': 0,
+        }).classes('w-full')
+        self.table.props(':rows-per-page-options="[10, 20, 30, 50, 100]" binary-state-sort')
+        self.table.on('request', self._on_request, ['pagination'])
+        self.refresh()
+
+    def refresh(self, force=False):
+        if asyncio.iscoroutinefunction(self.fetch):
+            background_tasks.create(self._load(force), name='paged table refresh')
+            return
+        pagination = dict(self.table.pagination)
+        rows_per_page = pagination['rowsPerPage'] or ROWS_PER_PAGE
+        offset = (pagination['page'] - 1) * rows_per_page
+        rows, total = self.fetch(offset, rows_per_page, pagination.get('sortBy'), pagination.get('descending', False))
+        if not rows and offset and total:
+            # Страница опустела после удаления - показываем последнюю непустую
+            pagination['page'] = (total - 1) // rows_per_page + 1
+            offset = (pagination['page'] - 1) * rows_per_page
+            rows, total = self.fetch(offset, rows_per_page, pagination.get('sortBy'), pagination.get('descending', False))
+        self._apply(pagination, rows, total, force)
+
+    async def _load(self, force):
+        self._requests += 1
+        request = self._requests
+        pagination = dict(self.table.pagination)
+        rows_per_page = pagination['rowsPerPage'] or ROWS_PER_PAGE
+        offset = (pagination['page'] - 1) * rows_per_page
+        rows, total = await self.fetch(offset, rows_per_page, pagination.get('sortBy'), pagination.get('descending', False))
+        if not rows and offset and total:
+            pagination['page'] = (total - 1) // rows_per_page + 1
+            offset = (pagination['page'] - 1) * rows_per_page
+            rows, total = await self.fetch(offset, rows_per_page, pagination.get('sortBy'), pagination.get('descending', False))
+        if request == self._requests:
+            self._apply(pagination, rows, total, force)
+
+    def _apply(self, pagination, rows, total, force):
+        pagination['rowsNumber'] = total
+        if not force and rows == self.table.rows and pagination == self.table.pagination:
+            return
+        self.table.pagination = pagination
+        self.table.rows = rows
+
+    def _on_request(self, e):
+        pagination = dict(self.table.pagination)
+        pagination.update(e.args['pagination'])
+        self.table.pagination = pagination
+        self.refresh(force=True)
@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import struct
+
+# Минимальный клиент MQTT 3.1.1 на asyncio без внешних зависимостей: QoS 0,
+# retained-сообщения, завещание (LWT) и keepalive. Этого хватает для Home Assistant.
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+KEEPALIVE = 60
+CONNECT_TIMEOUT = 5.0
+
+
+class MqttError(Exception):
+    pass
+
+
+def encode_length(length):
+    data = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        data.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(data)
+
+
+def encode_string(value):
+    data = value.encode() if isinstance(value, str) else value
+    return struct.pack('!H', len(data)) + data
+
+
+def decode_string(body, offset):
+    (length,) = struct.unpack_from('!H', body, offset)
+    return body[offset + 2:offset + 2 + length], offset + 2 + length
+
+
+def packet(kind, body=b'', flags=0):
+    return bytes([kind << 4 | flags]) + encode_length(len(body)) + body
+
+
+def publish_packet(topic, payload, retain=False):
+    payload = payload.encode() if isinstance(payload, str) else payload
+    return packet(PUBLISH, encode_string(topic) + payload, flags=int(retain))
+
+
+def parse_publish(flags, body):
+    # (топик, данные, retain, qos, id пакета)
+    topic, offset = decode_string(body, 0)
+    qos = flags >> 1 & 3
+    packet_id = None
+    if qos:
+        (packet_id,) = struct.unpack_from('!H', body, offset)
+        offset += 2
+    return topic.decode(), body[offset:], bool(flags & 1), qos, packet_id
+
+
+async def read_packet(reader):
+    # (тип, флаги, тело) очередного пакета
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128 ** 3:
+            raise MqttError('Некорректная длина пакета')
+    body = await reader.readexactly(length) if length else b''
+    return header[0] >> 4, header[0] & 0x0f, body
+
+
+def topic_matches(pattern, topic):
+    # Фильтр подписки с + и #
+    pattern_parts = pattern.split('/')
+    topic_parts = topic.split('/')
+    for index, part in enumerate(pattern_parts):
+        if part == '#':
+            return True
+        if index >= len(topic_parts) or (part != '+' and part != topic_parts[index]):
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class MqttClient:
+    # Одно соединение с брокером. on_message(topic, payload) вызывается для
+    # входящих сообщений; при обрыве соединения closed завершается.
+
+    def __init__(self, host, port=1883, client_id='autowatering', username=None, password=None,
+                 keepalive=KEEPALIVE, will=None, on_message=None):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        # (топик, данные, retain) - публикуется брокером при обрыве соединения
+        self.will = will
+        self.on_message = on_message
+        self.closed = None
+        self._reader = None
+        self._writer = None
+        self._packet_id = 0
+        self._tasks = []
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), CONNECT_TIMEOUT
+        )
+        flags = 0x02  # чистая сессия
+        payload = encode_string(self.client_id)
+        if self.will is not None:
+            topic, message, retain = self.will
+            flags |= 0x04 | (0x20 if retain else 0)
+            payload += encode_string(topic) + encode_string(message)
+        if self.username is not None:
+            flags |= 0x80
+            payload += encode_string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += encode_string(self.password)
+        body = encode_string('MQTT') + bytes([4, flags]) + struct.pack('!H', self.keepalive) + payload
+        self._writer.write(packet(CONNECT, body))
+        try:
+            kind, _, reply = await asyncio.wait_for(read_packet(self._reader), CONNECT_TIMEOUT)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            await self.close()
+            raise MqttError(f'Брокер не ответил на подключение: {e!r}')
+        if kind != CONNACK or len(reply) < 2 or reply[1] != 0:
+            await self.close()
+            raise MqttError(f'Брокер отклонил подключение, код {reply[1] if len(reply) > 1 else None}')
+        self.closed = asyncio.get_running_loop().create_future()
+        self._tasks = [asyncio.create_task(self._read_loop()), asyncio.create_task(self._ping_loop())]
+
+    def publish_many(self, messages):
+        # messages: [(топик, данные, retain)] - уходят одной записью в сокет
+        self._writer.write(b''.join(publish_packet(*message) for message in messages))
+
+    async def publish(self, topic, payload, retain=False):
+        self.publish_many([(topic, payload, retain)])
+        await self._writer.drain()
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def subscribe(self, topics):
+        self._packet_id = self._packet_id % 0xffff + 1
+        body = struct.pack('!H', self._packet_id) + b''.join(encode_string(topic) + b'\x00' for topic in topics)
+        self._writer.write(packet(SUBSCRIBE, body, flags=0x02))
+        await self._writer.drain()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._writer is not None:
+            try:
+                self._writer.write(packet(DISCONNECT))
+                self._writer.close()
+            except Exception:
+                pass
+            self._writer = None
+        if self.closed is not None and not self.closed.done():
+            self.closed.set_result(None)
+
+    async def _read_loop(self):
+        try:
+            while True:
+                kind, flags, body = await read_packet(self._reader)
+                if kind == PUBLISH:
+                    topic, payload, _, qos, packet_id = parse_publish(flags, body)
+                    if qos == 1:
+                        self._writer.write(packet(PUBACK, struct.pack('!H', packet_id)))
+                    if self.on_message is not None:
+                        try:
+                            await self.on_message(topic, payload)
+                        except Exception as e:
+                            logging.error(f"Ошибка обработки сообщения MQTT {topic}: {e}")
+        except (asyncio.IncompleteReadError, ConnectionError, MqttError) as e:
+            logging.warning(f"Соединение с брокером MQTT {self.host}:{self.port} потеряно: {e!r}")
+        finally:
+            if not self.closed.done():
+                self.closed.set_result(None)
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive / 2)
+            try:
+                self._writer.write(packet(PINGREQ))
+                await self._writer.drain()
+            except ConnectionError:
+                return
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import logging
+
+from metrics import Counter
+from mqtt import MqttClient, MqttError
+
+# Пауза между попытками подключения к брокеру: от RETRY_BASE, удваивается до RETRY_MAX (секунды)
+RETRY_BASE = 1
+RETRY_MAX = 60
+
+MESSAGES = Counter('watering_mqtt_messages_total', 'Сообщения, опубликованные в MQTT', ['kind'])
+COMMANDS = Counter('watering_mqtt_commands_total', 'Команды, полученные через MQTT', ['result'])
+
+
+class MqttBridge:
+    # Мост в MQTT для Home Assistant и других внешних систем.
+    # Состояние клапанов публикуется retained-сообщениями из кэша состояния и
+    # только при изменении: внешние подписчики никогда не вызывают опрос устройств.
+    # При подключении статус доступности, конфигурация discovery и текущее
+    # состояние уходят одной пачкой. Команды из топиков .../set проходят тот же
+    # путь, что и переключатели на странице (send_command).
+
+    def __init__(self, settings, cache, names, send_command, retry_base=RETRY_BASE, retry_max=RETRY_MAX):
+        self.settings = settings
+        self.prefix = settings.get('prefix', 'watering')
+        self.discovery_prefix = settings.get('discovery_prefix', 'homeassistant')
+        self.cache = cache
+        self.names = names
+        self.send_command = send_command
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.client = None
+        # Клапан -> последнее опубликованное состояние в текущем соединении
+        self._published = {}
+        self._dirty = set()
+        self._wakeup = asyncio.Event()
+        self._commands = set()
+        self._task = None
+        self._unsubscribe = None
+
+    @property
+    def availability_topic(self):
+        return f'{self.prefix}/status'
+
+    def state_topic(self, valve):
+        return f'{self.prefix}/valve/{valve}/state'
+
+    def command_topic(self, valve):
+        return f'{self.prefix}/valve/{valve}/set'
+
+    def discovery_messages(self):
+        device = {'identifiers': [self.prefix], 'name': 'Система полива'}
+        return [
+            (
+                f'{self.discovery_prefix}/switch/{self.prefix}_{valve}/config',
+                json.dumps({
+                    'name': name,
+                    'unique_id': f'{self.prefix}_valve_{valve}',
+                    'command_topic': self.command_topic(valve),
+                    'state_topic': self.state_topic(valve),
+                    'availability_topic': self.availability_topic,
+                    'payload_on': 'ON',
+                    'payload_off': 'OFF',
+                    'device': device,
+                }, ensure_ascii=False),
+                True,
+            )
+            for valve, name in self.names.items()
+        ]
+
+    def state_messages(self, valves):
+        # Клапаны, состояние которых известно и отличается от опубликованного
+        messages = []
+        for valve in valves:
+            if valve not in self.names or self.cache.age(valve) is None:
+                continue
+            state = self.cache.get(valve)
+            if self._published.get(valve) == state:
+                continue
+            self._published[valve] = state
+            messages.append((self.state_topic(valve), 'ON' if state else 'OFF', True))
+        return messages
+
+    def publish_discovery(self):
+        # Повторная публикация discovery, например после переименования клапанов
+        if self.client is not None:
+            messages = self.discovery_messages()
+            self.client.publish_many(messages)
+            MESSAGES.inc(len(messages), kind='discovery')
+
+    def start(self):
+        if self._task is None:
+            self._unsubscribe = self.cache.subscribe(self._on_state_change)
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        if self.client is not None:
+            # Штатная остановка: завещание брокер не публикует, статус отправляем сами
+            try:
+                await self.client.publish(self.availability_topic, 'offline', retain=True)
+            except (ConnectionError, AttributeError):
+                pass
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _on_state_change(self, changes):
+        self._dirty.update(changes)
+        self._wakeup.set()
+
+    async def _run(self):
+        delay = self.retry_base
+        while True:
+            client = MqttClient(
+                self.settings['host'], int(self.settings.get('port', 1883)),
+                client_id=self.settings.get('client_id', self.prefix),
+                username=self.settings.get('username'), password=self.settings.get('password'),
+                will=(self.availability_topic, 'offline', True), on_message=self._on_message,
+            )
+            try:
+                await client.connect()
+            except (OSError, asyncio.TimeoutError, MqttError) as e:
+                logging.warning(f"Брокер MQTT недоступен: {e!r}, повтор через {delay} с")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max)
+                continue
+            delay = self.retry_base
+            logging.info(f"Подключено к брокеру MQTT {self.settings['host']}")
+            self.client = client
+            try:
+                await self._serve(client)
+            except ConnectionError as e:
+                logging.warning(f"Ошибка отправки в MQTT: {e!r}")
+            finally:
+                self.client = None
+                await client.close()
+
+    async def _serve(self, client):
+        # Пачка при подключении: доступность, discovery и все известные состояния
+        self._published = {}
+        self._dirty.clear()
+        discovery = self.discovery_messages()
+        states = self.state_messages(self.names)
+        client.publish_many([(self.availability_topic, 'online', True), *discovery, *states])
+        MESSAGES.inc(len(discovery), kind='discovery')
+        MESSAGES.inc(len(states), kind='state')
+        await client.subscribe([f'{self.prefix}/valve/+/set'])
+        while not client.closed.done():
+            self._wakeup.clear()
+            states = self.state_messages(sorted(self._dirty))
+            self._dirty.clear()
+            if states:
+                client.publish_many(states)
+                MESSAGES.inc(len(states), kind='state')
+            await client.drain()
+            wakeup = asyncio.create_task(self._wakeup.wait())
+            await asyncio.wait([wakeup, client.closed], return_when=asyncio.FIRST_COMPLETED)
+            wakeup.cancel()
+
+    async def _on_message(self, topic, payload):
+        parts = topic.split('/')
+        action = {'ON': 'on', 'OFF': 'off'}.get(payload.decode(errors='replace').strip().upper())
+        try:
+            valve = int(parts[-2])
+        except (IndexError, ValueError):
+            valve = None
+        if action is None or valve not in self.names:
+            COMMANDS.inc(result='invalid')
+            logging.warning(f"Некорректная команда MQTT: {topic} {payload!r}")
+            return
+        # Команда выполняется отдельно, чтобы не задерживать чтение из брокера
+        task = asyncio.create_task(self._command(action, valve))
+        self._commands.add(task)
+        task.add_done_callback(self._commands.discard)
+
+    async def _command(self, action, valve):
+        logging.info(f"Команда MQTT: {action} - клапан {valve}")
+        if await self.send_command(action, [valve]):
+            COMMANDS.inc(result='ok')
+        else:
+            COMMANDS.inc(result='queued')
+        # Если состояние не изменилось (например, клапан уже был в нужном положении),
+        # подписчик все равно получает подтверждение
+        self._published.pop(valve, None)
+        self._on_state_change({valve: None})
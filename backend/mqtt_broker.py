@@ -0,0 +1,126 @@
+import argparse
+import asyncio
+import logging
+import struct
+
+from mqtt import (
+    CONNACK, CONNECT, DISCONNECT, PINGREQ, PINGRESP, PUBACK, PUBLISH, SUBACK, SUBSCRIBE,
+    MqttError, decode_string, packet, parse_publish, publish_packet, read_packet, topic_matches,
+)
+
+
+class MqttBroker:
+    # Локальный брокер MQTT 3.1.1 в том же процессе - для тестов моста и
+    # разработки без Mosquitto. Подписки, retained-сообщения и завещания,
+    # только QoS 0 при доставке. Хранит все опубликованные сообщения в published.
+
+    def __init__(self):
+        self.retained = {}
+        self.published = []
+        self.server = None
+        self._clients = {}
+
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self._handle, host, port)
+        return self
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for writer in list(self._clients):
+                writer.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    def publish(self, topic, payload, retain=False):
+        self.published.append((topic, payload, retain))
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        data = publish_packet(topic, payload)
+        for writer, subscriptions in list(self._clients.items()):
+            if any(topic_matches(pattern, topic) for pattern in subscriptions):
+                writer.write(data)
+
+    async def _handle(self, reader, writer):
+        will = None
+        try:
+            kind, _, body = await read_packet(reader)
+            if kind != CONNECT:
+                return
+            will = self._parse_will(body)
+            writer.write(packet(CONNACK, b'\x00\x00'))
+            self._clients[writer] = []
+            while True:
+                kind, flags, body = await read_packet(reader)
+                if kind == PUBLISH:
+                    topic, payload, retain, qos, packet_id = parse_publish(flags, body)
+                    if qos == 1:
+                        writer.write(packet(PUBACK, struct.pack('!H', packet_id)))
+                    self.publish(topic, payload, retain)
+                elif kind == SUBSCRIBE:
+                    self._subscribe(writer, body)
+                elif kind == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif kind == DISCONNECT:
+                    will = None
+                    return
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, MqttError, struct.error):
+            pass
+        finally:
+            self._clients.pop(writer, None)
+            writer.close()
+            if will is not None:
+                self.publish(*will)
+
+    def _subscribe(self, writer, body):
+        (packet_id,) = struct.unpack_from('!H', body, 0)
+        offset = 2
+        patterns = []
+        while offset < len(body):
+            pattern, offset = decode_string(body, offset)
+            offset += 1  # запрошенный QoS
+            patterns.append(pattern.decode())
+        self._clients[writer].extend(patterns)
+        writer.write(packet(SUBACK, struct.pack('!H', packet_id) + b'\x00' * len(patterns)))
+        for topic, payload in self.retained.items():
+            if any(topic_matches(pattern, topic) for pattern in patterns):
+                writer.write(publish_packet(topic, payload, retain=True))
+
+    @staticmethod
+    def _parse_will(body):
+        # (топик, данные, retain) завещания из пакета CONNECT или None
+        _, offset = decode_string(body, 0)
+        flags = body[offset + 1]
+        offset += 4
+        _, offset = decode_string(body, offset)
+        if not flags & 0x04:
+            return None
+        topic, offset = decode_string(body, offset)
+        message, offset = decode_string(body, offset)
+        return topic.decode(), message, bool(flags & 0x20)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Локальный брокер MQTT для тестов')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    broker = await MqttBroker().start(args.host, args.port)
+    logging.info(f"Брокер MQTT слушает {args.host}:{broker.port}")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import time
+import zlib
+from datetime import date, datetime
+
+from device import DeviceError
+from metrics import Counter
+
+# Расписание на платах (протокол 3): плата сама включает и выключает клапаны по
+# своим часам, сервер только досылает изменения и читает отчеты о выполнении.
+SCHEDULE_PROTOCOL = 3
+# Период сверки версии расписания и чтения отчетов (секунды)
+SYNC_INTERVAL = 30
+# Элементов расписания в одном кадре - строка должна помещаться в память платы
+CHUNK = 16
+# Предел времени включения пина (секунды); для клапанов с более долгим
+# поливом по расписанию предел равен самому долгому поливу
+MAX_ON = 2 * 3600
+
+SYNCS = Counter('watering_schedule_sync_total', 'Сверки расписания на платах по результату', ['device', 'result'])
+REPORTS = Counter('watering_device_reports_total', 'Действия, выполненные платами самостоятельно', ['device', 'source'])
+
+
+def utc_offset():
+    return int(datetime.now().astimezone().utcoffset().total_seconds())
+
+
+def schedule_version(tokens):
+    data = '\n'.join(sorted(tokens)).encode()
+    return f'{zlib.crc32(data):08x}'
+
+
+def device_schedules(timeline, mapping, canceled_dates, max_on=MAX_ON, today=None, tz=None):
+    # Устройство -> набор элементов расписания для платы (формат - apply_schedule в esp/boot.py).
+    # Поливы одного устройства с одинаковым началом и длительностью объединяются в маску пинов.
+    today = (today or date.today()).isoformat()
+    tz = utc_offset() if tz is None else tz
+    runs = {}
+    longest = {}
+    for valve, intervals in timeline.intervals.items():
+        if valve not in mapping:
+            continue
+        device, pin = mapping[valve]
+        device_runs = runs.setdefault(device, {})
+        for start, end in intervals:
+            device_runs[(start, end - start)] = device_runs.get((start, end - start), 0) | 1 << pin
+            longest[valve] = max(longest.get(valve, 0), end - start)
+    canceled = {f"x{day.replace('-', '')}" for day in canceled_dates if day >= today}
+    schedules = {}
+    for valve, (device, pin) in mapping.items():
+        tokens = schedules.setdefault(device, {f'z{tz}', *canceled})
+        tokens.add(f'm{pin:x},{max(max_on, longest.get(valve, 0)):x}')
+    for device, device_runs in runs.items():
+        schedules[device].update(f'r{start:x},{length:x},{mask:x}' for (start, length), mask in device_runs.items())
+    return schedules
+
+
+class ScheduleSync:
+    # Доставка расписания на платы и чтение их отчетов.
+    # desired() возвращает устройство -> набор элементов. Версия - контрольная
+    # сумма набора. Если на плате версия, которую сервер отправлял последней,
+    # досылаются только изменения, иначе расписание переписывается целиком.
+    # Кадры с изменениями применяются платой, только если ее версия совпадает с
+    # ожидаемой, поэтому оборванная на середине доставка приводит к полной
+    # перезаписи при следующей сверке. Пока версия на плате не подтверждена,
+    # события расписания для ее клапанов выполняет сервер (handles).
+    # on_report(устройство, [(время, маска включенных, маска выключенных, источник)])
+    # получает все новые действия, которые плата выполнила сама, одним списком:
+    # "s" - расписание, "f" - предел включения.
+
+    def __init__(self, fleet, desired, on_report, interval=SYNC_INTERVAL):
+        self.fleet = fleet
+        self.desired = desired
+        self.on_report = on_report
+        self.interval = interval
+        # Устройство -> (версия, элементы), подтвержденные платой
+        self.synced = {}
+        # Устройство -> версия текущего расписания сервера
+        self.versions = {}
+        # Устройство -> номер последнего прочитанного отчета
+        self.report_seq = {}
+        self.started = time.time()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def handles(self, valve):
+        # Плата устройства клапана выполняет текущее расписание сама
+        device = self.fleet.resolve(valve)[0]
+        version = self.versions.get(device)
+        return version is not None and self.synced.get(device, (None,))[0] == version
+
+    def kick(self):
+        # Расписание изменилось: до сверки его выполняет сервер
+        self.versions = {}
+        self._wakeup.set()
+
+    async def sync(self):
+        desired = self.desired()
+        self.versions = {device: schedule_version(tokens) for device, tokens in desired.items()}
+        await asyncio.gather(*(
+            self._sync_device(device, desired.get(device, {f'z{utc_offset()}'})) for device in self.fleet.devices
+        ))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.error(f"Ошибка сверки расписания на платах: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _sync_device(self, device, tokens):
+        client = self.fleet.devices[device]
+        try:
+            if await client.protocol_version() < SCHEDULE_PROTOCOL:
+                return
+            await client.set_clock(time.time())
+            result = await self._push(device, client, tokens)
+            SYNCS.inc(device=device, result=result)
+            await self._read_reports(device, client)
+        except DeviceError as e:
+            SYNCS.inc(device=device, result='error')
+            logging.warning(f"Не удалось сверить расписание на {device}: {e}")
+
+    async def _push(self, device, client, tokens):
+        version = schedule_version(tokens)
+        board_version, _ = await client.schedule_version()
+        if board_version == version:
+            self.synced[device] = (version, set(tokens))
+            return 'unchanged'
+        known = self.synced.get(device)
+        if known is not None and known[0] == board_version:
+            result = 'delta'
+            base = board_version
+            changes = [('+', token) for token in sorted(tokens - known[1])]
+            changes += [('-', token) for token in sorted(known[1] - tokens)]
+        else:
+            result = 'full'
+            base = f'{version}.0'
+            await client.clear_schedule(base)
+            changes = [('+', token) for token in sorted(tokens)]
+        chunks = [changes[i:i + CHUNK] for i in range(0, len(changes), CHUNK)] or [[]]
+        for index, chunk in enumerate(chunks):
+            new = version if index == len(chunks) - 1 else f'{version}.{index + 1}'
+            await client.update_schedule(
+                base, new,
+                add=[token for sign, token in chunk if sign == '+'],
+                remove=[token for sign, token in chunk if sign == '-'],
+            )
+            base = new
+        self.synced[device] = (version, set(tokens))
+        logging.info(f"Расписание на {device} обновлено ({result}, изменений: {len(changes)}), версия {version}")
+        return result
+
+    async def _read_reports(self, device, client):
+        after = self.report_seq.get(device)
+        first = after is None
+        fresh = []
+        while True:
+            last, entries = await client.reports(after or 0)
+            if after is not None and last < after:
+                # Плата перезагрузилась, нумерация отчетов началась заново
+                after = 0
+                continue
+            for seq, timestamp, on_mask, off_mask, source in entries:
+                # При первом чтении после запуска сервера пропускаем то, что
+                # могло попасть в журнал до перезапуска
+                if not first or timestamp >= self.started:
+                    REPORTS.inc(device=device, source=source)
+                    fresh.append((datetime.fromtimestamp(timestamp), on_mask, off_mask, source))
+                after = seq
+            self.report_seq[device] = after if after is not None else last
+            if not entries or after >= last:
+                break
+        if fresh:
+            self.on_report(device, fresh)
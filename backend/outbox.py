@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+
+from metrics import Counter, Gauge
+
+# Срок, после которого недоставленная команда теряет смысл (секунды): опоздавшее
+# включение хуже никакого, а выключение имеет смысл повторять долго
+ON_DEADLINE = 300.0
+OFF_DEADLINE = 86400.0
+# Пауза перед повтором удваивается после каждой неудачи, но не превышает RETRY_MAX
+RETRY_BASE = 1.0
+RETRY_MAX = 60.0
+
+RETRIES = Counter('watering_outbox_retries_total', 'Повторные отправки команд из очереди', ['result'])
+EXPIRED = Counter('watering_outbox_expired_total', 'Команды, не доставленные до истечения срока', ['action'])
+PENDING = Gauge('watering_outbox_pending', 'Недоставленные команды в очереди')
+
+
+class Outbox:
+    # Очередь недоставленных команд с повторами.
+    # Перед отправкой команда записывается в базу - по одной последней на клапан.
+    # Доставленная команда удаляется, недоставленная повторяется в фоне с паузой
+    # RETRY_BASE * 2^попытка, пока не будет доставлена, не истечет ее срок или ее
+    # не заменит более новая команда для того же клапана. После перезапуска очередь
+    # читается из базы, и повторы продолжаются. submit(action, valves) возвращает
+    # (не доставлено, отменено); отмененные включения удаляются без повторов.
+
+    def __init__(self, store, submit, on_delivered=None, retry_base=RETRY_BASE, retry_max=RETRY_MAX):
+        self.store = store
+        self.submit = submit
+        self.on_delivered = on_delivered
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.entries = {entry['valve']: entry for entry in store.load_outbox()}
+        self._inflight = set()
+        self._wakeup = asyncio.Event()
+        self._task = None
+        PENDING.set_function(lambda: len(self.entries))
+
+    def pending(self, valve):
+        return valve in self.entries
+
+    async def send(self, action, valves, deadline=None):
+        # Возвращает клапаны, команду для которых доставить не удалось.
+        # Они остаются в очереди и будут повторены.
+        now = time.time()
+        if deadline is None:
+            deadline = now + (ON_DEADLINE if action == 'on' else OFF_DEADLINE)
+        entries = [
+            {'valve': valve, 'action': action, 'created': now, 'deadline': deadline,
+             'attempts': 0, 'next_attempt': now + self.retry_base, 'error': None}
+            for valve in valves
+        ]
+        for entry in entries:
+            self.entries[entry['valve']] = entry
+        await asyncio.to_thread(self.store.put_outbox, entries)
+        return await self._deliver(action, entries)
+
+    async def retry_due(self):
+        now = time.time()
+        waiting = [entry for entry in self.entries.values() if entry['valve'] not in self._inflight]
+        expired = [entry for entry in waiting if entry['deadline'] <= now]
+        for entry in expired:
+            EXPIRED.inc(action=entry['action'])
+            logging.error(
+                f"Команда {entry['action']} для клапана {entry['valve']} не доставлена "
+                f"за {entry['attempts'] + 1} попыток: {entry['error']}"
+            )
+        if expired:
+            await self._forget(expired)
+        due = [entry for entry in waiting if entry['deadline'] > now and entry['next_attempt'] <= now]
+        # Выключения и включения уходят вместе и попадают в одно окно объединения команд
+        await asyncio.gather(*(
+            self._deliver(action, [entry for entry in due if entry['action'] == action], retry=True)
+            for action in ('off', 'on')
+            if any(entry['action'] == action for entry in due)
+        ))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._next_delay())
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.retry_due()
+            except Exception as e:
+                logging.error(f"Ошибка при повторной отправке команд: {e}")
+
+    def _next_delay(self):
+        waiting = [
+            min(entry['next_attempt'], entry['deadline'])
+            for entry in self.entries.values()
+            if entry['valve'] not in self._inflight
+        ]
+        if not waiting:
+            return None
+        return max(min(waiting) - time.time(), 0.0)
+
+    async def _deliver(self, action, entries, retry=False):
+        valves = [entry['valve'] for entry in entries]
+        self._inflight.update(valves)
+        error = None
+        overridden = set()
+        try:
+            failed, overridden = await self.submit(action, valves)
+            failed, overridden = set(failed), set(overridden)
+            if failed:
+                error = 'устройство недоступно'
+        except Exception as e:
+            failed = set(valves)
+            error = repr(e)
+        finally:
+            self._inflight.difference_update(valves)
+
+        # Включение, отмененное выключением в том же окне, не повторяем: выключение важнее
+        canceled = [entry for entry in entries if entry['valve'] in overridden]
+        if canceled:
+            await self._forget(canceled)
+        delivered = [entry for entry in entries if entry['valve'] not in failed and entry['valve'] not in overridden]
+        if delivered:
+            await self._forget(delivered)
+            if retry:
+                RETRIES.inc(len(delivered), result='ok')
+                logging.info(f"Команда {action} для клапанов {sorted(e['valve'] for e in delivered)} доставлена повторно")
+            if self.on_delivered is not None:
+                self.on_delivered(action, [entry['valve'] for entry in delivered])
+
+        # Команды, замененные за время отправки более новыми, больше не повторяем
+        now = time.time()
+        retries = [entry for entry in entries if entry['valve'] in failed and self.entries.get(entry['valve']) is entry]
+        for entry in retries:
+            entry['attempts'] += 1
+            entry['next_attempt'] = now + min(self.retry_base * 2 ** (entry['attempts'] - 1), self.retry_max)
+            entry['error'] = error
+        if retries:
+            if retry:
+                RETRIES.inc(len(retries), result='error')
+            await asyncio.to_thread(self.store.update_outbox, retries)
+            self._wakeup.set()
+        return sorted(failed)
+
+    async def _forget(self, entries):
+        for entry in entries:
+            if self.entries.get(entry['valve']) is entry:
+                del self.entries[entry['valve']]
+        await asyncio.to_thread(self.store.remove_outbox, entries)
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+
+from metrics import Counter
+
+# Пауза между поводом для сверки и самой сверкой (секунды): за это время
+# успевают завершиться команды, отправленные в тот же момент
+SETTLE_DELAY = 1.0
+
+CORRECTIONS = Counter('watering_reconcile_corrections_total', 'Клапаны, исправленные сверкой состояния', ['action'])
+
+
+class Reconciler:
+    # Сверка желаемого состояния клапанов с фактическим.
+    # Желаемое состояние - расписание диспетчера с учетом отмен полива, поверх
+    # которого действуют ручные команды: ручная команда важнее расписания до
+    # следующего события расписания для этого клапана. После каждой доставки и
+    # после восстановления связи с устройством (изменение кэша состояния)
+    # расхождения уходят через очередь команд одной пачкой. Клапаны с устаревшим
+    # состоянием и с командами, которые еще в очереди, не трогаем.
+
+    def __init__(self, store, cache, outbox, valves, dispatcher, is_canceled=None, settle=SETTLE_DELAY):
+        self.store = store
+        self.cache = cache
+        self.outbox = outbox
+        self.valves = valves
+        self.dispatcher = dispatcher
+        self.is_canceled = is_canceled
+        self.settle = settle
+        # Клапан -> (включен, время ручной команды)
+        self.overrides = store.load_overrides()
+        # Истекшие ручные команды, которые еще нужно удалить из базы
+        self._expired = {}
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._unsubscribe = None
+
+    async def override(self, action, valves):
+        # Ручная команда: запоминаем ее до следующего события расписания для этих клапанов
+        since = time.time()
+        for valve in valves:
+            self.overrides[valve] = (action == 'on', since)
+            self._expired.pop(valve, None)
+        await asyncio.to_thread(self.store.set_overrides, valves, action == 'on', since)
+
+    def scheduled(self, now):
+        # Клапаны, открытые по расписанию. Полив, начавшийся в отмененный день, не в счет.
+        runs = self.dispatcher.timeline.active_runs(now)
+        return {
+            valve for valve, started in runs.items()
+            if self.is_canceled is None or not self.is_canceled(started.date())
+        }
+
+    def desired(self, now=None):
+        # Клапан -> должен быть открыт
+        now = now or datetime.now()
+        scheduled = self.scheduled(now)
+        expired = [valve for valve, (_, since) in self.overrides.items() if self._is_expired(valve, since, now)]
+        for valve in expired:
+            # Из базы удаляет reconcile, не блокируя цикл событий
+            self._expired[valve] = self.overrides.pop(valve)[1]
+        return {
+            valve: self.overrides[valve][0] if valve in self.overrides else valve in scheduled
+            for valve in self.valves
+        }
+
+    def differences(self, now=None):
+        # (включить, выключить) - клапаны, состояние которых известно и расходится с желаемым
+        on, off = [], []
+        for valve, state in self.desired(now).items():
+            if self.cache.is_stale(valve) or self.outbox.pending(valve):
+                continue
+            if self.cache.get(valve) != state:
+                (on if state else off).append(valve)
+        return on, off
+
+    async def reconcile(self):
+        on, off = self.differences()
+        if self._expired:
+            expired, self._expired = self._expired, {}
+            await asyncio.to_thread(self.store.clear_overrides, expired)
+        if not on and not off:
+            return
+        logging.warning(f"Состояние клапанов расходится с желаемым, включаем {on}, выключаем {off}")
+        sends = []
+        if off:
+            CORRECTIONS.inc(len(off), action='off')
+            sends.append(self.outbox.send('off', off))
+        if on:
+            CORRECTIONS.inc(len(on), action='on')
+            sends.append(self.outbox.send('on', on))
+        await asyncio.gather(*sends)
+
+    def kick(self):
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._unsubscribe = self.cache.subscribe(lambda changes: self.kick())
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._unsubscribe is not None:
+            self._unsubscribe()
+            self._unsubscribe = None
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.settle)
+            self._wakeup.clear()
+            try:
+                await self.reconcile()
+            except Exception as e:
+                logging.error(f"Ошибка при сверке состояния клапанов: {e}")
+
+    def _is_expired(self, valve, since, now):
+        # Ручная команда перестает действовать на первом событии расписания для клапана
+        since = datetime.fromtimestamp(since)
+        limit = min(now, since + timedelta(days=7))
+        for when, event in self.dispatcher.timeline.iter_events(since):
+            if when > limit:
+                return False
+            if valve in event.on or valve in event.off:
+                return True
+        return False
@@ -0,0 +1,266 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from esp_sim import EspSimulator
+from fleet import Fleet, load_devices, load_valve_mapping
+from sequencer import FlowSequencer
+from storage import Store, DB_FILE
+from timeline import Dispatcher, compile_timeline, days_mapping
+
+# Прогон расписания в виртуальном времени: та же компиляция и тот же диспетчер,
+# что и в app.py, но время задает симуляция, а не часы. Месяцы расписания
+# проигрываются за доли секунды. С --devices команды уходят на симуляторы ESP
+# (esp_sim.py) через Fleet, и в конце состояние плат сверяется с ожидаемым.
+# Результат - лента включений и выключений, поливы по клапанам, пересечения,
+# сдвиги из-за ограничения расхода и отмененные дни.
+
+DAY_NAMES = {number: name for name, number in days_mapping.items()}
+# Сколько пересечений и сдвигов перечислять в выводе (в JSON попадают все)
+SHOWN = 10
+
+
+def format_week_second(second):
+    return f'{DAY_NAMES[second // 86400]} {second % 86400 // 3600:02d}:{second % 3600 // 60:02d}:{second % 60:02d}'
+
+
+class ScheduleSimulation:
+    # execute(on, off) - необязательный исполнитель команд, например Fleet.set;
+    # возвращает клапаны, команда для которых не прошла.
+
+    def __init__(self, timeline, is_canceled=None, execute=None):
+        self.timeline = timeline
+        self.is_canceled = is_canceled
+        self.execute = execute
+        self.events = []
+        self.runs = {}
+        self.canceled = set()
+        self.failed = 0
+        self.open_at_end = set()
+        self._open = {}
+
+    async def run(self, start, end):
+        # Поливы, идущие в начале периода, считаются начатыми в этот момент
+        initial = sorted(self.timeline.active_at(start))
+        if initial and self.execute is not None:
+            self.failed += len(await self.execute(initial, []))
+        self._open = {valve: start for valve in initial}
+        # Один вызов run_due за весь период - так же диспетчер догоняет события,
+        # пропущенные, пока приложение стояло
+        dispatcher = Dispatcher(self.timeline, self._execute, is_canceled=self._is_canceled, now=start)
+        await dispatcher.run_due(end)
+        for valve, started in self._open.items():
+            # Поливы, не закончившиеся к концу периода, обрезаются по нему
+            self.runs.setdefault(valve, []).append((started, end))
+        self.open_at_end = set(self._open)
+        self._open = {}
+        return self.report(start, end)
+
+    def report(self, start, end):
+        usage = {
+            valve: {'seconds': sum((e - s).total_seconds() for s, e in runs), 'runs': len(runs)}
+            for valve, runs in sorted(self.runs.items())
+        }
+        return {
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'events': [
+                {'time': when.isoformat(), 'on': on, 'off': off} for when, on, off in self.events
+            ],
+            'usage': usage,
+            'total_seconds': sum(valve['seconds'] for valve in usage.values()),
+            'max_concurrent': self.max_concurrent(),
+            'overlaps': [
+                {'valve': valve, 'at': format_week_second(second)} for valve, second in self.timeline.overlaps
+            ],
+            'shifts': [
+                {'valve': valve, 'requested': format_week_second(requested % (7 * 86400)),
+                 'start': format_week_second(shifted % (7 * 86400)), 'delay_seconds': shifted - requested}
+                for valve, requested, shifted, _ in self.timeline.shifts
+            ],
+            'canceled_dates': sorted(date.isoformat() for date in self.canceled),
+            'failed_commands': self.failed,
+        }
+
+    def max_concurrent(self):
+        # Наибольшее число одновременно открытых клапанов
+        changes = []
+        for runs in self.runs.values():
+            for started, ended in runs:
+                changes.append((started, 1))
+                changes.append((ended, -1))
+        current = peak = 0
+        for _, change in sorted(changes):
+            current += change
+            peak = max(peak, current)
+        return peak
+
+    def _is_canceled(self, date):
+        if self.is_canceled is None or not self.is_canceled(date):
+            return False
+        self.canceled.add(date)
+        return True
+
+    async def _execute(self, when, on, off):
+        failed = set()
+        if self.execute is not None:
+            failed = set(await self.execute(on, off))
+            self.failed += len(failed)
+        self.events.append((when, on, off))
+        for valve in off:
+            started = self._open.pop(valve, None)
+            if started is not None:
+                self.runs.setdefault(valve, []).append((started, when))
+        for valve in on:
+            if valve not in failed:
+                self._open.setdefault(valve, when)
+
+
+def load_inputs(args):
+    # (расписание, отмены, клапан -> (устройство, пин), устройства, расходы) из базы
+    # или из config.json старого формата. --schedule подменяет расписание.
+    if args.config:
+        with open(args.config, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+        devices = load_devices(config)
+        mapping = load_valve_mapping(config, next(iter(devices)))
+        flows = {int(k): float(v) for k, v in config.get('valve_flows', {}).items()}
+        schedule = config.get('schedule', [])
+        cancellations = set()
+    else:
+        store = Store(args.db)
+        try:
+            devices = store.load_devices()
+            mapping, _ = store.load_valves()
+            flows = store.load_flows()
+            schedule = store.load_schedule()
+            cancellations = store.load_cancellations()
+        finally:
+            store.close()
+    if args.schedule:
+        with open(args.schedule, 'r', encoding='utf-8') as f:
+            schedule = json.load(f)
+        if isinstance(schedule, dict):
+            schedule = schedule.get('schedule', [])
+    cancellations = set(cancellations) | set(args.cancel)
+    return schedule, cancellations, mapping, devices, flows
+
+
+async def start_devices(devices, mapping):
+    # По симулятору на каждое устройство с пинами, которые на нем используются
+    pins = {name: set() for name in devices}
+    for device_name, pin in mapping.values():
+        pins.setdefault(device_name, set()).add(pin)
+    simulators = {}
+    for name, device_pins in pins.items():
+        simulators[name] = await EspSimulator(pins=sorted(device_pins) or (0,)).start()
+    fleet = Fleet({name: {'ip': '127.0.0.1', 'port': sim.port} for name, sim in simulators.items()}, mapping)
+    return simulators, fleet
+
+
+async def run(args):
+    schedule, cancellations, mapping, devices, flows = load_inputs(args)
+    capacities = {name: device.get('capacity', 0) for name, device in devices.items()}
+    default_device = next(iter(devices))
+    sequencer = FlowSequencer(flows, capacities, lambda valve: mapping.get(valve, (default_device, valve))[0])
+    started = time.perf_counter()
+    timeline = compile_timeline(schedule, sequencer)
+    compile_ms = (time.perf_counter() - started) * 1000
+
+    start = datetime.fromisoformat(args.start) if args.start else datetime.now().replace(microsecond=0)
+    end = start + timedelta(days=args.days)
+    simulators, fleet = {}, None
+    if args.devices:
+        simulators, fleet = await start_devices(devices, mapping)
+    simulation = ScheduleSimulation(
+        timeline, is_canceled=lambda date: date.isoformat() in cancellations,
+        execute=fleet.set if fleet is not None else None,
+    )
+    try:
+        started = time.perf_counter()
+        result = await simulation.run(start, end)
+        result['simulation_ms'] = (time.perf_counter() - started) * 1000
+        result['compile_ms'] = compile_ms
+        if fleet is not None:
+            # Платы должны прийти в то же состояние, что и расписание на конец периода
+            expected = {valve: valve in simulation.open_at_end for valve in mapping}
+            actual = await fleet.status()
+            result['device_mismatches'] = sorted(
+                valve for valve, state in expected.items() if actual.get(valve, False) != state
+            )
+    finally:
+        if fleet is not None:
+            await fleet.close()
+        for simulator in simulators.values():
+            await simulator.stop()
+    return result
+
+
+def shown(items):
+    if len(items) > SHOWN:
+        return ', '.join(items[:SHOWN]) + f', и еще {len(items) - SHOWN}'
+    return ', '.join(items)
+
+
+def print_result(result, events=False):
+    if events:
+        for event in result['events']:
+            parts = []
+            if event['on']:
+                parts.append(f"включение {event['on']}")
+            if event['off']:
+                parts.append(f"выключение {event['off']}")
+            print(f"{event['time']}  {'; '.join(parts)}")
+        print()
+    print(f"Период: {result['start']} - {result['end']}")
+    print(f"Событий: {len(result['events'])}, компиляция {result['compile_ms']:.1f} мс, "
+          f"прогон {result['simulation_ms']:.1f} мс")
+    for valve, usage in result['usage'].items():
+        print(f"Клапан {valve:3}: {usage['runs']:5} поливов, {usage['seconds'] / 3600:8.2f} ч")
+    print(f"Всего полива: {result['total_seconds'] / 3600:.2f} ч, "
+          f"одновременно открыто до {result['max_concurrent']} клапанов")
+    if result['overlaps']:
+        print('Пересекающиеся поливы объединены: ' + shown([
+            f"{overlap['valve']} ({overlap['at']})" for overlap in result['overlaps']
+        ]))
+    if result['shifts']:
+        print('Сдвинуты из-за ограничения расхода: ' + shown([
+            f"{shift['valve']} ({shift['requested']} -> {shift['start']})" for shift in result['shifts']
+        ]))
+    if result['canceled_dates']:
+        print('Отменен полив: ' + ', '.join(result['canceled_dates']))
+    if result['failed_commands']:
+        print(f"Команд с ошибкой: {result['failed_commands']}")
+    if result.get('device_mismatches'):
+        print(f"Состояние плат расходится с расписанием: {result['device_mismatches']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Прогон расписания полива в виртуальном времени')
+    parser.add_argument('--db', default=DB_FILE, help='база с расписанием, клапанами и отменами')
+    parser.add_argument('--config', help='взять расписание и клапаны из config.json вместо базы')
+    parser.add_argument('--schedule', help='JSON со списком записей расписания, например перед импортом')
+    parser.add_argument('--start', help='начало периода, ISO (по умолчанию сейчас)')
+    parser.add_argument('--days', type=float, default=28, help='длительность периода, дни')
+    parser.add_argument('--cancel', action='append', default=[], help='дата отмены полива, ISO; можно повторять')
+    parser.add_argument('--devices', action='store_true', help='отправлять команды на симуляторы ESP')
+    parser.add_argument('--events', action='store_true', help='вывести ленту событий')
+    parser.add_argument('--json', help='сохранить результат в файл')
+    args = parser.parse_args()
+    if not args.config and not os.path.exists(args.db):
+        parser.error(f'нет базы {args.db}, укажите --db или --config')
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    result = asyncio.run(run(args))
+    print_result(result, events=args.events)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'params': vars(args), 'result': result}, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    main()
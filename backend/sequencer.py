@@ -0,0 +1,164 @@
+import heapq
+
+# Допуск при сравнении суммарного расхода с пропускной способностью
+FLOW_EPSILON = 1e-9
+# Группы взаимно мешающих поливов до этого размера планируются точным перебором
+EXACT_JOBS = 6
+
+
+class FlowSequencer:
+    # Упаковка поливов под ограничение расхода.
+    # У клапана есть расход (flows), у устройства - пропускная способность линии
+    # (capacities), в одних единицах, например л/мин. Если поливы одного устройства
+    # вместе превысили бы ее, часть из них откладывается. Сначала план строится
+    # жадно: в каждый момент из ожидающих поливов первыми запускаются самые
+    # длинные, пока хватает расхода. Это эвристика, она не всегда дает самый
+    # ранний конец. Поэтому группы поливов, которые мешают друг другу, размером
+    # до EXACT_JOBS перебираются точно: выбирается план с самым ранним концом
+    # группы, при равенстве - с наименьшей суммой задержек. Большие группы
+    # остаются с жадным планом. Длительность полива не меняется, сдвигается
+    # только начало. Клапаны без расхода и устройства без ограничения не планируются,
+    # клапан с расходом больше пропускной способности линии поливает один.
+
+    def __init__(self, flows, capacities, device_of):
+        self.flows = flows
+        self.capacities = capacities
+        self.device_of = device_of
+
+    def plan(self, intervals_by_valve):
+        # intervals_by_valve: клапан -> [(начало, конец)] в секундах от начала недели.
+        # Возвращает (клапан -> [(начало, конец)], сдвиги [(клапан, запрошено, начало, конец)]).
+        result = {}
+        jobs_by_device = {}
+        for valve, intervals in intervals_by_valve.items():
+            device = self.device_of(valve)
+            if (self.capacities.get(device) or 0) <= 0 or (self.flows.get(valve) or 0) <= 0:
+                result[valve] = list(intervals)
+                continue
+            jobs_by_device.setdefault(device, []).extend((start, end - start, valve) for start, end in intervals)
+
+        shifts = []
+        for device, jobs in jobs_by_device.items():
+            for valve, requested, start, end in self._sequence(jobs, self.capacities[device]):
+                result.setdefault(valve, []).append((start, end))
+                if start != requested:
+                    shifts.append((valve, requested, start, end))
+        for intervals in result.values():
+            intervals.sort()
+        return result, sorted(shifts, key=lambda shift: (shift[2], shift[0]))
+
+    def _sequence(self, jobs, capacity):
+        # jobs: [(запрошенное начало, длительность, клапан)] одного устройства
+        planned = []
+        for group in self._groups(self._greedy(jobs, capacity)):
+            if 1 < len(group) <= EXACT_JOBS and any(start != requested for _, requested, start, _ in group):
+                group = self._search(group, capacity)
+            planned.extend(group)
+        return planned
+
+    @staticmethod
+    def _groups(planned):
+        # Поливы, связанные пересечениями от запрошенного начала до конца по плану.
+        # Лучший план группы кончается не позже жадного, поэтому группы независимы.
+        groups = []
+        end = None
+        for run in sorted(planned, key=lambda run: (run[1], run[2])):
+            if end is None or run[1] >= end:
+                groups.append([])
+                end = run[3]
+            groups[-1].append(run)
+            end = max(end, run[3])
+        return groups
+
+    def _search(self, group, capacity):
+        # Перебор порядков с размещением каждого полива в самый ранний момент, когда
+        # ему хватает расхода (такие планы содержат лучший), с отсечением по лучшему
+        jobs = sorted((requested, end - start, valve) for valve, requested, start, end in group)
+        best = [(max(run[3] for run in group), sum(run[2] - run[1] for run in group)), group]
+
+        def search(placed, remaining, finish, delay):
+            if not remaining:
+                if (finish, delay) < best[0]:
+                    best[:] = [(finish, delay), list(placed)]
+                return
+            tried = set()
+            for index, job in enumerate(remaining):
+                requested, length, valve = job
+                kind = (requested, length, self.flows[valve])
+                if kind in tried:
+                    continue
+                tried.add(kind)
+                start = self._earliest(placed, job, capacity)
+                end = start + length
+                if (max(finish, end), delay + start - requested) >= best[0]:
+                    continue
+                placed.append((valve, requested, start, end))
+                search(placed, remaining[:index] + remaining[index + 1:], max(finish, end), delay + start - requested)
+                placed.pop()
+
+        search([], jobs, 0, 0)
+        return best[1]
+
+    def _earliest(self, placed, job, capacity):
+        requested, length, valve = job
+        flow = self.flows[valve]
+        for start in sorted({requested} | {run[3] for run in placed if run[3] > requested}):
+            end = start + length
+            overlapping = [run for run in placed if run[2] < end and run[3] > start]
+            if any(run[0] == valve for run in overlapping):
+                continue
+            # Расход меняется только в начале полива, поэтому проверяем эти моменты
+            moments = [start] + [run[2] for run in overlapping if run[2] > start]
+            if all(self._fits(overlapping, moment, flow, capacity) for moment in moments):
+                return start
+        return max(run[3] for run in placed)
+
+    def _fits(self, runs, moment, flow, capacity):
+        used = sum(self.flows[run[0]] for run in runs if run[2] <= moment < run[3])
+        return used <= 0 or used + flow <= capacity + FLOW_EPSILON
+
+    def _greedy(self, jobs, capacity):
+        jobs = sorted(jobs)
+        planned = []
+        waiting = []
+        running = []
+        busy = set()
+        used = 0.0
+        index = 0
+        now = jobs[0][0] if jobs else 0
+        while index < len(jobs) or waiting:
+            while running and running[0][0] <= now:
+                _, valve, flow = heapq.heappop(running)
+                used -= flow
+                busy.discard(valve)
+            while index < len(jobs) and jobs[index][0] <= now:
+                requested, length, valve = jobs[index]
+                heapq.heappush(waiting, (-length, requested, valve))
+                index += 1
+
+            deferred = []
+            while waiting:
+                job = heapq.heappop(waiting)
+                length, requested, valve = -job[0], job[1], job[2]
+                flow = self.flows[valve]
+                if valve in busy or (used > 0 and used + flow > capacity + FLOW_EPSILON):
+                    deferred.append(job)
+                    continue
+                used += flow
+                busy.add(valve)
+                heapq.heappush(running, (now + length, valve, flow))
+                planned.append((valve, requested, now, now + length))
+            for job in deferred:
+                heapq.heappush(waiting, job)
+
+            # Следующий момент, когда что-то может измениться: освобождение
+            # расхода или новый запрошенный полив
+            moments = []
+            if running:
+                moments.append(running[0][0])
+            if index < len(jobs):
+                moments.append(jobs[index][0])
+            if not moments:
+                break
+            now = max(now, min(moments))
+        return planned
@@ -0,0 +1,582 @@
+import json
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from fleet import load_devices, load_valve_mapping
+from usage import MAX_RUN, rollup
+
+DB_FILE = 'watering.db'
+# Записей журнала, удаляемых за одну транзакцию
+PRUNE_BATCH = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS devices (
+    name TEXT PRIMARY KEY,
+    ip TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    capacity REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS valves (
+    number INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    device TEXT NOT NULL,
+    pin INTEGER NOT NULL,
+    flow REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS schedule (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    day TEXT NOT NULL,
+    time TEXT NOT NULL,
+    duration REAL NOT NULL,
+    valves TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cancellations (
+    date TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS actions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp TEXT NOT NULL,
+    action TEXT NOT NULL,
+    valves TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS actions_timestamp ON actions (timestamp);
+CREATE TABLE IF NOT EXISTS action_valves (
+    action_id INTEGER NOT NULL REFERENCES actions (id) ON DELETE CASCADE,
+    valve INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS action_valves_valve ON action_valves (valve, action_id);
+CREATE INDEX IF NOT EXISTS action_valves_action ON action_valves (action_id);
+CREATE TABLE IF NOT EXISTS outbox (
+    valve INTEGER PRIMARY KEY,
+    action TEXT NOT NULL,
+    created REAL NOT NULL,
+    deadline REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS overrides (
+    valve INTEGER PRIMARY KEY,
+    state INTEGER NOT NULL,
+    since REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS open_runs (
+    valve INTEGER PRIMARY KEY,
+    started TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    valve INTEGER NOT NULL,
+    started TEXT NOT NULL,
+    ended TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    estimated INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS runs_valve ON runs (valve, started);
+CREATE TABLE IF NOT EXISTS usage_daily (
+    valve INTEGER NOT NULL,
+    day TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    runs INTEGER NOT NULL,
+    PRIMARY KEY (day, valve)
+);
+CREATE TABLE IF NOT EXISTS usage_weekly (
+    valve INTEGER NOT NULL,
+    week TEXT NOT NULL,
+    seconds REAL NOT NULL,
+    runs INTEGER NOT NULL,
+    PRIMARY KEY (week, valve)
+);
+"""
+
+# Колонки, добавленные после первой версии схемы: таблица -> [(колонка, определение)]
+MIGRATIONS = {
+    'devices': [('capacity', 'REAL NOT NULL DEFAULT 0')],
+    'valves': [('flow', 'REAL NOT NULL DEFAULT 0')],
+}
+
+
+def config_valves(config, devices):
+    # Строки таблицы valves из config.json: (номер, имя, устройство, пин, расход)
+    default_device = next(iter(devices))
+    mapping = load_valve_mapping(config, default_device)
+    names = {int(k): v for k, v in config.get('valve_names', {}).items()}
+    flows = {int(k): float(v) for k, v in config.get('valve_flows', {}).items()}
+    return [
+        (number, names.get(number, f'Клапан {number}'), *mapping.get(number, (default_device, number)), flows.get(number, 0))
+        for number in sorted(names.keys() | mapping.keys())
+    ]
+
+
+class Store:
+    # Хранилище конфигурации, расписания и истории в SQLite (режим WAL).
+    # Каждое изменение - отдельная транзакция над нужными строками, поэтому
+    # правка одной записи не переписывает весь файл, а сбой посреди записи не
+    # портит данные. Соединение общее для цикла событий и потоков записи журнала.
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        with self.transaction() as cur:
+            for statement in SCHEMA.split(';'):
+                if statement.strip():
+                    cur.execute(statement)
+            for table, columns in MIGRATIONS.items():
+                existing = {row[1] for row in cur.execute(f'PRAGMA table_info({table})')}
+                for column, definition in columns:
+                    if column not in existing:
+                        cur.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            cur = self.conn.cursor()
+            cur.execute('BEGIN IMMEDIATE')
+            try:
+                yield cur
+            except BaseException:
+                cur.execute('ROLLBACK')
+                raise
+            cur.execute('COMMIT')
+
+    def _fetch(self, query, params=()):
+        with self._lock:
+            return self.conn.execute(query, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+    # Разовый импорт config.json, state.json и action_log.json
+
+    def is_imported(self):
+        return bool(self._fetch("SELECT 1 FROM meta WHERE key = 'imported'"))
+
+    def import_legacy(self, config, state, actions=()):
+        if self.is_imported():
+            return
+        devices = load_devices(config)
+        with self.transaction() as cur:
+            cur.executemany(
+                'INSERT OR REPLACE INTO devices (name, ip, port, capacity) VALUES (?, ?, ?, ?)',
+                [(name, d['ip'], d['port'], d['capacity']) for name, d in devices.items()],
+            )
+            cur.executemany(
+                'INSERT OR REPLACE INTO valves (number, name, device, pin, flow) VALUES (?, ?, ?, ?, ?)',
+                config_valves(config, devices),
+            )
+            cur.executemany(
+                'INSERT INTO schedule (day, time, duration, valves) VALUES (?, ?, ?, ?)',
+                [
+                    (entry['day'], entry['time'], float(entry['duration']), json.dumps(entry['valves']))
+                    for entry in config.get('schedule', [])
+                ],
+            )
+            if state.get('today_watering_canceled') and state.get('canceled_date'):
+                cur.execute('INSERT OR IGNORE INTO cancellations (date) VALUES (?)', (state['canceled_date'],))
+            count = self._insert_actions(cur, actions)
+            cur.execute(
+                "INSERT INTO meta (key, value) VALUES ('imported', ?)", (datetime.now().isoformat(),)
+            )
+            # Поливы из импортированного журнала уже свернуты при вставке
+            cur.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('usage', ?)", (datetime.now().isoformat(),)
+            )
+        logging.info(f"Конфигурация и журнал импортированы в {self.path}, записей журнала: {count}")
+
+    def merge_config(self, config):
+        # Повторные запуски: устройства и клапаны, которых еще нет в базе, дописываются
+        # из config.json, адреса устройств берутся из файла - в интерфейсе они не
+        # меняются. Остальное в базе не трогаем. Возвращает список изменений.
+        devices = load_devices(config)
+        stored = self.load_devices()
+        known_valves = {number for number, in self._fetch('SELECT number FROM valves')}
+        changes = []
+        with self.transaction() as cur:
+            for name, device in devices.items():
+                if name not in stored:
+                    cur.execute(
+                        'INSERT INTO devices (name, ip, port, capacity) VALUES (?, ?, ?, ?)',
+                        (name, device['ip'], device['port'], device['capacity']),
+                    )
+                    changes.append(f"устройство {name} ({device['ip']}:{device['port']})")
+                elif (stored[name]['ip'], stored[name]['port']) != (device['ip'], device['port']):
+                    cur.execute('UPDATE devices SET ip = ?, port = ? WHERE name = ?', (device['ip'], device['port'], name))
+                    changes.append(f"адрес {name} {device['ip']}:{device['port']}")
+            valves = [row for row in config_valves(config, devices) if row[0] not in known_valves]
+            cur.executemany('INSERT INTO valves (number, name, device, pin, flow) VALUES (?, ?, ?, ?, ?)', valves)
+            changes.extend(f'клапан {number} ({device}, пин {pin})' for number, _, device, pin, _ in valves)
+        return changes
+
+    # Устройства и клапаны
+
+    def load_devices(self):
+        rows = self._fetch('SELECT name, ip, port, capacity FROM devices ORDER BY rowid')
+        return {name: {'ip': ip, 'port': port, 'capacity': capacity} for name, ip, port, capacity in rows}
+
+    def load_valves(self):
+        # (клапан -> (устройство, пин), клапан -> имя)
+        rows = self._fetch('SELECT number, name, device, pin FROM valves ORDER BY number')
+        mapping = {number: (device, pin) for number, _, device, pin in rows}
+        names = {number: name for number, name, _, _ in rows}
+        return mapping, names
+
+    def save_valves(self, valves):
+        # valves: [(номер, имя, устройство, пин)] - только изменившиеся строки
+        if not valves:
+            return
+        with self.transaction() as cur:
+            cur.executemany(
+                'INSERT INTO valves (number, name, device, pin) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (number) DO UPDATE SET name = excluded.name, device = excluded.device, pin = excluded.pin',
+                valves,
+            )
+
+    def load_flows(self):
+        # Клапан -> расход (0 - не задан)
+        return dict(self._fetch('SELECT number, flow FROM valves'))
+
+    def save_flows(self, flows):
+        if not flows:
+            return
+        with self.transaction() as cur:
+            cur.executemany('UPDATE valves SET flow = ? WHERE number = ?', [(f, v) for v, f in flows.items()])
+
+    def save_capacities(self, capacities):
+        # Устройство -> пропускная способность линии (0 - без ограничения)
+        if not capacities:
+            return
+        with self.transaction() as cur:
+            cur.executemany('UPDATE devices SET capacity = ? WHERE name = ?', [(c, d) for d, c in capacities.items()])
+
+    # Расписание
+
+    def load_schedule(self):
+        rows = self._fetch('SELECT id, day, time, duration, valves FROM schedule ORDER BY id')
+        return [
+            {'id': entry_id, 'day': day, 'time': time, 'duration': duration, 'valves': json.loads(valves)}
+            for entry_id, day, time, duration, valves in rows
+        ]
+
+    def add_schedule_entry(self, entry):
+        with self.transaction() as cur:
+            cur.execute(
+                'INSERT INTO schedule (day, time, duration, valves) VALUES (?, ?, ?, ?)',
+                (entry['day'], entry['time'], float(entry['duration']), json.dumps(entry['valves'])),
+            )
+            return cur.lastrowid
+
+    def delete_schedule_entry(self, entry_id):
+        with self.transaction() as cur:
+            cur.execute('DELETE FROM schedule WHERE id = ?', (entry_id,))
+
+    # Отмены полива по датам
+
+    def load_cancellations(self):
+        return {date for (date,) in self._fetch('SELECT date FROM cancellations')}
+
+    def set_canceled(self, date, canceled):
+        with self.transaction() as cur:
+            if canceled:
+                cur.execute('INSERT OR IGNORE INTO cancellations (date) VALUES (?)', (date,))
+            else:
+                cur.execute('DELETE FROM cancellations WHERE date = ?', (date,))
+
+    # Очередь недоставленных команд: по одной последней команде на клапан
+
+    def load_outbox(self):
+        rows = self._fetch(
+            'SELECT valve, action, created, deadline, attempts, next_attempt, error FROM outbox ORDER BY created'
+        )
+        return [
+            {'valve': valve, 'action': action, 'created': created, 'deadline': deadline,
+             'attempts': attempts, 'next_attempt': next_attempt, 'error': error}
+            for valve, action, created, deadline, attempts, next_attempt, error in rows
+        ]
+
+    def put_outbox(self, entries):
+        # Новая команда для клапана заменяет прежнюю недоставленную
+        with self.transaction() as cur:
+            cur.executemany(
+                'INSERT OR REPLACE INTO outbox (valve, action, created, deadline, attempts, next_attempt, error) '
+                'VALUES (:valve, :action, :created, :deadline, :attempts, :next_attempt, :error)',
+                entries,
+            )
+
+    def update_outbox(self, entries):
+        with self.transaction() as cur:
+            cur.executemany(
+                'UPDATE outbox SET attempts = :attempts, next_attempt = :next_attempt, error = :error '
+                'WHERE valve = :valve AND created = :created',
+                entries,
+            )
+
+    def remove_outbox(self, entries):
+        # Удаляются только те команды, которые не успели замениться более новыми
+        with self.transaction() as cur:
+            cur.executemany('DELETE FROM outbox WHERE valve = :valve AND created = :created', entries)
+
+    # Ручные команды, которые важнее расписания до его следующего события
+
+    def load_overrides(self):
+        # клапан -> (включен, время ручной команды)
+        rows = self._fetch('SELECT valve, state, since FROM overrides')
+        return {valve: (bool(state), since) for valve, state, since in rows}
+
+    def set_overrides(self, valves, state, since):
+        with self.transaction() as cur:
+            cur.executemany(
+                'INSERT OR REPLACE INTO overrides (valve, state, since) VALUES (?, ?, ?)',
+                [(valve, int(state), since) for valve in valves],
+            )
+
+    def clear_overrides(self, overrides):
+        # overrides: клапан -> время ручной команды; более новая команда не удаляется
+        with self.transaction() as cur:
+            cur.executemany('DELETE FROM overrides WHERE valve = ? AND since = ?', list(overrides.items()))
+
+    # Журнал действий
+
+    def append_many(self, entries, fsync=False):
+        with self.transaction() as cur:
+            self._insert_actions(cur, entries)
+        if fsync:
+            # Переносим WAL в основной файл базы, например перед остановкой
+            with self._lock:
+                self.conn.execute('PRAGMA wal_checkpoint(FULL)')
+
+    def prune_actions(self, before, batch=PRUNE_BATCH):
+        # Удаляет записи журнала и поливы, закончившиеся до before. Итоги по дням
+        # и неделям остаются. Пачками, чтобы не занимать базу надолго.
+        total = 0
+        while True:
+            with self.transaction() as cur:
+                cur.execute(
+                    'DELETE FROM actions WHERE id IN (SELECT id FROM actions WHERE timestamp < ? LIMIT ?)',
+                    (before.isoformat(), batch),
+                )
+                count = cur.rowcount
+            total += count
+            if count < batch:
+                break
+        with self.transaction() as cur:
+            cur.execute('DELETE FROM runs WHERE ended < ?', (before.isoformat(),))
+        return total
+
+    def query(self, valve=None, action=None, since=None, until=None, offset=0, limit=30, descending=True):
+        # Страница записей журнала, по умолчанию от новых к старым. Возвращает (записи, есть_ли_еще).
+        where, params = self._filters(valve, action, since, until)
+        order = 'DESC' if descending else 'ASC'
+        rows = self._fetch(
+            f'SELECT timestamp, action, valves FROM actions {where} '
+            f'ORDER BY timestamp {order}, id {order} LIMIT ? OFFSET ?',
+            (*params, limit + 1, offset),
+        )
+        entries = [
+            {'timestamp': timestamp, 'action': action, 'valves': json.loads(valves)}
+            for timestamp, action, valves in rows[:limit]
+        ]
+        return entries, len(rows) > limit
+
+    def count(self, valve=None, action=None, since=None, until=None):
+        where, params = self._filters(valve, action, since, until)
+        return self._fetch(f'SELECT COUNT(*) FROM actions {where}', params)[0][0]
+
+    def _filters(self, valve, action, since, until):
+        conditions = []
+        params = []
+        if valve is not None:
+            conditions.append('id IN (SELECT action_id FROM action_valves WHERE valve = ?)')
+            params.append(valve)
+        if action is not None:
+            conditions.append('action = ?')
+            params.append(action)
+        if since is not None:
+            conditions.append('timestamp >= ?')
+            params.append(since.isoformat())
+        if until is not None:
+            conditions.append('timestamp <= ?')
+            params.append(until.isoformat())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return where, params
+
+    def _insert_actions(self, cur, entries):
+        count = 0
+        for entry in entries:
+            cur.execute(
+                'INSERT INTO actions (timestamp, action, valves) VALUES (?, ?, ?)',
+                (entry['timestamp'], entry['action'], json.dumps(entry['valves'])),
+            )
+            action_id = cur.lastrowid
+            cur.executemany(
+                'INSERT INTO action_valves (action_id, valve) VALUES (?, ?)',
+                [(action_id, valve) for valve in entry['valves']],
+            )
+            self._fold_runs(cur, entry, action_id)
+            count += 1
+        return count
+
+    # Поливы и итоги расхода воды по клапанам.
+    # Включение открывает полив, выключение закрывает его и добавляет время в
+    # суточные и недельные итоги - в той же транзакции, что и запись журнала.
+
+    def backfill_usage(self):
+        # Разовый пересчет поливов и итогов по всему журналу, записанному до их появления
+        if self._fetch("SELECT 1 FROM meta WHERE key = 'usage'"):
+            return
+        with self.transaction() as cur:
+            for table in ('open_runs', 'runs', 'usage_daily', 'usage_weekly'):
+                cur.execute(f'DELETE FROM {table}')
+            count = 0
+            rows = self.conn.cursor().execute('SELECT timestamp, action, valves FROM actions ORDER BY timestamp, id')
+            for timestamp, action, valves in rows:
+                self._fold_runs(cur, {'timestamp': timestamp, 'action': action, 'valves': json.loads(valves)})
+                count += 1
+            cur.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('usage', ?)", (datetime.now().isoformat(),))
+        logging.info(f"Итоги полива пересчитаны по журналу, записей: {count}")
+
+    def load_open_runs(self):
+        # клапан -> начало незакрытого полива
+        return {valve: datetime.fromisoformat(started) for valve, started in self._fetch('SELECT valve, started FROM open_runs')}
+
+    def close_interrupted_runs(self, valves, at):
+        # Клапаны закрыты, а выключения в журнале нет (сбой). Полив закрывается
+        # моментом, когда это обнаружено, но не позже MAX_RUN от начала.
+        with self.transaction() as cur:
+            for valve in valves:
+                row = cur.execute('SELECT started FROM open_runs WHERE valve = ?', (valve,)).fetchone()
+                if row is not None:
+                    self._close_run(cur, valve, datetime.fromisoformat(row[0]), at, estimated=True)
+
+    def usage(self, period='day', since=None, until=None):
+        # Итоги по периодам: [(клапан, начало периода, секунды, поливы)].
+        # since и until - даты; для недель это понедельники.
+        table, column = ('usage_weekly', 'week') if period == 'week' else ('usage_daily', 'day')
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append(f'{column} >= ?')
+            params.append(since.isoformat())
+        if until is not None:
+            conditions.append(f'{column} <= ?')
+            params.append(until.isoformat())
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self._fetch(f'SELECT valve, {column}, seconds, runs FROM {table} {where} ORDER BY {column}, valve', params)
+
+    def _fold_runs(self, cur, entry, action_id=None):
+        # action_id - запись уже в журнале; тогда проверяем, не пришла ли она позже
+        # более новых записей (отчеты плат читаются с опозданием)
+        try:
+            at = datetime.fromisoformat(entry['timestamp'])
+        except (TypeError, ValueError):
+            return
+        for valve in entry['valves']:
+            row = cur.execute('SELECT started FROM open_runs WHERE valve = ?', (valve,)).fetchone()
+            started = datetime.fromisoformat(row[0]) if row is not None else None
+            later = self._next_action(cur, valve, entry['timestamp'], action_id) if action_id is not None else None
+            if later is not None:
+                self._fold_late(cur, valve, entry['action'], at, started, *later)
+            elif entry['action'] == 'on':
+                if started is not None and (at - started).total_seconds() <= MAX_RUN:
+                    # Повторное включение открытого клапана (например, сверкой) продолжает полив
+                    continue
+                if started is not None:
+                    self._close_run(cur, valve, started, at, estimated=True)
+                cur.execute('INSERT INTO open_runs (valve, started) VALUES (?, ?)', (valve, at.isoformat()))
+            elif entry['action'] == 'off' and started is not None:
+                self._close_run(cur, valve, started, at)
+
+    def _next_action(self, cur, valve, timestamp, action_id):
+        # (время, действие) ближайшей более поздней записи журнала для клапана или None
+        row = cur.execute(
+            'SELECT a.timestamp, a.action FROM actions a JOIN action_valves v ON v.action_id = a.id '
+            'WHERE a.timestamp > ? AND a.id != ? AND v.valve = ? ORDER BY a.timestamp, a.id LIMIT 1',
+            (timestamp, action_id, valve),
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return datetime.fromisoformat(row[0]), row[1]
+        except ValueError:
+            return None
+
+    def _fold_late(self, cur, valve, action, at, started, next_at, next_action):
+        # Запись старше уже учтенных: встраиваем ее между соседними по времени
+        if action == 'on':
+            if next_action == 'on' and started is not None and started >= at:
+                # Полив на самом деле начался раньше
+                cur.execute('UPDATE open_runs SET started = ? WHERE valve = ?', (at.isoformat(), valve))
+            elif next_action == 'off' and (started is None or started > next_at):
+                covered = cur.execute(
+                    'SELECT 1 FROM runs WHERE valve = ? AND started <= ? AND ended >= ?',
+                    (valve, at.isoformat(), next_at.isoformat()),
+                ).fetchone()
+                if covered is None:
+                    # Выключение уже записано, а включения перед ним не было
+                    self._close_run(cur, valve, at, next_at, keep_open=True)
+        elif started is not None and started < at:
+            # Выключение внутри открытого полива; если после него клапан включали
+            # снова, новый полив начинается с того включения
+            self._close_run(cur, valve, started, at)
+            if next_action == 'on':
+                cur.execute('INSERT INTO open_runs (valve, started) VALUES (?, ?)', (valve, next_at.isoformat()))
+        else:
+            # Выключение внутри уже закрытого полива: он заканчивается этим выключением,
+            # а если клапан потом включали снова - продолжается с того включения
+            row = cur.execute(
+                'SELECT id, started, ended, estimated FROM runs WHERE valve = ? AND started < ? AND ended > ? '
+                'ORDER BY started DESC LIMIT 1',
+                (valve, at.isoformat(), at.isoformat()),
+            ).fetchone()
+            if row is None:
+                return
+            run_started, run_ended = datetime.fromisoformat(row[1]), datetime.fromisoformat(row[2])
+            self._drop_run(cur, valve, row[0], run_started, run_ended)
+            self._close_run(cur, valve, run_started, at, keep_open=True)
+            if next_action == 'on' and next_at < run_ended:
+                self._close_run(cur, valve, next_at, run_ended, estimated=bool(row[3]), keep_open=True)
+
+    def _drop_run(self, cur, valve, run_id, started, ended):
+        # Убирает полив вместе с его вкладом в суточные и недельные итоги
+        cur.execute('DELETE FROM runs WHERE id = ?', (run_id,))
+        daily, weekly = rollup(started, ended)
+        for table, column, totals in (('usage_daily', 'day', daily), ('usage_weekly', 'week', weekly)):
+            cur.executemany(
+                f'UPDATE {table} SET seconds = seconds - ?, runs = runs - ? WHERE {column} = ? AND valve = ?',
+                [(seconds, runs, key.isoformat(), valve) for key, (seconds, runs) in totals.items()],
+            )
+            cur.execute(f'DELETE FROM {table} WHERE valve = ? AND runs <= 0 AND seconds < 0.001', (valve,))
+
+    def _close_run(self, cur, valve, started, ended, estimated=False, keep_open=False):
+        limit = started + timedelta(seconds=MAX_RUN)
+        if ended > limit:
+            ended, estimated = limit, True
+        ended = max(ended, started)
+        if not keep_open:
+            cur.execute('DELETE FROM open_runs WHERE valve = ?', (valve,))
+        cur.execute(
+            'INSERT INTO runs (valve, started, ended, seconds, estimated) VALUES (?, ?, ?, ?, ?)',
+            (valve, started.isoformat(), ended.isoformat(), (ended - started).total_seconds(), int(estimated)),
+        )
+        daily, weekly = rollup(started, ended)
+        cur.executemany(
+            'INSERT INTO usage_daily (valve, day, seconds, runs) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (day, valve) DO UPDATE SET seconds = seconds + excluded.seconds, runs = runs + excluded.runs',
+            [(valve, day.isoformat(), seconds, runs) for day, (seconds, runs) in daily.items()],
+        )
+        cur.executemany(
+            'INSERT INTO usage_weekly (valve, week, seconds, runs) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (week, valve) DO UPDATE SET seconds = seconds + excluded.seconds, runs = runs + excluded.runs',
+            [(valve, week.isoformat(), seconds, runs) for week, (seconds, runs) in weekly.items()],
+        )
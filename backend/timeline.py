@@ -0,0 +1,259 @@
+import bisect
+import logging
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from apscheduler.triggers.date import DateTrigger
+
+DAY_SECONDS = 24 * 3600
+WEEK_SECONDS = 7 * DAY_SECONDS
+
+# Соответствие дня недели числу (Понедельник=0)
+days_mapping = {
+    'Понедельник': 0, 'Вторник': 1, 'Среда': 2, 'Четверг': 3,
+    'Пятница': 4, 'Суббота': 5, 'Воскресенье': 6,
+}
+
+# Событие недельного расписания: секунда от начала недели и множества
+# включаемых и выключаемых в этот момент клапанов
+Event = namedtuple('Event', ['second', 'on', 'off'])
+
+
+def parse_time(time_str):
+    # "HH:MM" или "HH:MM:SS" -> секунды от начала суток
+    parts = [int(p) for p in time_str.split(':')]
+    hour, minute = parts[0], parts[1]
+    second = parts[2] if len(parts) > 2 else 0
+    return hour * 3600 + minute * 60 + second
+
+
+def entry_sort_key(entry):
+    # Порядок записей расписания в таблице: день недели, время, порядок добавления
+    try:
+        second = parse_time(entry['time'])
+    except (ValueError, IndexError):
+        second = 0
+    return days_mapping.get(entry['day'], 7), second, entry.get('id', 0)
+
+
+def entry_runs(entry):
+    # Запись расписания -> [(клапан, начало, конец)] в секундах от начала недели.
+    # Конец может выходить за пределы недели, если полив переходит через полночь воскресенья.
+    day_of_week = days_mapping.get(entry['day'])
+    if day_of_week is None:
+        logging.warning(f"Некорректный день недели: {entry['day']}")
+        return []
+    start = day_of_week * DAY_SECONDS + parse_time(entry['time'])
+    length = round(float(entry['duration']) * 60)
+    if length <= 0:
+        return []
+    return [(int(valve), start, start + length) for valve in entry['valves']]
+
+
+def merge_runs(runs):
+    # Объединяет пересекающиеся и смежные поливы одного клапана с учетом
+    # перехода через конец недели. Возвращает (интервалы, пересечения).
+    runs = sorted(runs)
+    merged = []
+    overlaps = []
+    for start, end in runs:
+        if merged and start <= merged[-1][1]:
+            if start < merged[-1][1]:
+                overlaps.append(start)
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    # Последний интервал может заходить на начало следующей недели
+    while len(merged) > 1 and merged[-1][1] >= merged[0][0] + WEEK_SECONDS:
+        first = merged.pop(0)
+        if merged[-1][1] > first[0] + WEEK_SECONDS:
+            overlaps.append(first[0])
+        merged[-1][1] = max(merged[-1][1], first[1] + WEEK_SECONDS)
+    return [tuple(interval) for interval in merged], overlaps
+
+
+def compile_timeline(schedule, sequencer=None):
+    # sequencer (см. sequencer.py) сдвигает поливы, которые вместе превысили бы
+    # пропускную способность линии. Сдвиги сохраняются в Timeline.shifts.
+    runs_by_valve = {}
+    for entry in schedule:
+        for valve, start, end in entry_runs(entry):
+            runs_by_valve.setdefault(valve, []).append((start, end))
+
+    intervals_by_valve = {}
+    overlaps = []
+    for valve, runs in runs_by_valve.items():
+        intervals, valve_overlaps = merge_runs(runs)
+        overlaps.extend((valve, second % WEEK_SECONDS) for second in valve_overlaps)
+        intervals_by_valve[valve] = intervals
+    shifts = []
+    if sequencer is not None:
+        intervals_by_valve, shifts = sequencer.plan(intervals_by_valve)
+        # Сдвинутые поливы одного клапана могут сомкнуться на стыке недель
+        intervals_by_valve = {valve: merge_runs(intervals)[0] for valve, intervals in intervals_by_valve.items()}
+
+    on_at = {}
+    off_at = {}
+    initial = set()
+    week_intervals = {}
+    for valve, intervals in intervals_by_valve.items():
+        for start, end in intervals:
+            if end - start >= WEEK_SECONDS:
+                # Клапан открыт всю неделю
+                initial.add(valve)
+                week_intervals.setdefault(valve, []).append((0, WEEK_SECONDS))
+                continue
+            # Сдвинутый полив может начаться уже на следующей неделе
+            end -= start - start % WEEK_SECONDS
+            start %= WEEK_SECONDS
+            week_intervals.setdefault(valve, []).append((start, end))
+            on_at.setdefault(start, set()).add(valve)
+            off_at.setdefault(end % WEEK_SECONDS, set()).add(valve)
+            if end > WEEK_SECONDS:
+                initial.add(valve)
+
+    events = [
+        Event(second, frozenset(on_at.get(second, ())), frozenset(off_at.get(second, ())))
+        for second in sorted(on_at.keys() | off_at.keys())
+    ]
+    return Timeline(events, initial, sorted(overlaps, key=lambda o: (o[1], o[0])), shifts, week_intervals)
+
+
+def week_start(dt):
+    return datetime.combine(dt.date() - timedelta(days=dt.weekday()), datetime.min.time())
+
+
+class Timeline:
+    # Скомпилированное недельное расписание: отсортированные события с точностью
+    # до секунды. Поиск следующего события - бинарный поиск по секундам недели.
+
+    def __init__(self, events, initial=(), overlaps=(), shifts=(), intervals=None):
+        self.events = events
+        self.seconds = [event.second for event in events]
+        self.overlaps = list(overlaps)
+        # Поливы, сдвинутые из-за ограничения расхода: (клапан, запрошено, начало, конец)
+        self.shifts = list(shifts)
+        # Клапан -> [(начало, конец)], начало в пределах недели - для расписания на платах
+        self.intervals = intervals or {}
+        # Множество открытых клапанов после каждого события
+        self._active = []
+        active = set(initial)
+        for event in events:
+            active = (active - event.off) | event.on
+            self._active.append(frozenset(active))
+        self._initial = frozenset(initial)
+
+    def iter_events(self, after):
+        # События строго после момента after, по порядку, без ограничения по времени
+        if not self.events:
+            return
+        start = week_start(after)
+        position = (after - start).total_seconds()
+        index = bisect.bisect_right(self.seconds, position)
+        while True:
+            if index == len(self.events):
+                index = 0
+                start += timedelta(days=7)
+            event = self.events[index]
+            yield start + timedelta(seconds=event.second), event
+            index += 1
+
+    def next_event(self, after):
+        return next(self.iter_events(after), None)
+
+    def events_between(self, start, end):
+        # События в интервале (start, end]
+        result = []
+        for when, event in self.iter_events(start):
+            if when > end:
+                break
+            result.append((when, event))
+        return result
+
+    def active_at(self, dt):
+        # Клапаны, которые по расписанию должны быть открыты в момент dt
+        if not self.events:
+            return set(self._initial)
+        position = (dt - week_start(dt)).total_seconds()
+        index = bisect.bisect_right(self.seconds, position) - 1
+        return set(self._active[index])
+
+    def active_runs(self, dt):
+        # Открытые в момент dt клапаны и время начала их текущего полива.
+        # Ищем назад от dt последнее включение каждого открытого клапана.
+        active = self.active_at(dt)
+        runs = {}
+        if not active:
+            return runs
+        start = week_start(dt)
+        index = bisect.bisect_right(self.seconds, (dt - start).total_seconds()) - 1
+        for _ in range(len(self.events)):
+            if index < 0:
+                index = len(self.events) - 1
+                start -= timedelta(days=7)
+            event = self.events[index]
+            for valve in event.on & active:
+                runs.setdefault(valve, start + timedelta(seconds=event.second))
+            if len(runs) == len(active):
+                break
+            index -= 1
+        return runs
+
+
+class Dispatcher:
+    # Единственный исполнитель расписания. Не зависит от часов: вызывающий код
+    # сообщает текущее время, а диспетчер выполняет все события, наступившие с
+    # прошлого запуска, и возвращает время следующего.
+
+    def __init__(self, timeline, execute, is_canceled=None, now=None, job_id='dispatcher'):
+        self.timeline = timeline
+        self.execute = execute
+        self.is_canceled = is_canceled
+        self.last_run = now or datetime.now()
+        self.job_id = job_id
+        self.scheduler = None
+
+    def set_timeline(self, timeline):
+        self.timeline = timeline
+
+    def next_time(self):
+        event = self.timeline.next_event(self.last_run)
+        return event[0] if event else None
+
+    async def run_due(self, now):
+        for when, event in self.timeline.events_between(self.last_run, now):
+            on = event.on
+            if on and self.is_canceled is not None and self.is_canceled(when.date()):
+                # Отмена полива - исключение по дате: пропускаем только включение,
+                # выключение выполняется всегда
+                logging.info(f"Полив на {when.date().isoformat()} отменен, пропускаем включение клапанов: {sorted(on)}")
+                on = frozenset()
+            if on or event.off:
+                await self.execute(when, sorted(on), sorted(event.off))
+        self.last_run = max(self.last_run, now)
+        return self.next_time()
+
+    def attach(self, scheduler):
+        # Исполнение по реальным часам: в планировщике APScheduler всегда одно
+        # задание на время ближайшего события
+        self.scheduler = scheduler
+        self.arm()
+
+    def arm(self):
+        if self.scheduler is None:
+            return
+        next_time = self.next_time()
+        if next_time is None:
+            if self.scheduler.get_job(self.job_id):
+                self.scheduler.remove_job(self.job_id)
+            return
+        self.scheduler.add_job(
+            self._fire, trigger=DateTrigger(run_date=next_time), id=self.job_id,
+            replace_existing=True, misfire_grace_time=None,
+        )
+
+    async def _fire(self):
+        try:
+            await self.run_due(datetime.now())
+        finally:
+            self.arm()
@@ -0,0 +1,37 @@
+from datetime import datetime, timedelta
+
+# Полив дольше этого считается оборвавшимся: выключение потерялось при сбое.
+# Такой полив закрывается через MAX_RUN секунд после начала и помечается оценочным.
+MAX_RUN = 6 * 3600
+
+
+def week_of(day):
+    # Понедельник недели, в которую попадает дата
+    return day - timedelta(days=day.weekday())
+
+
+def split_by_day(started, ended):
+    # Полив -> [(дата, секунды)] с разбиением по полуночи
+    pieces = []
+    while started < ended:
+        midnight = datetime.combine(started.date() + timedelta(days=1), datetime.min.time())
+        end = min(ended, midnight)
+        pieces.append((started.date(), (end - started).total_seconds()))
+        started = end
+    return pieces
+
+
+def rollup(started, ended):
+    # Вклад полива в суточные и недельные итоги: ({дата: (секунды, поливы)}, {неделя: (секунды, поливы)}).
+    # Полив засчитывается дню и неделе, в которые он начался, время - по дням фактически.
+    if ended <= started:
+        return {started.date(): (0.0, 1)}, {week_of(started.date()): (0.0, 1)}
+    daily = {}
+    weekly = {}
+    for day, seconds in split_by_day(started, ended):
+        first = int(day == started.date())
+        daily[day] = (seconds, first)
+        week = week_of(day)
+        total, runs = weekly.get(week, (0.0, 0))
+        weekly[week] = (total + seconds, runs + first)
+    return daily, weekly
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+
+from metrics import Gauge, Histogram
+
+# Интервал опроса устройств и время, после которого состояние считается устаревшим (секунды)
+POLL_INTERVAL = 10.0
+STATE_TTL = 30.0
+
+REFRESH_DURATION = Histogram('watering_status_poll_duration_seconds', 'Время опроса состояния всех устройств')
+STATE_AGE = Gauge('watering_valve_state_age_seconds', 'Возраст последнего подтвержденного состояния клапана', ['valve'])
+
+
+class ValveStateCache:
+    # Общий кэш состояния клапанов.
+    # Один фоновый опросчик обновляет кэш раз в interval секунд, а все открытые
+    # страницы подписываются на изменения и получают их рассылкой. Загрузка
+    # страницы и команды из интерфейса читают кэш и не обращаются к устройству.
+
+    def __init__(self, fetch, interval=POLL_INTERVAL, ttl=STATE_TTL):
+        self.fetch = fetch
+        self.interval = interval
+        self.ttl = ttl
+        self.states = {}
+        self.updated = {}
+        self._stale = True
+        self._subscribers = []
+        self._wakeup = asyncio.Event()
+        self._task = None
+        STATE_AGE.set_function(lambda: {(str(valve),): self.age(valve) for valve in self.updated})
+
+    def get(self, valve, default=False):
+        return self.states.get(valve, default)
+
+    def age(self, valve):
+        updated = self.updated.get(valve)
+        return None if updated is None else time.monotonic() - updated
+
+    def is_stale(self, valve=None):
+        if valve is None:
+            return not self.updated or any(self.is_stale(v) for v in self.updated)
+        age = self.age(valve)
+        return age is None or age > self.ttl
+
+    def subscribe(self, callback):
+        # callback(changes) вызывается с изменившимися клапанами {номер: включен}.
+        # Возвращает функцию для отписки.
+        self._subscribers.append(callback)
+        return lambda: self._subscribers.remove(callback) if callback in self._subscribers else None
+
+    def update(self, states, since=None):
+        # Применяет подтвержденное состояние клапанов и рассылает изменения.
+        # since - время начала опроса: более свежее состояние, полученное от
+        # команды, пока шел опрос, ответом опроса не перезаписывается.
+        now = time.monotonic()
+        changes = {}
+        for valve, value in states.items():
+            if since is not None and self.updated.get(valve, since) > since:
+                continue
+            if self.states.get(valve) != value:
+                changes[valve] = value
+            self.states[valve] = value
+            self.updated[valve] = now
+        stale = self.is_stale()
+        if changes or stale != self._stale:
+            self._stale = stale
+            self._broadcast(changes)
+
+    async def refresh(self):
+        # Клапаны недоступных устройств в ответ не попадают и со временем устаревают
+        started = time.monotonic()
+        with REFRESH_DURATION.time():
+            states = await self.fetch()
+        self.update(states, since=started)
+
+    def request_refresh(self):
+        # Внеочередной опрос, не дожидаясь интервала. Запросы, пришедшие до его
+        # начала, объединяются в один опрос.
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error(f"Ошибка при опросе состояния клапанов: {e}")
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _broadcast(self, changes):
+        for callback in list(self._subscribers):
+            try:
+                callback(changes)
+            except Exception as e:
+                logging.error(f"Ошибка при обновлении подписчика состояния клапанов: {e}")
@@ -1,7 +1,8 @@
 import time
-import socket
 import network
-from machine import Timer, Pin, WDT
+import ntptime
+import uasyncio as asyncio
+from machine import Pin, RTC, Timer, WDT
 
 
 WIFI_NETWORK = "milkyway"
@@ -9,6 +10,56 @@ WIFI_PASSWORD = "qwertyuiop123"
 
 STA_IF = network.WLAN(network.STA_IF)
 
+RELAY_PINS = (12, 13, 14, 16)
+PINS_MASK = sum(1 << pin_number for pin_number in RELAY_PINS)
+SERVER_PORT = 8080
+# Старшая поддерживаемая версия протокола, см. handle_frame
+PROTOCOL_VERSION = 3
+# Соединение без команд дольше этого времени закрывается (секунды)
+READ_TIMEOUT = 60
+# Ограничение одновременных соединений, чтобы не закончилась память
+MAX_CLIENTS = 4
+WIFI_CHECK_PERIOD = 60
+WDT_FEED_PERIOD = 1
+NTP_PERIOD = 3600
+# Локальное расписание: файл, период проверки (секунды), длина недели
+SCHEDULE_FILE = "schedule.txt"
+SCHEDULE_PERIOD = 1
+WEEK = 7 * 86400
+# Пин не может быть включен дольше (секунды), если сервер не задал свой предел
+MAX_ON_DEFAULT = 3 * 3600
+MAX_ON_CHECK_MS = 1000
+# Время сервера ставится, только если часы платы ушли дальше (секунды)
+CLOCK_TOLERANCE = 2
+REPORTS_KEPT = 50
+REPORTS_PER_REPLY = 8
+# Разница между эпохой Unix и эпохой часов платы (у ESP8266 - 2000 год)
+EPOCH_OFFSET = 946684800 if time.localtime(0)[0] == 2000 else 0
+
+pins = {}
+clients = 0
+# Когда включен каждый пин (ticks_ms) - для ограничения времени включения
+on_since = {}
+# Расписание с сервера: версия и набор элементов, см. apply_schedule
+schedule_version = "0"
+schedule_tokens = set()
+runs = []
+canceled = set()
+max_on = {}
+tz_offset = 0
+scheduled = 0
+# Отчеты о том, что плата сделала сама: (номер, время Unix, включено, выключено, источник)
+reports = []
+report_seq = 0
+
+
+def get_pin(pin_number):
+    pin = pins.get(pin_number)
+    if pin is None:
+        pin = Pin(pin_number, Pin.OUT)
+        pins[pin_number] = pin
+    return pin
+
 
 def connect_to_wifi(ssid, password):
     print("Connecting to WiFi")
@@ -26,87 +77,365 @@ def connect_to_wifi(ssid, password):
         return False
 
 
-def check_connection():
-    print("Checking connection")
-    if not STA_IF.isconnected():
+async def check_connection():
+    # Проверка Wi-Fi в том же цикле событий, без блокирующего ожидания
+    while True:
+        await asyncio.sleep(WIFI_CHECK_PERIOD)
+        if STA_IF.isconnected():
+            continue
         print("!!! Not connected to WiFi")
-        connect_to_wifi(WIFI_NETWORK, WIFI_PASSWORD)
+        STA_IF.connect(WIFI_NETWORK, WIFI_PASSWORD)
+        for _ in range(30):
+            if STA_IF.isconnected():
+                print("Connected to WiFi")
+                break
+            await asyncio.sleep(1)
+
+
+def pin_on(pin_number):
+    get_pin(pin_number).on()
+    if pin_number not in on_since:
+        on_since[pin_number] = time.ticks_ms()
 
 
-def check_wifi_connect_regularly():
-    print("Add task to check wifi connection regularly")
-    timer = Timer(-1)
-    timer.init(period=60000, mode=Timer.PERIODIC, callback=check_connection)
+def pin_off(pin_number):
+    get_pin(pin_number).off()
+    on_since.pop(pin_number, None)
 
 
 def disable_pins():
-    for pin_number in (12, 13, 14, 16):
-        pin = Pin(pin_number, Pin.OUT)
-        pin.off()
+    for pin_number in RELAY_PINS:
+        pin_off(pin_number)
 
 
-def feed_wdt(z):
-    WDT().feed()
+async def feed_wdt(wdt):
+    # Сторожевой таймер кормится из цикла событий: если цикл зависнет, плата перезагрузится
+    while True:
+        wdt.feed()
+        await asyncio.sleep(WDT_FEED_PERIOD)
 
 
-def enable_wdt():
-    tim1 = Timer(-1)
-    tim1.init(period=1000, mode=Timer.PERIODIC, callback=feed_wdt)
+def check_max_on(timer=None):
+    # Аппаратный таймер рядом со сторожевым: пин, включенный дольше предела,
+    # выключается, даже если команда выключения не дошла
+    now = time.ticks_ms()
+    expired = 0
+    for pin_number, since in on_since.items():
+        if time.ticks_diff(now, since) > max_on.get(pin_number, MAX_ON_DEFAULT) * 1000:
+            expired |= 1 << pin_number
+    if expired:
+        for pin_number in RELAY_PINS:
+            if expired >> pin_number & 1:
+                pin_off(pin_number)
+        add_report(0, expired, "f")
 
 
-def start_socket_server():
-    # format: on|off pin_number,pin_number
-    print("Start socket server")
-    s = socket.socket()
-    ai = socket.getaddrinfo("0.0.0.0", 8080)
-    addr = ai[0][-1]
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind(addr)
-    s.listen(5)
+def set_pins(on_mask, off_mask):
+    # Сначала включение, затем выключение: пин из обеих масок остается выключенным
+    for pin_number in RELAY_PINS:
+        if on_mask >> pin_number & 1:
+            pin_on(pin_number)
+    for pin_number in RELAY_PINS:
+        if off_mask >> pin_number & 1:
+            pin_off(pin_number)
+
+
+def add_report(on_mask, off_mask, source):
+    global report_seq
+    report_seq += 1
+    reports.append((report_seq, time.time() + EPOCH_OFFSET, on_mask, off_mask, source))
+    if len(reports) > REPORTS_KEPT:
+        reports.pop(0)
+
+
+def clock_valid():
+    # Часы выставлены по NTP или сервером (после перезагрузки они идут с 2000 года)
+    return time.localtime()[0] >= 2024
+
+
+def set_clock(unix_time):
+    now = unix_time - EPOCH_OFFSET
+    if abs(now - time.time()) <= CLOCK_TOLERANCE:
+        return
+    t = time.localtime(now)
+    RTC().datetime((t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0))
+
+
+async def sync_ntp():
+    while True:
+        try:
+            ntptime.settime()
+        except Exception as e:
+            print("!!! NTP failed:", e)
+        await asyncio.sleep(NTP_PERIOD)
+
+
+def apply_schedule(tokens):
+    # Элементы расписания (шестнадцатеричные числа):
+    #   r<начало>,<длительность>,<маска пинов> - полив, начало в секундах от понедельника 00:00
+    #   x<ГГГГММДД> - дата (десятичная), на которую полив отменен
+    #   m<пин>,<секунды> - предел времени включения пина
+    #   z<смещение> - смещение местного времени от UTC в секундах (десятичное, со знаком)
+    global tz_offset
+    new_runs = []
+    new_canceled = set()
+    new_max_on = {}
+    new_tz = 0
+    for token in tokens:
+        kind, value = token[0], token[1:]
+        if kind == "r":
+            start, length, mask = (int(part, 16) for part in value.split(","))
+            new_runs.append((start, length, mask & PINS_MASK))
+        elif kind == "x":
+            new_canceled.add(int(value))
+        elif kind == "m":
+            pin_number, seconds = (int(part, 16) for part in value.split(","))
+            new_max_on[pin_number] = seconds
+        elif kind == "z":
+            new_tz = int(value)
+    runs[:] = new_runs
+    canceled.clear()
+    canceled.update(new_canceled)
+    max_on.clear()
+    max_on.update(new_max_on)
+    tz_offset = new_tz
 
+
+def load_schedule():
+    global schedule_version
+    try:
+        with open(SCHEDULE_FILE) as f:
+            lines = [line.strip() for line in f]
+    except OSError:
+        return
+    if not lines:
+        return
+    # Промежуточную версию (с точкой) сервер не дописал: хранить храним, но не
+    # выполняем, как и в handle_schedule
+    if "." not in lines[0]:
+        try:
+            apply_schedule(lines[1:])
+        except ValueError:
+            print("!!! Invalid schedule file")
+            return
+    schedule_version = lines[0]
+    schedule_tokens.update(lines[1:])
+
+
+def save_schedule():
+    with open(SCHEDULE_FILE, "w") as f:
+        f.write(schedule_version + "\n")
+        for token in schedule_tokens:
+            f.write(token + "\n")
+
+
+def scheduled_mask():
+    # Пины, которые по расписанию должны быть включены сейчас. Полив, начавшийся
+    # в отмененный день, не в счет - как у диспетчера на сервере.
+    local = time.time() + tz_offset
+    t = time.localtime(local)
+    position = t[6] * 86400 + t[3] * 3600 + t[4] * 60 + t[5]
+    mask = 0
+    for start, length, run_mask in runs:
+        elapsed = (position - start) % WEEK
+        if elapsed >= length:
+            continue
+        if canceled:
+            started = time.localtime(local - elapsed)
+            if started[0] * 10000 + started[1] * 100 + started[2] in canceled:
+                continue
+        mask |= run_mask
+    return mask
+
+
+async def run_schedule():
+    # Поливы выполняются по часам платы: команды сервера для этого не нужны.
+    # Пины переключаются только при смене состояния по расписанию, поэтому
+    # ручные команды между событиями расписания не перебиваются.
+    global scheduled
     while True:
-        print("While loop")
-        conn, addr = s.accept()
-        print("Got a connection from %s" % str(addr))
-        request = conn.recv(1024).decode()
-        print('Content = "%s"' % request)
+        if clock_valid():
+            mask = scheduled_mask()
+            on_mask = mask & ~scheduled
+            off_mask = scheduled & ~mask
+            if on_mask or off_mask:
+                set_pins(on_mask, off_mask)
+                add_report(on_mask, off_mask, "s")
+            scheduled = mask
+        await asyncio.sleep(SCHEDULE_PERIOD)
+
+
+def handle_schedule(request_id, d):
+    # <id> sched - версия и число элементов
+    # <id> sched clear <версия> - удалить все элементы
+    # <id> sched <база> <версия> +элемент -элемент ... - изменения, если текущая версия равна базе
+    # Версия с точкой - промежуточная (доставка частями): набор запоминается, а
+    # к реле применяется только после последней части
+    global schedule_version
+    if len(d) == 2:
+        return "%s ok %s %d" % (request_id, schedule_version, len(schedule_tokens))
+    if d[2] == "clear" and len(d) == 4:
+        tokens = set()
+        version = d[3]
+    elif len(d) >= 4:
+        if d[2] != schedule_version:
+            return request_id + " err version"
+        tokens = set(schedule_tokens)
+        for change in d[4:]:
+            if change[0] == "+":
+                tokens.add(change[1:])
+            elif change[0] == "-":
+                tokens.discard(change[1:])
+        version = d[3]
+    else:
+        return request_id + " err request"
+    if "." not in version:
+        try:
+            apply_schedule(tokens)
+        except (ValueError, IndexError):
+            # Разбор идет до замены, поэтому действующее расписание не меняется
+            return request_id + " err schedule"
+    schedule_tokens.clear()
+    schedule_tokens.update(tokens)
+    schedule_version = version
+    save_schedule()
+    return request_id + " ok"
+
+
+def handle_report(request_id, d):
+    # <id> report <после номера> -> <id> ok <последний номер> номер,время,включено,выключено,источник ...
+    after = int(d[2]) if len(d) > 2 else 0
+    entries = [entry for entry in reports if entry[0] > after][:REPORTS_PER_REPLY]
+    return "%s ok %d %s" % (
+        request_id, report_seq, " ".join("%d,%d,%x,%x,%s" % entry for entry in entries),
+    )
 
-        d = request.split()
-        response = ""
 
-        if len(d) == 2:
-            action = d[0].strip()
-            pins = d[1].split(',')
+def status_mask():
+    values = 0
+    for pin_number in RELAY_PINS:
+        if get_pin(pin_number).value():
+            values |= 1 << pin_number
+    return values
 
-            if action not in ["on", "off"]:
-                response = "Invalid action"
+
+def handle_request(request):
+    # Протокол 1, format: on|off pin_number,pin_number | status | uptime
+    d = request.split()
+
+    if len(d) == 2:
+        action = d[0].strip()
+        if action not in ["on", "off"]:
+            return "Invalid action"
+        try:
+            pin_numbers = [int(pin_number) for pin_number in d[1].split(',')]
+        except ValueError:
+            return "Invalid request"
+        for pin_number in pin_numbers:
+            if action == "on":
+                pin_on(pin_number)
             else:
-                for pin_number in pins:
-                    pin = Pin(int(pin_number), Pin.OUT)
-                    if action == "on":
-                        pin.on()
-                    elif action == "off":
-                        pin.off()
-                response = "Done"
-        elif len(d) == 1:
-            action = d[0].strip()
-            if action == "uptime":
-                response = str(time.time())
-            elif action == "status":
-                response = ""
-                for pin_number in (12, 13, 14, 16):
-                    pin = Pin(pin_number)
-                    response += f"{pin_number}={pin.value()};"
+                pin_off(pin_number)
+        return "Done"
+    elif len(d) == 1:
+        action = d[0].strip()
+        if action == "uptime":
+            return str(time.time())
+        elif action == "status":
+            return "".join("%d=%d;" % (pin_number, get_pin(pin_number).value()) for pin_number in RELAY_PINS)
+    return "Invalid request"
+
+
+def handle_frame(request):
+    # Протокол 2, format: <id> set <on_mask> <off_mask> | <id> status | <id> uptime
+    # Маски шестнадцатеричные, бит N соответствует пину N.
+    # Протокол 3 добавляет локальное расписание: <id> sched ..., <id> clock <время Unix>,
+    # <id> report <номер>.
+    # Ответ: <id> ok [данные] | <id> err <причина>
+    d = request.split()
+    request_id = d[0]
+    command = d[1] if len(d) > 1 else ""
+    if command == "set" and len(d) == 4:
+        try:
+            on_mask, off_mask = int(d[2], 16), int(d[3], 16)
+        except ValueError:
+            return request_id + " err mask"
+        if (on_mask | off_mask) & ~PINS_MASK:
+            return request_id + " err pin"
+        set_pins(on_mask, off_mask)
+        return request_id + " ok"
+    elif command == "status" and len(d) == 2:
+        return "%s ok %x %x" % (request_id, status_mask(), PINS_MASK)
+    elif command == "uptime" and len(d) == 2:
+        return "%s ok %d" % (request_id, time.time())
+    elif command == "sched":
+        return handle_schedule(request_id, d)
+    elif command == "clock" and len(d) == 3:
+        try:
+            set_clock(int(d[2]))
+        except ValueError:
+            return request_id + " err clock"
+        return request_id + " ok"
+    elif command == "report":
+        try:
+            return handle_report(request_id, d)
+        except ValueError:
+            return request_id + " err request"
+    return request_id + " err request"
+
+
+async def handle_client(reader, writer):
+    # Одно соединение обслуживает любое число команд, по одной на строку.
+    # Молчащий или полуоткрытый клиент отключается по READ_TIMEOUT и не мешает остальным.
+    # После "hello 2" соединение переходит на кадры протокола 2.
+    global clients
+    if clients >= MAX_CLIENTS:
+        writer.close()
+        await writer.wait_closed()
+        return
+    clients += 1
+    version = 1
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), READ_TIMEOUT)
+            if not line:
+                break
+            request = line.decode().strip()
+            if not request:
+                continue
+            if request.startswith("hello "):
+                try:
+                    version = min(int(request[6:]), PROTOCOL_VERSION)
+                except ValueError:
+                    version = 1
+                response = "hello %d" % PROTOCOL_VERSION
+            elif version >= 2:
+                response = handle_frame(request)
             else:
-                response = "Invalid request"
-        else:
-            response = "Invalid request"
-        conn.sendall(response)
-        conn.close()
+                response = handle_request(request)
+            writer.write((response + "\n").encode())
+            await writer.drain()
+    except (asyncio.TimeoutError, OSError):
+        pass
+    finally:
+        clients -= 1
+        writer.close()
+        await writer.wait_closed()
+
+
+async def main():
+    asyncio.create_task(feed_wdt(WDT()))
+    Timer(-1).init(period=MAX_ON_CHECK_MS, mode=Timer.PERIODIC, callback=check_max_on)
+    asyncio.create_task(check_connection())
+    asyncio.create_task(sync_ntp())
+    asyncio.create_task(run_schedule())
+    print("Start socket server")
+    await asyncio.start_server(handle_client, "0.0.0.0", SERVER_PORT, backlog=5)
+    while True:
+        await asyncio.sleep(3600)
 
 
 disable_pins()
+load_schedule()
 connect_to_wifi(WIFI_NETWORK, WIFI_PASSWORD)
-# check_wifi_connect_regularly()
-enable_wdt()
-start_socket_server()
+asyncio.run(main())
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули бэкенда лежат плоско в backend/ и импортируются друг другом по имени
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend'))
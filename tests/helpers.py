@@ -0,0 +1,11 @@
+import asyncio
+
+
+async def wait_for(predicate, timeout=3.0):
+    # Ждет, пока predicate() станет истинным; падает по таймауту
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError('условие не выполнилось за отведенное время')
+        await asyncio.sleep(0.01)
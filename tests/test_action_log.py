@@ -0,0 +1,73 @@
+import asyncio
+import sqlite3
+
+from action_log import ActionLogWriter
+from storage import Store
+
+
+class FlakyLog:
+    # Журнал, первая запись в который падает, как при заблокированной базе
+    def __init__(self):
+        self.entries = []
+        self.failures = 1
+
+    def append_many(self, entries, fsync=False):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        self.entries.extend(entries)
+
+
+def test_failed_flush_keeps_batch():
+    async def scenario():
+        log = FlakyLog()
+        writer = ActionLogWriter(log, flush_interval=0.01)
+        writer.start()
+        writer.append({'timestamp': '2026-10-14T10:00:00', 'action': 'on', 'valves': [1]})
+        await asyncio.sleep(0.05)
+        writer.append({'timestamp': '2026-10-14T10:01:00', 'action': 'off', 'valves': [1]})
+        await writer.stop()
+        assert [entry['action'] for entry in log.entries] == ['on', 'off']
+
+    asyncio.run(scenario())
+
+
+def pages(writer, descending, limit=3, **filters):
+    async def collect():
+        entries = []
+        while True:
+            page, has_more = await writer.query(offset=len(entries), limit=limit, descending=descending, **filters)
+            entries.extend(page)
+            if not has_more:
+                return entries
+
+    return asyncio.run(collect())
+
+
+def test_query_merges_pending_and_stored_entries(tmp_path):
+    store = Store(str(tmp_path / 'watering.db'))
+    entries = [
+        {'timestamp': f'2026-10-14T10:{minute:02d}:00', 'action': 'on' if minute % 2 else 'off', 'valves': [minute % 3]}
+        for minute in range(8)
+    ]
+    store.append_many(entries[:5])
+    # Последние записи еще в очереди писателя
+    writer = ActionLogWriter(store)
+    for entry in entries[5:]:
+        writer.append(entry)
+    for limit in (2, 3, 5, 10):
+        assert pages(writer, descending=False, limit=limit) == entries
+        assert pages(writer, descending=True, limit=limit) == entries[::-1]
+    by_valve = [entry for entry in entries if entry['valves'] == [1]]
+    assert pages(writer, descending=False, limit=1, valve=1) == by_valve
+    assert pages(writer, descending=True, limit=1, valve=1) == by_valve[::-1]
+    assert asyncio.run(writer.count(valve=1)) == len(by_valve)
+
+
+def test_query_pages_through_pending_only(tmp_path):
+    writer = ActionLogWriter(Store(str(tmp_path / 'watering.db')))
+    entries = [{'timestamp': f'2026-10-14T10:0{minute}:00', 'action': 'on', 'valves': [1]} for minute in range(4)]
+    for entry in entries:
+        writer.append(entry)
+    assert pages(writer, descending=True, limit=1) == entries[::-1]
+    assert pages(writer, descending=False, limit=1) == entries
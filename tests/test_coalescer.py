@@ -0,0 +1,38 @@
+import asyncio
+
+from coalescer import CommandCoalescer
+
+
+def test_off_wins_within_window_and_commands_share_one_send():
+    async def scenario():
+        sends = []
+
+        async def send(on, off):
+            sends.append((on, off))
+            return [3]
+
+        commands = CommandCoalescer(send, window=0.01)
+        # Порядок прихода не важен: выключение в том же окне отменяет включение
+        results = await asyncio.gather(
+            commands.submit('on', [1, 2]),
+            commands.submit('off', [2, 3]),
+            commands.submit('on', [4]),
+        )
+        assert sends == [([1, 4], [2, 3])]
+        assert results == [([], [2]), ([3], []), ([], [])]
+
+    asyncio.run(scenario())
+
+
+def test_send_error_reaches_every_waiter():
+    async def scenario():
+        async def send(on, off):
+            raise RuntimeError('нет связи')
+
+        commands = CommandCoalescer(send, window=0.01)
+        results = await asyncio.gather(
+            commands.submit('off', [1]), commands.submit('on', [2]), return_exceptions=True,
+        )
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    asyncio.run(scenario())
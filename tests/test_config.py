@@ -0,0 +1,27 @@
+from storage import Store
+
+CONFIG = {
+    'devices': {'main': {'ip': '192.168.1.48', 'port': 8080}},
+    'valve_mapping': {'1': {'device': 'main', 'pin': 16}, '2': {'device': 'main', 'pin': 14}},
+    'valve_names': {'1': 'Газон', '2': 'Грядки'},
+    'schedule': [],
+}
+
+
+def test_config_changes_reach_imported_database(tmp_path):
+    store = Store(str(tmp_path / 'watering.db'))
+    store.import_legacy(CONFIG, {})
+    store.save_valves([(1, 'Газон у дома', 'main', 12)])
+    config = {
+        'devices': {'main': {'ip': '192.168.1.50', 'port': 8080}, 'garden': {'ip': '192.168.1.51', 'port': 8080}},
+        'valve_mapping': {**CONFIG['valve_mapping'], '3': {'device': 'garden', 'pin': 12}},
+        'valve_names': {**CONFIG['valve_names'], '3': 'Сад'},
+    }
+    assert len(store.merge_config(config)) == 3
+    assert store.load_devices()['main']['ip'] == '192.168.1.50'
+    assert store.load_devices()['garden']['ip'] == '192.168.1.51'
+    mapping, names = store.load_valves()
+    # Правки из интерфейса остаются, новый клапан добавлен
+    assert mapping == {1: ('main', 12), 2: ('main', 14), 3: ('garden', 12)}
+    assert names[1] == 'Газон у дома' and names[3] == 'Сад'
+    assert store.merge_config(config) == []
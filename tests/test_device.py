@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from device import DeviceClient, DeviceError
+from esp_sim import EspSimulator
+
+
+@pytest.mark.parametrize('options, version', [
+    ({'keep_alive': False}, 1),
+    ({'protocol': 2}, 2),
+    ({'protocol': 3}, 3),
+])
+def test_set_and_status(options, version):
+    async def scenario():
+        simulator = await EspSimulator(pins=(12, 13, 14), **options).start()
+        client = DeviceClient('127.0.0.1', simulator.port)
+        try:
+            assert await client.protocol_version() == version
+            await client.set_pins(on=[12, 13])
+            await client.set_pins(on=[14], off=[12])
+            values, pins = await client.status()
+            assert values == 1 << 13 | 1 << 14
+            assert pins == 1 << 12 | 1 << 13 | 1 << 14
+        finally:
+            await client.close()
+            await simulator.stop()
+
+    asyncio.run(scenario())
+
+
+def test_pipelined_commands_keep_their_replies():
+    # Кадры протокола 2 уходят не дожидаясь ответов; ответы сопоставляются по id
+    async def scenario():
+        simulator = await EspSimulator(pins=(12, 13), protocol=2, latency=0.01, jitter=0.02, seed=1).start()
+        client = DeviceClient('127.0.0.1', simulator.port)
+        try:
+            results = await asyncio.gather(*(
+                client.set_pins(on=[12]) if n % 2 else client.status() for n in range(20)
+            ))
+            statuses = [result for result in results if result is not None]
+            assert len(statuses) == 10
+            assert all(pins == 1 << 12 | 1 << 13 for _, pins in statuses)
+        finally:
+            await client.close()
+            await simulator.stop()
+
+    asyncio.run(scenario())
+
+
+
+def test_firmware_upgrade_is_noticed():
+    # Плату перепрошили, пока бэкенд работал: клиент снова предлагает новый протокол
+    async def scenario():
+        simulator = await EspSimulator(pins=(12, 13), keep_alive=False).start()
+        port = simulator.port
+        client = DeviceClient('127.0.0.1', port, renegotiate_interval=0.05)
+        try:
+            assert await client.protocol_version() == 1
+            await client.set_pins(on=[12])
+            await simulator.stop()
+            simulator = await EspSimulator(pins=(12, 13), protocol=3).start(port=port)
+            await asyncio.sleep(0.1)
+            await client.set_pins(on=[13])
+            assert client.protocol == 3
+            values, _ = await client.status()
+            assert values == 1 << 13
+        finally:
+            await client.close()
+            await simulator.stop()
+
+    asyncio.run(scenario())
+
+
+def test_schedule_update_requires_base_version():
+    async def scenario():
+        simulator = await EspSimulator(pins=(12, 13), protocol=3).start()
+        client = DeviceClient('127.0.0.1', simulator.port)
+        try:
+            await client.clear_schedule('a.0')
+            # Промежуточная версия с точкой хранит элементы, но не применяет их
+            await client.update_schedule('a.0', 'a.1', add=['r0,3c,1000'])
+            assert simulator.runs == []
+            await client.update_schedule('a.1', 'a', add=['z0'])
+            assert await client.schedule_version() == ('a', 2)
+            assert simulator.runs == [(0, 60, 1 << 12)]
+            with pytest.raises(DeviceError):
+                await client.update_schedule('b', 'c', add=['z60'])
+            assert await client.schedule_version() == ('a', 2)
+        finally:
+            await client.close()
+            await simulator.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,67 @@
+import asyncio
+
+from helpers import wait_for
+from mqtt import MqttClient
+from mqtt_bridge import MqttBridge
+from mqtt_broker import MqttBroker
+from valve_state import ValveStateCache
+
+NAMES = {1: 'Клапан 1', 2: 'Клапан 2'}
+
+
+async def start_bridge(commands):
+    broker = await MqttBroker().start()
+    cache = ValveStateCache(fetch=None)
+
+    async def send_command(action, valves):
+        commands.append((action, valves))
+        return True
+
+    bridge = MqttBridge({'host': '127.0.0.1', 'port': broker.port}, cache, NAMES, send_command, retry_base=0.05)
+    bridge.start()
+    await wait_for(lambda: broker.retained.get('watering/status') == b'online')
+    return broker, cache, bridge
+
+
+def test_state_published_only_on_change():
+    async def scenario():
+        broker, cache, bridge = await start_bridge([])
+        try:
+            cache.update({1: True})
+            await wait_for(lambda: broker.retained.get('watering/valve/1/state') == b'ON')
+            cache.update({1: True})
+            cache.update({2: False})
+            await wait_for(lambda: broker.retained.get('watering/valve/2/state') == b'OFF')
+            valve_1 = [message for message in broker.published if message[0] == 'watering/valve/1/state']
+            assert valve_1 == [('watering/valve/1/state', b'ON', True)]
+            cache.update({1: False})
+            await wait_for(lambda: broker.retained.get('watering/valve/1/state') == b'OFF')
+            assert broker.retained['homeassistant/switch/watering_1/config']
+            await bridge.stop()
+            await wait_for(lambda: broker.retained.get('watering/status') == b'offline')
+        finally:
+            await bridge.stop()
+            await broker.stop()
+
+    asyncio.run(scenario())
+
+
+def test_set_topic_reaches_send_command():
+    async def scenario():
+        commands = []
+        broker, cache, bridge = await start_bridge(commands)
+        client = MqttClient('127.0.0.1', broker.port, client_id='test')
+        try:
+            await client.connect()
+            await client.publish('watering/valve/9/set', 'ON')
+            await client.publish('watering/valve/1/set', 'bogus')
+            await client.publish('watering/valve/2/set', 'on')
+            await wait_for(lambda: commands)
+            await asyncio.sleep(0.1)
+            assert commands == [('on', [2])]
+        finally:
+            await client.close()
+            await bridge.stop()
+            await broker.stop()
+
+    asyncio.run(scenario())
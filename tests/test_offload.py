@@ -0,0 +1,45 @@
+import asyncio
+from datetime import date
+from types import SimpleNamespace
+
+from device import DeviceClient
+from esp_sim import EspSimulator
+from offload import ScheduleSync, device_schedules, schedule_version
+
+
+def test_device_schedules_merge_pins_and_drop_past_cancellations():
+    timeline = SimpleNamespace(intervals={1: [(3600, 3660)], 2: [(3600, 3660)], 3: [(0, 3 * 3600)]})
+    mapping = {1: ('a', 12), 2: ('a', 13), 3: ('b', 12)}
+    schedules = device_schedules(
+        timeline, mapping, {'2026-10-13', '2026-10-20'}, max_on=600, today=date(2026, 10, 14), tz=10800,
+    )
+    assert schedules['a'] == {'z10800', 'x20261020', 'mc,258', 'md,258', f're10,3c,{(1 << 12 | 1 << 13):x}'}
+    # Предел включения не меньше самого долгого полива клапана
+    assert schedules['b'] == {'z10800', 'x20261020', 'mc,2a30', f'r0,2a30,{1 << 12:x}'}
+
+
+def test_push_sends_delta_only_over_confirmed_version():
+    async def scenario():
+        simulator = await EspSimulator(pins=(12, 13), protocol=3).start()
+        client = DeviceClient('127.0.0.1', simulator.port)
+        sync = ScheduleSync(None, None, None)
+        # Больше элементов, чем помещается в один кадр
+        tokens = {'z0'} | {f'r{start:x},3c,1000' for start in range(0, 40 * 60, 60)}
+        try:
+            assert await sync._push('a', client, tokens) == 'full'
+            assert simulator.schedule_version == schedule_version(tokens)
+            assert await sync._push('a', client, tokens) == 'unchanged'
+            tokens = tokens - {'r0,3c,1000'} | {'r0,78,1000'}
+            assert await sync._push('a', client, tokens) == 'delta'
+            assert simulator.schedule_tokens == tokens
+            # Плата потеряла расписание: версия не та, что отправляли, - перезапись целиком
+            simulator.schedule_version = '0'
+            simulator.schedule_tokens = set()
+            assert await sync._push('a', client, tokens) == 'full'
+            assert simulator.schedule_tokens == tokens
+            assert simulator.schedule_version == schedule_version(tokens)
+        finally:
+            await client.close()
+            await simulator.stop()
+
+    asyncio.run(scenario())
@@ -0,0 +1,141 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from coalescer import CommandCoalescer
+from esp_sim import EspSimulator
+from fleet import Fleet
+from helpers import wait_for
+from outbox import Outbox
+from reconciler import Reconciler
+from storage import Store
+from timeline import Dispatcher, compile_timeline, days_mapping
+from valve_state import ValveStateCache
+
+MAPPING = {1: ('main', 12), 2: ('main', 13)}
+
+
+async def dead_device():
+    # Порт, на котором симулятор будет запущен позже: пока на нем никто не слушает
+    simulator = await EspSimulator(pins=(12, 13)).start()
+    port = simulator.port
+    await simulator.stop()
+    return port
+
+
+def make_outbox(store, port, delivered):
+    fleet = Fleet({'main': {'ip': '127.0.0.1', 'port': port}}, MAPPING)
+    commands = CommandCoalescer(fleet.set, window=0)
+    outbox = Outbox(
+        store, commands.submit, on_delivered=lambda action, valves: delivered.append((action, valves)),
+        retry_base=0.05, retry_max=0.2,
+    )
+    return fleet, outbox
+
+
+def test_retry_until_device_returns(tmp_path):
+    async def scenario():
+        store = Store(str(tmp_path / 'watering.db'))
+        port = await dead_device()
+        delivered = []
+        fleet, outbox = make_outbox(store, port, delivered)
+        outbox.start()
+        assert await outbox.send('on', [1]) == [1]
+        assert outbox.pending(1) and store.load_outbox()
+        simulator = await EspSimulator(pins=(12, 13)).start(port=port)
+        try:
+            await wait_for(lambda: not outbox.pending(1))
+            assert simulator.pins[12] == 1
+            assert delivered == [('on', [1])]
+            assert store.load_outbox() == []
+        finally:
+            await outbox.stop()
+            await fleet.close()
+            await simulator.stop()
+            store.close()
+
+    asyncio.run(scenario())
+
+
+def test_expired_command_is_dropped(tmp_path):
+    async def scenario():
+        store = Store(str(tmp_path / 'watering.db'))
+        port = await dead_device()
+        fleet, outbox = make_outbox(store, port, [])
+        try:
+            assert await outbox.send('on', [1], deadline=time.time() + 0.1) == [1]
+            await asyncio.sleep(0.15)
+            await outbox.retry_due()
+            assert not outbox.pending(1)
+            assert store.load_outbox() == []
+        finally:
+            await fleet.close()
+            store.close()
+
+    asyncio.run(scenario())
+
+
+def test_queue_survives_restart(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'watering.db')
+        store = Store(path)
+        port = await dead_device()
+        fleet, outbox = make_outbox(store, port, [])
+        await outbox.send('off', [2])
+        await fleet.close()
+        store.close()
+
+        # Новый процесс: очередь читается из базы и доставляется, когда устройство доступно
+        store = Store(path)
+        simulator = await EspSimulator(pins=(12, 13)).start(port=port)
+        simulator.pins[13] = 1
+        delivered = []
+        fleet, outbox = make_outbox(store, port, delivered)
+        assert outbox.pending(2)
+        outbox.start()
+        try:
+            await wait_for(lambda: delivered == [('off', [2])])
+            assert simulator.pins[13] == 0
+        finally:
+            await outbox.stop()
+            await fleet.close()
+            await simulator.stop()
+            store.close()
+
+    asyncio.run(scenario())
+
+
+def test_reconciler_resumes_run_in_progress(tmp_path):
+    # После перезапуска посреди полива клапан закрыт, а по расписанию должен быть
+    # открыт: сверка включает его, не дожидаясь следующего события
+    async def scenario():
+        store = Store(str(tmp_path / 'watering.db'))
+        simulator = await EspSimulator(pins=(12, 13)).start()
+        started = datetime.now() - timedelta(minutes=1)
+        day = {number: name for name, number in days_mapping.items()}[started.weekday()]
+        schedule = [{'day': day, 'time': started.strftime('%H:%M'), 'duration': 10, 'valves': [1]}]
+        dispatcher = Dispatcher(compile_timeline(schedule), execute=None)
+        fleet, outbox = make_outbox(store, simulator.port, [])
+        cache = ValveStateCache(fleet.status, interval=0.05)
+        reconciler = Reconciler(store, cache, outbox, MAPPING, dispatcher, settle=0.01)
+        outbox.start()
+        cache.start()
+        reconciler.start()
+        try:
+            await wait_for(lambda: simulator.pins[12] == 1)
+            assert simulator.pins[13] == 0
+            # Ручное выключение важнее расписания до его следующего события
+            await reconciler.override('off', [1])
+            await outbox.send('off', [1])
+            await asyncio.sleep(0.3)
+            assert simulator.pins[12] == 0
+            assert store.load_overrides()[1][0] is False
+        finally:
+            await reconciler.stop()
+            await cache.stop()
+            await outbox.stop()
+            await fleet.close()
+            await simulator.stop()
+            store.close()
+
+    asyncio.run(scenario())
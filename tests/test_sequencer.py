@@ -0,0 +1,29 @@
+from sequencer import FlowSequencer
+
+
+def concurrent_flow(result, flows):
+    # Наибольший суммарный расход в любой момент плана
+    moments = sorted({start for intervals in result.values() for start, _ in intervals})
+    return max(
+        sum(flows[valve] for valve, intervals in result.items() for start, end in intervals if start <= moment < end)
+        for moment in moments
+    )
+
+
+def test_small_group_gets_earliest_finish():
+    # Жадно (сначала самые длинные) три двухминутных полива заканчиваются на 7-й минуте,
+    # а 3+3 и 2+2+2 минуты в две линии укладываются в 6
+    flows = {valve: 5 for valve in range(1, 6)}
+    sequencer = FlowSequencer(flows, {'main': 10}, lambda valve: 'main')
+    durations = {1: 180, 2: 180, 3: 120, 4: 120, 5: 120}
+    result, shifts = sequencer.plan({valve: [(0, length)] for valve, length in durations.items()})
+    assert max(end for intervals in result.values() for _, end in intervals) == 360
+    assert concurrent_flow(result, flows) <= 10
+    assert {valve: end - start for valve, [(start, end)] in result.items()} == durations
+    assert len(shifts) == 3
+
+
+def test_unlimited_device_and_valves_without_flow_are_left_alone():
+    sequencer = FlowSequencer({1: 5, 2: 0}, {'main': 0, 'garden': 10}, lambda valve: 'main' if valve == 1 else 'garden')
+    intervals = {1: [(0, 60)], 2: [(0, 60)]}
+    assert sequencer.plan(intervals) == (intervals, [])
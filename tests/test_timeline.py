@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from timeline import DAY_SECONDS, WEEK_SECONDS, compile_timeline, merge_runs
+
+SUNDAY = 6 * DAY_SECONDS
+
+
+def test_run_over_sunday_midnight_merges_with_monday_run():
+    # Воскресенье 23:50-00:10 и понедельник 00:05-00:30 - один полив, пересечение в 00:05
+    intervals, overlaps = merge_runs([(SUNDAY + 23 * 3600 + 50 * 60, WEEK_SECONDS + 600), (300, 1800)])
+    assert intervals == [(SUNDAY + 23 * 3600 + 50 * 60, WEEK_SECONDS + 1800)]
+    assert overlaps == [300]
+
+
+def test_timeline_keeps_valve_open_across_week_boundary():
+    timeline = compile_timeline([{'day': 'Воскресенье', 'time': '23:50', 'duration': 20, 'valves': [1]}])
+    sunday = datetime(2026, 10, 18, 23, 55)
+    monday = datetime(2026, 10, 19, 0, 5)
+    assert timeline.active_at(sunday) == {1}
+    assert timeline.active_at(monday) == {1}
+    assert timeline.active_at(datetime(2026, 10, 19, 0, 10)) == set()
+    assert timeline.active_runs(monday) == {1: datetime(2026, 10, 18, 23, 50)}
+    when, event = timeline.next_event(sunday)
+    assert when == datetime(2026, 10, 19, 0, 10) and event.off == {1}
@@ -0,0 +1,73 @@
+from datetime import datetime
+
+from storage import Store
+
+DAY = '2026-10-14T'
+
+
+def fold(tmp_path, entries):
+    # Записи приходят в журнал в порядке списка, по одной, как отчеты плат
+    store = Store(str(tmp_path / 'watering.db'))
+    for timestamp, action in entries:
+        store.append_many([{'timestamp': DAY + timestamp, 'action': action, 'valves': [1]}])
+    runs = store._fetch('SELECT started, ended FROM runs ORDER BY started')
+    return store, [(started[11:], ended[11:]) for started, ended in runs]
+
+
+def test_late_off_splits_closed_run(tmp_path):
+    store, runs = fold(tmp_path, [('10:03:00', 'on'), ('10:38:00', 'on'), ('10:59:00', 'off'), ('10:14:00', 'off')])
+    assert runs == [('10:03:00', '10:14:00'), ('10:38:00', '10:59:00')]
+    assert store.usage('day') == [(1, '2026-10-14', 32 * 60.0, 2)]
+    assert store.usage('week') == [(1, '2026-10-12', 32 * 60.0, 2)]
+
+
+def test_late_off_shortens_closed_run(tmp_path):
+    store, runs = fold(tmp_path, [('10:03:00', 'on'), ('10:59:00', 'off'), ('10:14:00', 'off')])
+    assert runs == [('10:03:00', '10:14:00')]
+    assert store.usage('day') == [(1, '2026-10-14', 11 * 60.0, 1)]
+
+
+def test_late_off_closes_open_run(tmp_path):
+    store, runs = fold(tmp_path, [('10:03:00', 'on'), ('10:38:00', 'on'), ('10:14:00', 'off')])
+    assert runs == [('10:03:00', '10:14:00')]
+    assert store.load_open_runs()[1].isoformat() == DAY + '10:38:00'
+
+
+def test_late_on_before_recorded_off(tmp_path):
+    store, runs = fold(tmp_path, [('12:00:10', 'off'), ('12:00:00', 'on')])
+    assert runs == [('12:00:00', '12:00:10')]
+    assert store.usage('day') == [(1, '2026-10-14', 10.0, 1)]
+
+
+def test_run_across_midnight_and_week_boundary(tmp_path):
+    store = Store(str(tmp_path / 'watering.db'))
+    store.append_many([
+        {'timestamp': '2026-10-18T23:50:00', 'action': 'on', 'valves': [1, 2]},
+        {'timestamp': '2026-10-19T00:20:00', 'action': 'off', 'valves': [1, 2]},
+    ])
+    # Полив засчитывается дню и неделе начала, минуты - по дням фактически
+    assert store.usage('day') == [
+        (1, '2026-10-18', 600.0, 1), (2, '2026-10-18', 600.0, 1),
+        (1, '2026-10-19', 1200.0, 0), (2, '2026-10-19', 1200.0, 0),
+    ]
+    assert store.usage('week') == [
+        (1, '2026-10-12', 600.0, 1), (2, '2026-10-12', 600.0, 1),
+        (1, '2026-10-19', 1200.0, 0), (2, '2026-10-19', 1200.0, 0),
+    ]
+
+
+def test_repeated_on_continues_run(tmp_path):
+    store, runs = fold(tmp_path, [('10:00:00', 'on'), ('10:05:00', 'on'), ('10:10:00', 'off'), ('10:20:00', 'off')])
+    assert runs == [('10:00:00', '10:10:00')]
+    assert store.usage('day') == [(1, '2026-10-14', 600.0, 1)]
+
+
+def test_lost_off_closes_run_as_estimated(tmp_path):
+    store, runs = fold(tmp_path, [('01:00:00', 'on'), ('09:00:00', 'on'), ('09:30:00', 'off')])
+    # Выключение потерялось: первый полив обрезан по MAX_RUN, второй начался заново
+    assert runs == [('01:00:00', '07:00:00'), ('09:00:00', '09:30:00')]
+    assert [estimated for estimated, in store._fetch('SELECT estimated FROM runs ORDER BY started')] == [1, 0]
+    store.append_many([{'timestamp': DAY + '10:00:00', 'action': 'on', 'valves': [1]}])
+    store.close_interrupted_runs([1], datetime.fromisoformat(DAY + '10:15:00'))
+    assert store.load_open_runs() == {}
+    assert store.usage('day') == [(1, '2026-10-14', 6 * 3600 + 1800 + 900.0, 3)]